@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'customusers.settings')
+# Serve the read-heavy user endpoints with their async views.
+os.environ.setdefault('ASYNC_USER_VIEWS', 'True')
 
 application = get_asgi_application()
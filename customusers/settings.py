@@ -1,7 +1,8 @@
 import os
+import sys
 from pathlib import Path
 
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -35,6 +36,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'profiles.middleware.MetricsMiddleware',
+    'profiles.middleware.RequestIDMiddleware',
+    'profiles.middleware.ReplicaMiddleware',
+    'profiles.middleware.IdentityMapMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,6 +83,29 @@ DATABASES = {
     }
 }
 
+# Read replicas, see profiles.db_routers. DATABASE_REPLICAS is a comma separated
+# list of database NAMEs (local SQLite files work); each becomes a `replicaN`
+# alias. Leave it unset for the test suite, which sets up its own replicas.
+DATABASE_REPLICAS = config('DATABASE_REPLICAS', default='', cast=Csv())
+REPLICA_DATABASES = ['replica{0}'.format(i) for i in range(1, len(DATABASE_REPLICAS) + 1)]
+DATABASES.update({alias: dict(DATABASES['default'], NAME=name)
+                  for alias, name in zip(REPLICA_DATABASES, DATABASE_REPLICAS)})
+REPLICA_MODELS = ['profiles.CustomUser', 'profiles.AuthToken']
+# Seconds a user who was written to keeps reading from the primary.
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=int)
+# Seconds between health checks of each replica.
+REPLICA_HEALTH_INTERVAL = config('REPLICA_HEALTH_INTERVAL', default=5, cast=int)
+
+# Users sharded by email hash, see profiles.sharding. USER_SHARDS is a comma
+# separated list of database NAMEs for the shards after `default`; each becomes
+# a `shardN` alias. Run `migrate --database shardN` for every shard.
+USER_SHARDS = config('USER_SHARDS', default='', cast=Csv())
+SHARD_DATABASES = ['default'] + ['shard{0}'.format(i) for i in range(1, len(USER_SHARDS) + 1)]
+DATABASES.update({alias: dict(DATABASES['default'], NAME=name)
+                  for alias, name in zip(SHARD_DATABASES[1:], USER_SHARDS)})
+
+DATABASE_ROUTERS = ['profiles.db_routers.ShardRouter', 'profiles.db_routers.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -116,9 +144,47 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+DEFAULT_FILE_STORAGE = 'profiles.storage.MediaStorage'
+# Serve MEDIA_URL from Django (with ETag and range support). Set MEDIA_SENDFILE_HEADER to
+# 'X-Sendfile' or 'X-Accel-Redirect' to hand the file transfer to the front end server.
+SERVE_MEDIA = config('SERVE_MEDIA', default=DEBUG, cast=bool)
+MEDIA_SENDFILE_HEADER = config('MEDIA_SENDFILE_HEADER', default=None)
+MEDIA_ACCEL_REDIRECT_PREFIX = config('MEDIA_ACCEL_REDIRECT_PREFIX', default='/protected-media/')
+# Store identical profile images once under MEDIA_ROOT/cas/
+PROFILE_IMAGE_DEDUPE = config('PROFILE_IMAGE_DEDUPE', default=False, cast=bool)
+
+# Profile image uploads, see profiles.uploadhandlers
+PROFILE_IMAGE_MAX_UPLOAD_SIZE = config('PROFILE_IMAGE_MAX_UPLOAD_SIZE', default=5 * 2 ** 20, cast=int)
+PROFILE_IMAGE_MEMORY_THRESHOLD = config('PROFILE_IMAGE_MEMORY_THRESHOLD', default=256 * 2 ** 10, cast=int)
+
+# Profile image variants, see profiles.images
+PROFILE_IMAGE_VARIANT_SIZES = (64, 128, 256)
+PROFILE_IMAGE_VARIANT_CACHE_MAX_BYTES = config('PROFILE_IMAGE_VARIANT_CACHE_MAX_BYTES', default=512 * 1024 * 1024,
+                                               cast=int)
 
 AUTH_USER_MODEL = 'profiles.CustomUser'
 
+AUTHENTICATION_BACKENDS = ['profiles.backends.EmailBackend']
+
+# Password hashing executor, see profiles.hashing
+HASHING_EXECUTOR = config('HASHING_EXECUTOR', default='thread')  # thread, process or inline
+HASHING_WORKERS = config('HASHING_WORKERS', default=os.cpu_count() or 1, cast=int)
+HASHING_MAX_PENDING = config('HASHING_MAX_PENDING', default=64, cast=int)
+HASHING_TIMEOUT = config('HASHING_TIMEOUT', default=10, cast=int)
+
+# PBKDF2 iterations: PASSWORD_HASH_ITERATIONS when set, else the count
+# `manage.py calibrate_hasher` wrote to PASSWORD_HASH_CALIBRATION_FILE, else
+# Django's default. Hashes with another count are redone after login.
+PASSWORD_HASHERS = [
+    'profiles.hashing.CalibratedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = config('PASSWORD_HASH_ITERATIONS', default=0, cast=int)
+PASSWORD_HASH_CALIBRATION_FILE = config('PASSWORD_HASH_CALIBRATION_FILE',
+                                        default=os.path.join(BASE_DIR, 'hasher_calibration.json'))
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny'
@@ -126,6 +192,111 @@ REST_FRAMEWORK = {
 
 }
 
+# Encode and decode the users API's JSON with orjson when it is installed
+# (pip install orjson), see profiles.renderers.FastJSONRenderer.
+FAST_JSON = config('FAST_JSON', default=True, cast=bool)
+
+# Sliding window limits on login, register and forget_password, per client IP
+# and per email, see profiles.throttling. THROTTLE_BACKEND 'cache' keeps the
+# windows in the THROTTLE_CACHE_ALIAS cache so every worker shares them.
+THROTTLE_ENABLED = config('THROTTLE_ENABLED', default=True, cast=bool)
+THROTTLE_BACKEND = config('THROTTLE_BACKEND', default='locmem')
+THROTTLE_CACHE_ALIAS = 'default'
+THROTTLE_LOCMEM_MAX_KEYS = config('THROTTLE_LOCMEM_MAX_KEYS', default=100000, cast=int)
+THROTTLE_RATES = {
+    'login': {'ip': config('LOGIN_IP_RATE', default='60/min'), 'email': config('LOGIN_EMAIL_RATE', default='10/min')},
+    'register': {'ip': config('REGISTER_IP_RATE', default='20/min'), 'email': '5/hour'},
+    'forget_password': {'ip': config('FORGET_PASSWORD_IP_RATE', default='20/min'), 'email': '5/hour'},
+}
+
+# OpenAPI schema artifact written by `manage.py generate_schema` and served
+# by /swagger/?format=openapi, see profiles.schema.
+OPENAPI_SCHEMA_DIR = config('OPENAPI_SCHEMA_DIR', default=os.path.join(BASE_DIR, 'schema'))
+OPENAPI_SCHEMA_MAX_AGE = config('OPENAPI_SCHEMA_MAX_AGE', default=24 * 3600, cast=int)
+
+# Staff user listing in `users/me` and `users/export`
+USER_LIST_PAGE_SIZE = config('USER_LIST_PAGE_SIZE', default=100, cast=int)
+USER_EXPORT_CHUNK_SIZE = config('USER_EXPORT_CHUNK_SIZE', default=2000, cast=int)
+# Under ASGI an export is written to a temporary file first, on disk past this size.
+USER_EXPORT_SPOOL_MAX_MEMORY = config('USER_EXPORT_SPOOL_MAX_MEMORY', default=8 * 1024 * 1024, cast=int)
+
+# Logging: JSON lines written by a background thread, see profiles.log
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+# 'queue' or 'null'; `manage.py test` discards records so its output stays readable.
+LOG_HANDLER = config('LOG_HANDLER', default='null' if sys.argv[1:2] == ['test'] else 'queue')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {'()': 'profiles.log.RequestIDFilter'},
+        # The permission and token paths log on every request; keep a fraction.
+        'sample_permissions': {'()': 'profiles.log.SamplingFilter',
+                               'rate': config('LOG_SAMPLE_PERMISSIONS', default=0.01, cast=float)},
+        'sample_tokens': {'()': 'profiles.log.SamplingFilter',
+                          'rate': config('LOG_SAMPLE_TOKENS', default=0.01, cast=float)},
+    },
+    'formatters': {
+        'json': {'()': 'profiles.log.JSONFormatter'},
+    },
+    'handlers': {
+        'queue': {
+            'class': 'profiles.log.BackgroundQueueHandler',
+            'stream': 'ext://sys.stdout',
+            'filters': ['request_id'],
+            'formatter': 'json',
+        },
+        'null': {
+            'class': 'logging.NullHandler',
+        },
+    },
+    'loggers': {
+        'profiles': {
+            'handlers': [LOG_HANDLER],
+            'level': LOG_LEVEL,
+            'propagate': False,
+        },
+        'profiles.permissions': {
+            'level': config('LOG_LEVEL_PERMISSIONS', default=LOG_LEVEL),
+            'filters': ['sample_permissions'],
+        },
+        'profiles.tokens': {
+            'level': config('LOG_LEVEL_TOKENS', default=LOG_LEVEL),
+            'filters': ['sample_tokens'],
+        },
+    },
+}
+
+# Prometheus metrics at /metrics, see profiles.metrics
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+
+# In-process token -> user cache used by profiles.authentication.CachedTokenAuthentication
+TOKEN_CACHE_SIZE = config('TOKEN_CACHE_SIZE', default=10000, cast=int)
+TOKEN_CACHE_TTL = config('TOKEN_CACHE_TTL', default=300, cast=int)
+# API tokens (profiles.AuthToken) expire this many seconds after login; expired
+# ones are deleted by `manage.py purge_tokens`. Their last use is recorded at
+# most every TOKEN_LAST_USED_INTERVAL seconds.
+TOKEN_TTL = config('TOKEN_TTL', default=30 * 24 * 3600, cast=int)
+TOKEN_LAST_USED_INTERVAL = config('TOKEN_LAST_USED_INTERVAL', default=300, cast=int)
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='customusers'),
+    },
+}
+# Serialized `users/me` payloads of non-staff users, see profiles.mecache.
+# A timeout of 0 turns the cache off.
+ME_CACHE_ALIAS = 'default'
+ME_CACHE_TIMEOUT = config('ME_CACHE_TIMEOUT', default=300, cast=int)
+
+# Async views for `users/me`, `users/logout`, `users/export` and the reset
+# password page, see profiles.asyncviews. Switched on by asgi.py;
+# ASYNC_DB_WORKERS bounds the threads their queries and template rendering
+# run on.
+ASYNC_USER_VIEWS = config('ASYNC_USER_VIEWS', default=False, cast=bool)
+ASYNC_DB_WORKERS = config('ASYNC_DB_WORKERS', default=16, cast=int)
+
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
         'Basic': {
@@ -150,3 +321,9 @@ EMAIL_USE_SSL = False
 # print(EMAIL_HOST_PASSWORD)
 PASSWORD_RESET_TIMEOUT = 86400
 # PASSWORD_RESET_TIMEOUT = 30
+
+# Outbox delivery, see `manage.py drain_outbox`
+OUTBOX_WORKERS = config('OUTBOX_WORKERS', default=4, cast=int)
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=50, cast=int)
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=5, cast=int)
+OUTBOX_RETRY_BACKOFF = config('OUTBOX_RETRY_BACKOFF', default=30, cast=int)
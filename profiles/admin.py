@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import CustomUser
+from .models import AuthToken, CustomUser, OutboxMessage
 
 # Register your models here.
 admin.site.register(CustomUser)
+admin.site.register(OutboxMessage)
+admin.site.register(AuthToken)
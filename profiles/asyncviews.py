@@ -0,0 +1,212 @@
+"""
+Async versions of the read-heavy UserViewSet actions (`me`, `logout`,
+`export` and the reset password page), used when the project is served
+over ASGI.
+
+Django 3.1 has no async ORM, so queries and template rendering run on a
+bounded pool of worker threads while the event loop only parses headers,
+checks cached tokens and renders JSON. Requests the async views do not
+handle (other methods, browsers asking for the browsable API, reset form
+posts) are passed to the regular viewset view.
+"""
+import asyncio
+import contextvars
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from rest_framework import exceptions, status
+from rest_framework.authentication import get_authorization_header
+from rest_framework.request import Request
+
+from . import metrics
+from .authentication import CachedTokenAuthentication
+from .models import CustomUser
+from .pagination import UserCursorPagination
+from .renderers import FastJSONRenderer
+from .serializers import ResetPasswordSerializer
+from .views import UserViewSet, log_out, log_out_everywhere, me_data, me_listing, reset_link_user, set_me_validators, \
+    user_queryset
+
+# Exports larger than this are spooled to disk instead of memory.
+EXPORT_SPOOL_MAX_MEMORY = getattr(settings, 'USER_EXPORT_SPOOL_MAX_MEMORY', 8 * 1024 * 1024)
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'ASYNC_DB_WORKERS', 16),
+                              thread_name_prefix='async-db')
+
+
+def _call(func, *args, **kwargs):
+    # What request_started/request_finished do for a sync request.
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run `func` on the worker pool. The request's context variables (such as
+    the logging request id) go along with it.
+    """
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _call, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    response = HttpResponse(FastJSONRenderer().render(data), status=status_code, content_type='application/json')
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def error_response(exc):
+    response = json_response({'detail': exc.detail}, exc.status_code)
+    if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+        response['WWW-Authenticate'] = CachedTokenAuthentication.keyword
+    return response
+
+
+async def authenticate(request):
+    """
+    Token authentication for async views: cache hits are served on the event
+    loop, misses are looked up on the worker pool. Returns a DRF Request
+    carrying the user and token; raises NotAuthenticated without a token.
+    """
+    auth = get_authorization_header(request).split()
+    authenticator = CachedTokenAuthentication()
+    if not auth or auth[0].lower() != authenticator.keyword.lower().encode():
+        raise exceptions.NotAuthenticated()
+    if len(auth) != 2:
+        raise exceptions.AuthenticationFailed('Invalid token header.')
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise exceptions.AuthenticationFailed('Invalid token header. Token string should not contain invalid '
+                                              'characters.')
+    user, token = authenticator.cached_credentials(key) or await run_blocking(authenticator.fetch_credentials, key)
+    if authenticator.touch_due(token):
+        await run_blocking(authenticator.touch, user, token)
+    drf_request = Request(request, authenticators=())
+    drf_request.user, drf_request.auth = user, token
+    return drf_request
+
+
+def wants_html(request):
+    accept = request.META.get('HTTP_ACCEPT', '')
+    return 'text/html' in accept and 'application/json' not in accept
+
+
+def async_action(action, fallback, html=False):
+    """
+    Wrap an async handler for `action`: GETs are handled by it, everything
+    else by the sync `fallback` view.
+    """
+    fallback = sync_to_async(fallback)
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def view(request, *args, **kwargs):
+            if request.method != 'GET' or (not html and wants_html(request)):
+                return await fallback(request, *args, **kwargs)
+            try:
+                return await handler(request, *args, **kwargs)
+            except exceptions.APIException as exc:
+                return error_response(exc)
+        # Read by MetricsMiddleware, like a viewset view's mapping.
+        view.actions = {'get': action}
+        return view
+    return decorator
+
+
+def load_me(request):
+    return me_listing(request, user_queryset(request, CustomUser.objects.all()), UserCursorPagination(),
+                      {'request': request})
+
+
+def me_view(fallback):
+    @async_action('me', fallback)
+    async def me(request):
+        request = await authenticate(request)
+        serialize, extra, last_modified, etag = await run_blocking(load_me, request)
+        not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        response = json_response(me_data(request, serialize(), extra))
+        return set_me_validators(response, etag, last_modified)
+    return me
+
+
+def logout_view(fallback):
+    @async_action('logout', fallback)
+    async def logout(request):
+        request = await authenticate(request)
+        if not await run_blocking(log_out, request.auth, everywhere=log_out_everywhere(request)):
+            return json_response({'result': 'error in logout, try again'}, status.HTTP_400_BAD_REQUEST)
+        return json_response({'result': 'successfully logged out'})
+    return logout
+
+
+def render_page(request, template_name, context):
+    with metrics.timer(metrics.TEMPLATE_RENDER_TIME, template=template_name):
+        return render_to_string(template_name, context, request=request)
+
+
+def reset_password_view(fallback):
+    @async_action('reset_password', fallback, html=True)
+    async def reset_password(request, uid, token):
+        user = await run_blocking(reset_link_user, uid, token)
+        if user is not None and user.has_requested_password_reset:
+            template_name = 'reset_password.html'
+            context = {'view': UserViewSet, 'reset_password': ResetPasswordSerializer()}
+        else:
+            template_name, context = 'error_password.html', {}
+        return HttpResponse(await run_blocking(render_page, request, template_name, context))
+    return reset_password
+
+
+def iter_spool(spool):
+    with spool:
+        yield from iter(lambda: spool.read(SPOOL_CHUNK_SIZE), b'')
+
+
+def spooled_response(view, request):
+    """
+    `view`'s response with a streamed body drained into a temporary file.
+    Django 3.1 iterates a streaming response on the event loop, where the
+    export's queries would raise SynchronousOnlyOperation, so the rows are
+    read here, on the worker pool, and only file reads are left to the loop.
+    """
+    response = view(request)
+    if not response.streaming:
+        return response
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_MEMORY)
+    try:
+        for part in response:
+            spool.write(part)
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        response.close()
+    spool.seek(0)
+    spooled = StreamingHttpResponse(iter_spool(spool), status=response.status_code)
+    for header, value in response.items():
+        spooled[header] = value
+    return spooled
+
+
+def export_view(fallback):
+    @async_action('export', fallback, html=True)
+    async def export(request):
+        # Authentication, permissions and the format check are the
+        # viewset's own.
+        return await run_blocking(spooled_response, fallback, request)
+    return export
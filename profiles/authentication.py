@@ -0,0 +1,214 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from . import identity, metrics, sharding
+from .db_routers import primary_fallback, read_after_write, use_primary
+from .models import AuthToken
+
+
+def _snapshot(instance):
+    # Plain field values only, so a cached entry never shares state with
+    # the instance a request is free to mutate.
+    fields = instance._meta.concrete_fields
+    return (instance._state.db, [f.attname for f in fields],
+            [getattr(instance, f.attname) for f in fields])
+
+
+def _restore(model, snapshot):
+    db, field_names, values = snapshot
+    return model.from_db(db, field_names, values)
+
+
+class TokenCache:
+    """
+    Bounded LRU map of token key -> (token, user) snapshots with a TTL.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, key, token, user):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, _snapshot(token), _snapshot(user), user.pk)
+            self._keys_by_user.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def update_token(self, key, token):
+        """
+        Replace the token snapshot of a cached entry, keeping its user and
+        its expiry: the TTL is what bounds how stale the entry can get.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], _snapshot(token)) + entry[2:]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_user(self, user_pk):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_pk, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_pk = entry[3]
+        keys = self._keys_by_user.get(user_pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user_pk]
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_CACHE_TTL', 300),
+)
+
+
+@metrics.registry.register_collector
+def collect_token_cache_stats():
+    stats = token_cache.stats()
+    return [
+        ('profiles_token_cache_requests_total', 'counter', 'Token cache lookups by result.',
+         [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]),
+        ('profiles_token_cache_evictions_total', 'counter', 'Token cache entries evicted for space.',
+         [({}, stats['evictions'])]),
+        ('profiles_token_cache_size', 'gauge', 'Token cache entries.', [({}, stats['size'])]),
+    ]
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication against AuthToken that serves repeat lookups from
+    the in-process token cache instead of joining AuthToken and CustomUser
+    on every request. Expired tokens are rejected.
+    """
+    model = AuthToken
+    cache = token_cache
+
+    def authenticate_credentials(self, key):
+        user, token = self.cached_credentials(key) or self.fetch_credentials(key)
+        self.touch(user, token)
+        return user, token
+
+    def cached_credentials(self, key):
+        """
+        (user, token) from the cache, or None. Never touches the database,
+        apart from the replica pin lookup in the cache framework.
+        """
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+        model = self.get_model()
+        token_snapshot, user_snapshot = cached
+        token = _restore(model, token_snapshot)
+        user = _restore(model._meta.get_field('user').related_model, user_snapshot)
+        model.user.field.set_cached_value(token, user)
+        if read_after_write(user):
+            return None
+        self.check_expiry(token)
+        return user, token
+
+    def fetch_credentials(self, key):
+        # A token created moments ago may not have reached the replica yet.
+        user, token = primary_fallback(exceptions.AuthenticationFailed, self.lookup, key)
+        if read_after_write(user):
+            with use_primary():
+                user, token = self.lookup(key)
+        self.check_expiry(token)
+        self.cache.set(key, token, user)
+        return identity.remember(user), token
+
+    def check_expiry(self, token):
+        if token.is_expired:
+            self.cache.invalidate(token.key)
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+
+    def touch_due(self, token):
+        interval = datetime.timedelta(seconds=getattr(settings, 'TOKEN_LAST_USED_INTERVAL', 300))
+        return token.last_used_at is None or token.last_used_at <= timezone.now() - interval
+
+    def touch(self, user, token):
+        """
+        Record that `token` was used, at most once per
+        TOKEN_LAST_USED_INTERVAL. The UPDATE is conditional, so workers
+        racing on the same token write it once between them.
+        """
+        if not self.touch_due(token):
+            return
+        now = timezone.now()
+        since = now - datetime.timedelta(seconds=getattr(settings, 'TOKEN_LAST_USED_INTERVAL', 300))
+        sharding.on_shard(self.get_model().objects, sharding.db_for_user(token)).filter(key=token.key).filter(
+            Q(last_used_at__isnull=True) | Q(last_used_at__lte=since)).update(last_used_at=now)
+        # Whether or not this worker won, the cached copy is not due again.
+        token.last_used_at = now
+        self.cache.update_token(token.key, token)
+
+    def lookup(self, key):
+        if not sharding.enabled():
+            return super().authenticate_credentials(key)
+        # The key names the shard; a token moved by a rebalance is found on another one.
+        model = self.get_model()
+        try:
+            token = sharding.get_from_shards(model.objects.select_related('user'), sharding.shard_for_token(key),
+                                             key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return token.user, token
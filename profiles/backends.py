@@ -0,0 +1,84 @@
+import functools
+import logging
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import make_password
+from django.db import connections
+from django.db.models import F
+
+from . import sharding
+from .db_routers import primary_fallback, read_after_write, use_primary
+from .hashing import hashing_executor, must_update
+from .models import canonical_email
+
+logger = logging.getLogger(__name__)
+
+UserModel = get_user_model()
+
+
+def rehash_password(using, pk, encoded, password_hash, close_connection=True):
+    """
+    Replace the outdated hash `encoded` of user `pk` with `password_hash`,
+    unless the password changed in the meantime. Called once the hashing
+    executor made the new hash, after the login response went out.
+    """
+    try:
+        updated = UserModel._default_manager.db_manager(using).filter(pk=pk, password=encoded).update(
+            password=password_hash, version=F('version') + 1)
+    finally:
+        if close_connection:
+            # Pool workers are not request threads, nothing else closes it.
+            connections[using].close()
+    logger.info('Rehashed password of user %s: %s', pk, 'done' if updated else 'changed meanwhile')
+
+
+class EmailBackend(ModelBackend):
+    """
+    ModelBackend that verifies passwords on the hashing executor instead of
+    the request thread.
+    """
+
+    def authenticate(self, request, email=None, password=None, **kwargs):
+        if email is None:
+            email = kwargs.get(UserModel.USERNAME_FIELD)
+        if email is None or password is None:
+            return None
+        try:
+            # An account registered moments ago may not have reached the replica yet.
+            user = primary_fallback(UserModel.DoesNotExist, self.get_by_email, email)
+            if read_after_write(user):
+                with use_primary():
+                    user = self.get_by_email(email)
+        except UserModel.DoesNotExist:
+            # Hash anyway so a missing account takes as long as a wrong password.
+            hashing_executor.make_password(password)
+            return None
+        if not hashing_executor.check_password(password, user.password):
+            return None
+        if must_update(user.password):
+            # Only the hashing runs on the executor: process workers must not
+            # use the connections they inherited.
+            hashing_executor.run_later(make_password, password, callback=functools.partial(
+                rehash_password, sharding.shard_of(user), user.pk, user.password,
+                close_connection=hashing_executor.mode != 'inline'))
+        if self.user_can_authenticate(user):
+            return user
+        return None
+
+    def get_by_email(self, email):
+        if not sharding.enabled():
+            return UserModel._default_manager.get_by_natural_key(email)
+        # Found on another shard when the user has not been rebalanced yet.
+        return sharding.get_from_shards(UserModel._default_manager.all(), sharding.shard_for_email(email),
+                                        email_canonical=canonical_email(email))
+
+    def get_user(self, user_id):
+        if not sharding.enabled():
+            return super().get_user(user_id)
+        try:
+            user = sharding.get_from_shards(UserModel._default_manager.all(), sharding.shard_for_pk(user_id),
+                                            pk=user_id)
+        except (UserModel.DoesNotExist, ValueError):
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,369 @@
+"""
+Micro-benchmarks of the serializers, token generator and permission class,
+plus an in-process load driver for every UserViewSet route. See the
+`benchmark` management command for running them against a seeded database.
+"""
+import json
+import platform
+import random
+import sqlite3
+import time
+from io import BytesIO
+from urllib.parse import urlencode
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import RequestFactory
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+
+from .metrics import QueryTimer
+from .models import AuthToken, CustomUser
+from .permissions import UserAccessPermission
+from .renderers import FastJSONRenderer
+from .serializers import LoginSerializer, RegisterSerializer, ResetPasswordSerializer, UserRowSerializer, \
+    UserSerializer
+from .sharding import encode_uid
+from .tokens import default_token_generator
+
+PASSWORD = 'Bench-pass-0!'
+# Settings the load driver runs under: it sends every request from one
+# client, which the login/register throttles would otherwise turn into 429s.
+SETTINGS_OVERRIDES = {'THROTTLE_ENABLED': False}
+STAFF_EMAIL = 'staff@bench.test'
+SEED_BATCH_SIZE = 5000
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def summarize(samples, queries=None, errors=0):
+    """
+    Reduce per-call durations (seconds) to throughput and latency
+    percentiles in milliseconds.
+    """
+    ordered = sorted(samples)
+    total = sum(ordered)
+    summary = {
+        'count': len(ordered),
+        'throughput': len(ordered) / total if total else 0.0,
+        'mean_ms': total / len(ordered) * 1000 if ordered else 0.0,
+        'p50_ms': percentile(ordered, .50) * 1000,
+        'p99_ms': percentile(ordered, .99) * 1000,
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+    }
+    if queries is not None:
+        summary['queries_per_request'] = sum(queries) / len(queries) if queries else 0.0
+        summary['queries_max'] = max(queries, default=0)
+        summary['errors'] = errors
+    return summary
+
+
+def seed_users(count, batch_size=SEED_BATCH_SIZE):
+    """
+    Insert `count` users sharing one precomputed password hash, plus a staff
+    user. Returns the staff user.
+    """
+    encoded = make_password(PASSWORD)
+    for start in range(0, count, batch_size):
+        CustomUser.objects.bulk_create([
+            CustomUser(email='user{0}@bench.test'.format(i), email_canonical='user{0}@bench.test'.format(i),
+                       name='User {0}'.format(i), password=encoded)
+            for i in range(start, min(start + batch_size, count))
+        ], batch_size=batch_size)
+    return CustomUser.objects.create_user(STAFF_EMAIL, PASSWORD, is_staff=True)
+
+
+def png_upload(name='avatar.png', size=(300, 200)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class Context:
+    """
+    State shared by the benchmarks: a seeded RNG, the staff user and a way
+    to pick random seeded users.
+    """
+
+    def __init__(self, seed=0, page_size=50):
+        self.rng = random.Random(seed)
+        self.page_size = page_size
+        self.staff = CustomUser.objects.get(email=STAFF_EMAIL)
+        pks = CustomUser.objects.filter(is_staff=False).order_by('pk').values_list('pk', flat=True)
+        self.first_pk, self.last_pk = pks.first(), pks.last()
+        self.counter = 0
+
+    def unique(self, prefix):
+        self.counter += 1
+        return '{0}-{1}@bench.test'.format(prefix, self.counter)
+
+    def user(self):
+        return CustomUser.objects.get(pk=self.rng.randint(self.first_pk, self.last_pk))
+
+    def client(self, user):
+        client = APIClient()
+        token = AuthToken.objects.create(user=user)
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        return client
+
+    def reset_path(self, user):
+        return '/users/reset-password/{0}/{1}/'.format(encode_uid(user), default_token_generator.make_token(user))
+
+
+# Micro-benchmarks: prepare(ctx) returns the callable to time.
+
+def micro_register_serializer(ctx):
+    data = {'email': ctx.unique('register'), 'name': 'Bench', 'password': PASSWORD, 're_password': PASSWORD}
+    return lambda: RegisterSerializer(data=data).is_valid(raise_exception=True)
+
+
+def micro_login_serializer(ctx):
+    data = {'email': ctx.user().email, 'password': PASSWORD}
+    return lambda: LoginSerializer(data=data, context={'request': None}).is_valid(raise_exception=True)
+
+
+def micro_user_serializer(ctx):
+    users = list(CustomUser.objects.order_by('pk')[:ctx.page_size])
+    request = Request(RequestFactory().get('/users/me/'))
+    return lambda: UserSerializer(users, many=True, context={'request': request}).data
+
+
+def micro_user_row_serializer(ctx):
+    rows = list(CustomUser.objects.order_by('pk').values(*UserRowSerializer.VALUES)[:ctx.page_size])
+    request = Request(RequestFactory().get('/users/me/'))
+    return lambda: FastJSONRenderer().render(UserRowSerializer({'request': request}).many(rows))
+
+
+def micro_reset_password_serializer(ctx):
+    user = ctx.user()
+    data = {'password': PASSWORD, 'confirm_password': PASSWORD}
+    return lambda: ResetPasswordSerializer(user, data=data).is_valid(raise_exception=True)
+
+
+def micro_token_make(ctx):
+    user = ctx.user()
+    return lambda: default_token_generator.make_token(user)
+
+
+def micro_token_check(ctx):
+    user = ctx.user()
+    token = default_token_generator.make_token(user)
+    return lambda: default_token_generator.check_token(user, token)
+
+
+def micro_permission(ctx):
+    user = ctx.user()
+    request = Request(RequestFactory().get('/users/me/'))
+    request.user = user
+
+    class View:
+        action = 'me'
+
+    permission = UserAccessPermission()
+    return lambda: permission.has_permission(request, View) and permission.has_object_permission(request, View, user)
+
+
+MICRO_BENCHMARKS = {
+    'register_serializer': micro_register_serializer,
+    'login_serializer': micro_login_serializer,
+    'user_serializer': micro_user_serializer,
+    'user_row_serializer': micro_user_row_serializer,
+    'reset_password_serializer': micro_reset_password_serializer,
+    'token_make': micro_token_make,
+    'token_check': micro_token_check,
+    'permission': micro_permission,
+}
+
+
+# Load routes: prepare(ctx) returns (client, method, path, kwargs) for one
+# request. Only the request itself is timed.
+
+def route_register(ctx):
+    data = {'email': ctx.unique('register'), 'name': 'Bench', 'password': PASSWORD, 're_password': PASSWORD}
+    return APIClient(), 'post', '/users/register/', {'data': data}
+
+
+def route_register_bulk(ctx):
+    records = [{'email': ctx.unique('bulk'), 'password': PASSWORD} for _ in range(10)]
+    return ctx.client(ctx.staff), 'post', '/users/register-bulk/', {'data': records, 'format': 'json'}
+
+
+def route_login(ctx):
+    return APIClient(), 'post', '/users/login/', {'data': {'email': ctx.user().email, 'password': PASSWORD}}
+
+
+def route_update(ctx):
+    user = ctx.user()
+    data = {'email': user.email, 'profile_image': png_upload()}
+    return ctx.client(user), 'patch', '/users/{0}'.format(user.pk), {'data': data}
+
+
+def route_me(ctx):
+    return ctx.client(ctx.user()), 'get', '/users/me/', {}
+
+
+def route_me_staff(ctx):
+    return ctx.client(ctx.staff), 'get', '/users/me/?page_size={0}'.format(ctx.page_size), {}
+
+
+def route_export(ctx):
+    return ctx.client(ctx.staff), 'get', '/users/export/?type=ndjson', {}
+
+
+def route_logout(ctx):
+    return ctx.client(ctx.user()), 'get', '/users/logout/', {}
+
+
+def route_forget_password(ctx):
+    return APIClient(), 'post', '/users/forget-password/', {'data': {'email': ctx.user().email}}
+
+
+def route_reset_password_get(ctx):
+    user = ctx.user()
+    user.has_requested_password_reset = True
+    user.save(update_fields=['has_requested_password_reset'])
+    return APIClient(), 'get', ctx.reset_path(user), {}
+
+
+def route_reset_password_post(ctx):
+    user = ctx.user()
+    data = urlencode({'password': PASSWORD, 'confirm_password': PASSWORD})
+    return APIClient(), 'post', ctx.reset_path(user), {'data': data,
+                                                       'content_type': 'application/x-www-form-urlencoded'}
+
+
+ROUTES = {
+    'register': route_register,
+    'register_bulk': route_register_bulk,
+    'login': route_login,
+    'update': route_update,
+    'me': route_me,
+    'me_staff': route_me_staff,
+    'export': route_export,
+    'logout': route_logout,
+    'forget_password': route_forget_password,
+    'reset_password_get': route_reset_password_get,
+    'reset_password_post': route_reset_password_post,
+}
+
+
+def run_micro(ctx, names=None, iterations=1000, warmup=50):
+    results = {}
+    for name in names or MICRO_BENCHMARKS:
+        func = MICRO_BENCHMARKS[name](ctx)
+        for _ in range(warmup):
+            func()
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+        results[name] = summarize(samples)
+    return results
+
+
+def send(client, method, path, kwargs):
+    response = getattr(client, method)(path, **kwargs)
+    if response.streaming:
+        # Time the whole body, not just the first chunk.
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def run_load(ctx, names=None, requests=200, warmup=10):
+    """
+    Drive each route `requests` times through the full middleware stack.
+    Responses other than 2xx/3xx are counted as errors.
+    """
+    results = {}
+    for name in names or ROUTES:
+        prepare = ROUTES[name]
+        for _ in range(warmup):
+            send(*prepare(ctx))
+        samples, queries, errors = [], [], 0
+        for _ in range(requests):
+            request = prepare(ctx)
+            counter = QueryTimer()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                response = send(*request)
+                samples.append(time.perf_counter() - start)
+            queries.append(counter.count)
+            errors += response.status_code >= 400
+        results[name] = summarize(samples, queries, errors)
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def check_budget(results, budget):
+    """
+    Compare results against a budget mapping dotted metric names (e.g.
+    "load.me.p99_ms") to a maximum, or to {"max": ...} and/or {"min": ...}.
+    Returns a list of violations; budgeted metrics missing from the results
+    count as violations too.
+    """
+    flat = flatten(results)
+    violations = []
+    for key, limits in sorted(budget.items()):
+        if not isinstance(limits, dict):
+            limits = {'max': limits}
+        if key not in flat:
+            violations.append('{0}: not measured'.format(key))
+            continue
+        value = flat[key]
+        if 'max' in limits and value > limits['max']:
+            violations.append('{0}: {1:.3f} is above the budget of {2}'.format(key, value, limits['max']))
+        if 'min' in limits and value < limits['min']:
+            violations.append('{0}: {1:.3f} is below the budget of {2}'.format(key, value, limits['min']))
+    return violations
+
+
+def make_budget(results, headroom=1.5):
+    """
+    Budget allowing `headroom` times the p99 latency and queries per
+    request of `results`, and 1/headroom of their throughput.
+    """
+    budget = {}
+    for section in ('micro', 'load'):
+        for name, summary in results.get(section, {}).items():
+            prefix = '{0}.{1}.'.format(section, name)
+            budget[prefix + 'p99_ms'] = {'max': round(summary['p99_ms'] * headroom, 3)}
+            budget[prefix + 'throughput'] = {'min': round(summary['throughput'] / headroom, 3)}
+            if 'queries_max' in summary:
+                budget[prefix + 'queries_max'] = {'max': summary['queries_max']}
+                budget[prefix + 'errors'] = {'max': 0}
+    return budget
+
+
+def dump(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
@@ -0,0 +1,229 @@
+import codecs
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+
+from .hashing import hashing_executor
+from .models import CustomUser, canonical_email
+from .serializers import BulkRegisterSerializer
+from .sharding import db_for_email, on_shard
+
+FORMATS = ('json', 'jsonl', 'csv')
+
+
+class ImportInterrupted(ValueError):
+    """
+    The input became unreadable after `created` users of earlier chunks were
+    already committed.
+    """
+
+    def __init__(self, error, created, failed):
+        super().__init__(error, created, failed)
+        self.error = error
+        self.created = created
+        self.failed = failed
+
+    def __str__(self):
+        return '{0} (after creating {1} user(s))'.format(self.error, self.created)
+
+
+def guess_format(filename, default='jsonl'):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'ndjson':
+        return 'jsonl'
+    return ext if ext in FORMATS else default
+
+
+def iter_text(stream, encoding='utf-8', chunk_size=64 * 1024):
+    """
+    Decode a binary or text stream chunk by chunk.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk if isinstance(chunk, str) else decoder.decode(chunk)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_lines(stream):
+    buffer = ''
+    for text in iter_text(stream):
+        buffer += text
+        *lines, buffer = buffer.split('\n')
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def read_jsonl(stream):
+    for line in iter_lines(stream):
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    yield from csv.DictReader(iter_lines(stream))
+
+
+def read_json(stream):
+    """
+    Yield the items of a top level JSON array one at a time without
+    loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter_text(stream)
+    buffer = ''
+    started = False
+    while True:
+        buffer = buffer.lstrip()
+        if not buffer:
+            chunk = next(chunks, None)
+            if chunk is None:
+                if started:
+                    raise ValueError('Truncated JSON array')
+                return
+            buffer = chunk
+            continue
+        if not started:
+            if buffer[0] != '[':
+                raise ValueError('Expected a JSON array')
+            buffer, started = buffer[1:], True
+            continue
+        if buffer[0] == ']':
+            return
+        if buffer[0] == ',':
+            buffer = buffer[1:]
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except ValueError:
+            end = None
+        if end is None or end == len(buffer):
+            # The item may continue in the next chunk.
+            chunk = next(chunks, None)
+            if chunk is not None:
+                buffer += chunk
+                continue
+            if end is None:
+                raise ValueError('Malformed or truncated JSON array')
+        yield item
+        buffer = buffer[end:]
+
+
+READERS = {
+    'json': read_json,
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def read_records(stream, fmt):
+    return READERS[fmt](stream)
+
+
+def import_users(records, chunk_size=1000, on_error=None):
+    """
+    Validate, hash and insert user records chunk by chunk. Bad records are
+    passed to `on_error(row, email, errors)` and skipped; the rest of the
+    batch still goes in. Returns (created, failed). Raises ImportInterrupted
+    when reading `records` fails, once the records read before the failure
+    are imported.
+    """
+    records = enumerate(records)
+    created = failed = 0
+    while True:
+        chunk, read_error = [], None
+        try:
+            for record in islice(records, chunk_size):
+                chunk.append(record)
+        except (ValueError, KeyError, csv.Error) as e:
+            read_error = e
+        if chunk:
+            chunk_created, errors = import_chunk(chunk)
+            created += chunk_created
+            failed += len(errors)
+            if on_error is not None:
+                for error in errors:
+                    on_error(*error)
+        if read_error is not None:
+            raise ImportInterrupted(read_error, created, failed) from read_error
+        if not chunk:
+            return created, failed
+
+
+def import_chunk(chunk):
+    errors = []
+    valid = []
+    seen = set()
+    for row, record in chunk:
+        if not isinstance(record, dict):
+            errors.append((row, None, {'non_field_errors': ['Expected an object']}))
+            continue
+        serializer = BulkRegisterSerializer(data=record)
+        if not serializer.is_valid():
+            errors.append((row, record.get('email'), serializer.errors))
+            continue
+        data = serializer.validated_data
+        email = CustomUser.objects.normalize_email(data['email'])
+        if canonical_email(email) in seen:
+            errors.append((row, email, {'email': ['Duplicate email in import']}))
+            continue
+        seen.add(canonical_email(email))
+        valid.append((row, email, data))
+
+    by_shard = defaultdict(list)
+    for email in seen:
+        by_shard[db_for_email(email)].append(email)
+    existing = set()
+    for shard, emails in by_shard.items():
+        existing.update(on_shard(CustomUser.objects, shard).filter(email_canonical__in=emails)
+                        .values_list('email_canonical', flat=True))
+    rows = []
+    for row, email, data in valid:
+        if canonical_email(email) in existing:
+            errors.append((row, email, {'email': ['custom user with this email address already exists.']}))
+        else:
+            rows.append((row, email, data))
+
+    passwords = hashing_executor.map(make_password, [data['password'] for _, _, data in rows])
+    # bulk_create() skips save(), which fills in email_canonical.
+    users = [CustomUser(email=email, email_canonical=canonical_email(email), name=data.get('name', ''),
+                        password=password)
+             for (_, email, data), password in zip(rows, passwords)]
+    shards = defaultdict(list)
+    for user in users:
+        shards[db_for_email(user.email)].append(user)
+    created = 0
+    inserted = set()
+    try:
+        for shard, shard_users in shards.items():
+            with transaction.atomic(using=shard):
+                on_shard(CustomUser.objects, shard).bulk_create(shard_users)
+            created += len(shard_users)
+            inserted.add(shard)
+        return created, errors
+    except IntegrityError:
+        pass
+
+    # Someone registered one of these emails since the existence check;
+    # fall back to row by row inserts so only the clashing records fail.
+    for (row, email, _), user in zip(rows, users):
+        shard = db_for_email(email)
+        if shard in inserted:
+            continue
+        try:
+            with transaction.atomic(using=shard):
+                user.save(force_insert=True)
+            created += 1
+        except IntegrityError:
+            errors.append((row, email, {'email': ['custom user with this email address already exists.']}))
+    return created, errors
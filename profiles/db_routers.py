@@ -0,0 +1,254 @@
+"""
+Read replica routing for users and tokens.
+
+Reads of the routed models go to a healthy replica and writes go to the
+primary ('default'). Two rules keep a client from reading its own writes
+back stale:
+
+* once a request has written, the rest of that request reads from the
+  primary;
+* a user who was written to is pinned to the primary for
+  REPLICA_PIN_SECONDS, shared through the cache so every worker sees it.
+  Authentication checks the pin once it knows who the request is for.
+
+Lookups that miss on a replica (a token or an account created moments
+ago) are retried on the primary by the callers, see `primary_fallback`.
+"""
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+
+from . import metrics, sharding
+
+PRIMARY = 'default'
+
+_state = contextvars.ContextVar('replica_state', default=None)
+
+
+class RequestState:
+    # Mutable, so a flag set in a copied context (a worker thread of an
+    # async view) is still seen by the rest of the request.
+    def __init__(self):
+        self.pinned = False
+
+
+@contextmanager
+def request_scope():
+    """
+    Track writes for one request; see profiles.middleware.
+    """
+    token = _state.set(RequestState())
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def pin_request():
+    state = _state.get()
+    if state is not None:
+        state.pinned = True
+
+
+@contextmanager
+def use_primary():
+    """
+    Send routed reads to the primary inside the block, and for the rest of
+    the request when there is one.
+    """
+    state = _state.get()
+    if state is not None:
+        state.pinned = True
+        yield
+        return
+    token = _state.set(RequestState())
+    pin_request()
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+def _pin_key(user_pk):
+    return 'replica-pin:{0}'.format(user_pk)
+
+
+def pin_user(user_pk):
+    if replicas.aliases and user_pk is not None:
+        cache.set(_pin_key(user_pk), True, getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+
+
+def is_pinned(user_pk):
+    return bool(replicas.aliases) and cache.get(_pin_key(user_pk), False)
+
+
+def read_after_write(user):
+    """
+    Pin the current request to the primary if `user` was written to within
+    REPLICA_PIN_SECONDS. Returns True when `user` itself was read from a
+    replica and should be read again.
+    """
+    if not is_pinned(user.pk):
+        return False
+    pin_request()
+    return user._state.db != PRIMARY
+
+
+def primary_fallback(exceptions, func, *args, **kwargs):
+    """
+    Call `func`, and again against the primary if it raised one of
+    `exceptions` while reading from a replica that may not have caught up.
+    """
+    try:
+        return func(*args, **kwargs)
+    except exceptions:
+        if not replicas.aliases or _reading_primary():
+            raise
+    with use_primary():
+        return func(*args, **kwargs)
+
+
+def _reading_primary():
+    state = _state.get()
+    return state is not None and state.pinned
+
+
+class ReplicaSet:
+    """
+    Replica aliases with a health check per alias, rerun at most every
+    `interval` seconds. Unhealthy replicas are skipped until they pass
+    again; with none healthy, reads fall back to the primary.
+    """
+
+    def __init__(self, aliases, interval=5):
+        self.aliases = list(aliases)
+        self.interval = interval
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(getattr(settings, 'REPLICA_DATABASES', []), getattr(settings, 'REPLICA_HEALTH_INTERVAL', 5))
+
+    def check(self, alias):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError:
+            connections[alias].close()
+            return False
+        return True
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(alias)
+            if checked is not None and now - checked[0] < self.interval:
+                return checked[1]
+        healthy = self.check(alias)
+        with self._lock:
+            self._checked[alias] = (now, healthy)
+        return healthy
+
+    def reset(self):
+        with self._lock:
+            self._checked.clear()
+
+    def choose(self):
+        healthy = [alias for alias in self.aliases if self.is_healthy(alias)]
+        return random.choice(healthy) if healthy else PRIMARY
+
+    def stats(self):
+        with self._lock:
+            return {alias: self._checked.get(alias, (None, True))[1] for alias in self.aliases}
+
+
+replicas = ReplicaSet.from_settings()
+
+
+@metrics.registry.register_collector
+def collect_replica_stats():
+    return [
+        ('profiles_replica_healthy', 'gauge', 'Whether a read replica passed its last health check.',
+         [({'alias': alias}, int(healthy)) for alias, healthy in replicas.stats().items()]),
+    ]
+
+
+class ReplicaRouter:
+    """
+    Routes REPLICA_MODELS ('app_label.ModelName') between the primary and
+    the replicas; other models are left to Django.
+    """
+
+    def __init__(self):
+        self.models = {label.lower() for label in getattr(settings, 'REPLICA_MODELS', [])}
+
+    def routed(self, model):
+        return model._meta.label_lower in self.models
+
+    def db_for_read(self, model, **hints):
+        if not self.routed(model) or not replicas.aliases:
+            return None
+        if _reading_primary():
+            return PRIMARY
+        return replicas.choose()
+
+    def db_for_write(self, model, **hints):
+        if not self.routed(model):
+            return None
+        pin_request()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *replicas.aliases}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ShardRouter:
+    """
+    Keeps users and what hangs off them on their shard when sharding is on
+    (see profiles.sharding): a new user goes to the shard of its email, and
+    any other instance to the shard of the instance it was read from or
+    relates to. Queries without an instance to go by name their shard with
+    .using(). Reads on 'default' are left to ReplicaRouter.
+    """
+
+    def shard(self, instance):
+        from django.contrib.auth import get_user_model
+
+        if instance._state.db:
+            return sharding.shard_of(instance)
+        if isinstance(instance, get_user_model()):
+            return sharding.shard_for_email(instance.email)
+        for field in instance._meta.concrete_fields:
+            related = field.is_relation and field.get_cached_value(instance, None)
+            if related and related._state.db:
+                return sharding.shard_of(related)
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not sharding.enabled() or hints.get('instance') is None:
+            return None
+        shard = self.shard(hints['instance'])
+        return None if shard == PRIMARY else shard
+
+    def db_for_write(self, model, **hints):
+        if not sharding.enabled() or hints.get('instance') is None:
+            return None
+        shard = self.shard(hints['instance'])
+        if shard is not None:
+            pin_request()
+        return shard
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not sharding.enabled() or not (obj1._state.db and obj2._state.db):
+            return None
+        return sharding.shard_of(obj1) == sharding.shard_of(obj2)
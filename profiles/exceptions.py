@@ -0,0 +1,29 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class HashingUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Too many password operations in progress, try again shortly.')
+    default_code = 'hashing_unavailable'
+    # Picked up by DRF's exception handler as a Retry-After header.
+    wait = 1
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = _('Uploaded file is too large.')
+    default_code = 'upload_too_large'
+
+
+class UnsupportedImageType(APIException):
+    status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    default_detail = _('Only JPEG and PNG images are supported.')
+    default_code = 'unsupported_image_type'
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = _('The user was changed since the version given in If-Match.')
+    default_code = 'precondition_failed'
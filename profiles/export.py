@@ -0,0 +1,51 @@
+import csv
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .serializers import UserRowSerializer
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'USER_EXPORT_CHUNK_SIZE', 2000)
+CSV_FIELDS = ['id', 'email', 'profile_image', 'date_joined']
+
+
+class Echo:
+    """
+    File-like object for csv.writer that hands each row straight back
+    instead of buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_rows(queryset, request, chunk_size=EXPORT_CHUNK_SIZE):
+    serializer = UserRowSerializer(context={'request': request})
+    for row in queryset.order_by('id').values(*UserRowSerializer.VALUES).iterator(chunk_size=chunk_size):
+        yield serializer.to_representation(row)
+
+
+def iter_ndjson(queryset, request):
+    for row in iter_rows(queryset, request):
+        yield json.dumps(row) + '\n'
+
+
+def iter_csv(queryset, request):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for row in iter_rows(queryset, request):
+        yield writer.writerow([row[field] for field in CSV_FIELDS])
+
+
+EXPORTERS = {
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'csv': (iter_csv, 'text/csv'),
+}
+
+
+def export_response(queryset, request, export_type):
+    stream, content_type = EXPORTERS[export_type]
+    response = StreamingHttpResponse(stream(queryset, request), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="users.{0}"'.format(export_type)
+    return response
@@ -0,0 +1,275 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from . import metrics
+from .exceptions import HashingUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def _timed(submitted, func, *args):
+    # Runs in the worker; only durations cross back. time.monotonic() is
+    # system wide, so the queue wait is measured right in process pools too.
+    queue_wait = time.monotonic() - submitted
+    start = time.perf_counter()
+    result = func(*args)
+    return result, queue_wait, time.perf_counter() - start
+
+
+def _init_worker():
+    # A forked worker inherits a set up Django. Setting it up again would
+    # reconfigure logging, which flushes streams whose locks another thread
+    # may have held at the fork.
+    if not apps.ready:
+        django.setup()
+
+
+def must_update(encoded):
+    """
+    Same rule check_password() applies before calling its setter: the hash
+    was made by a non-default hasher or with outdated parameters.
+    """
+    preferred = hashers.get_hasher('default')
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+@functools.lru_cache()
+def load_calibration(path):
+    """
+    The result `manage.py calibrate_hasher` wrote to `path`, or None.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def calibrated_iterations():
+    """
+    PBKDF2 iterations from PASSWORD_HASH_ITERATIONS, else from the
+    calibration file, else Django's default.
+    """
+    iterations = getattr(settings, 'PASSWORD_HASH_ITERATIONS', 0)
+    if iterations:
+        return iterations
+    path = getattr(settings, 'PASSWORD_HASH_CALIBRATION_FILE', None)
+    calibration = load_calibration(path) if path else None
+    if calibration and calibration.get('algorithm') == CalibratedPBKDF2PasswordHasher.algorithm:
+        return calibration['iterations']
+    return hashers.PBKDF2PasswordHasher.iterations
+
+
+class CalibratedPBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with the iteration count picked for this hardware (see
+    `calibrated_iterations`). Hashes keep Django's format, so existing ones
+    still verify and get upgraded on the next login.
+    """
+
+    @property
+    def iterations(self):
+        return calibrated_iterations()
+
+
+class HashingExecutor:
+    """
+    Runs password hashing off the request thread.
+
+    `mode` is 'thread' (hashlib's PBKDF2 releases the GIL), 'process' or
+    'inline'. At most `max_pending` jobs may be queued or running; callers
+    beyond that get HashingUnavailable (a 503) straight away instead of
+    waiting behind the backlog.
+
+    Process workers are forked with the database connections open at the
+    time, so jobs only hash; anything writing the result back runs in this
+    process (see `run_later`).
+    """
+
+    def __init__(self, mode='thread', workers=None, max_pending=64, timeout=10):
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            mode=getattr(settings, 'HASHING_EXECUTOR', 'thread'),
+            workers=getattr(settings, 'HASHING_WORKERS', None),
+            max_pending=getattr(settings, 'HASHING_MAX_PENDING', 64),
+            timeout=getattr(settings, 'HASHING_TIMEOUT', 10),
+        )
+
+    def _reset_stats(self):
+        self.completed = 0
+        self.rejected = 0
+        self.pending = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    if self.mode == 'process':
+                        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+                    else:
+                        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hashing')
+        return self._pool
+
+    def _record(self, func, queue_wait, hash_time):
+        if metrics.enabled:
+            metrics.PASSWORD_HASH_TIME.observe(hash_time, operation=func.__name__)
+            metrics.PASSWORD_HASH_QUEUE_WAIT.observe(queue_wait, operation=func.__name__)
+        with self._stats_lock:
+            self.completed += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+            self.hash_time_total += hash_time
+            self.hash_time_max = max(self.hash_time_max, hash_time)
+
+    def _release(self, future=None):
+        with self._stats_lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def submit(self, func, *args, block=False):
+        """
+        Queue `func(*args)` and return its future, which resolves to
+        (result, queue_wait, hash_time).
+        """
+        if not self._slots.acquire(blocking=block):
+            with self._stats_lock:
+                self.rejected += 1
+            raise HashingUnavailable()
+        with self._stats_lock:
+            self.pending += 1
+        try:
+            future = self._get_pool().submit(_timed, time.monotonic(), func, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def result(self, func, future):
+        try:
+            result, queue_wait, hash_time = future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingUnavailable()
+        self._record(func, queue_wait, hash_time)
+        return result
+
+    def run(self, func, *args):
+        if self.mode == 'inline':
+            result, queue_wait, hash_time = _timed(time.monotonic(), func, *args)
+            self._record(func, queue_wait, hash_time)
+            return result
+        return self.result(func, self.submit(func, *args))
+
+    def run_later(self, func, *args, callback=None):
+        """
+        Run `func(*args)` without waiting for it, then `callback(result)` in
+        this process, on a pool thread. Errors are logged. Returns False
+        when the queue is full and the job was dropped.
+        """
+        if self.mode == 'inline':
+            try:
+                result = self.run(func, *args)
+                if callback is not None:
+                    callback(result)
+            except Exception:
+                logger.exception('Background password job %s failed', func.__name__)
+            return True
+        try:
+            future = self.submit(func, *args)
+        except HashingUnavailable:
+            return False
+
+        def done(future):
+            if future.exception() is not None:
+                logger.error('Background password job %s failed', func.__name__, exc_info=future.exception())
+                return
+            result, queue_wait, hash_time = future.result()
+            self._record(func, queue_wait, hash_time)
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    logger.exception('Background password job %s failed', func.__name__)
+        future.add_done_callback(done)
+        return True
+
+    def map(self, func, iterable):
+        """
+        Run `func` over every item in parallel, waiting for free slots
+        rather than failing fast. Meant for batch jobs, not requests.
+        """
+        if self.mode == 'inline':
+            return [self.run(func, item) for item in iterable]
+        jobs = [self.submit(func, item, block=True) for item in iterable]
+        return [self.result(func, job) for job in jobs]
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def make_password(self, password):
+        return self.run(hashers.make_password, password)
+
+    def check_password(self, password, encoded):
+        return self.run(hashers.check_password, password, encoded)
+
+    def stats(self):
+        with self._stats_lock:
+            completed = self.completed or 1
+            return {
+                'mode': self.mode,
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'queue_wait_avg': self.queue_wait_total / completed,
+                'queue_wait_max': self.queue_wait_max,
+                'hash_time_avg': self.hash_time_total / completed,
+                'hash_time_max': self.hash_time_max,
+            }
+
+
+hashing_executor = HashingExecutor.from_settings()
+
+
+@metrics.registry.register_collector
+def collect_hashing_stats():
+    stats = hashing_executor.stats()
+    return [
+        ('profiles_password_hash_pending', 'gauge', 'Password jobs queued or running.',
+         [({}, stats['pending'])]),
+        ('profiles_password_hash_rejected_total', 'counter', 'Password jobs refused because the queue was full.',
+         [({}, stats['rejected'])]),
+    ]
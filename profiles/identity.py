@@ -0,0 +1,53 @@
+"""
+Request-scoped identity map of users.
+
+Users read from the database while handling a request are remembered by
+primary key, so looking the same user up again later in that request (the
+authenticated user in get_object or the `me` listing) reuses the instance
+instead of querying the row again. Outside a request scope (see
+profiles.middleware.IdentityMapMiddleware) nothing is remembered.
+
+Only fresh reads go in: users restored from the token cache may be up to
+TOKEN_CACHE_TTL old, which would make version-checked writes fail.
+"""
+import contextvars
+from contextlib import contextmanager
+
+_map = contextvars.ContextVar('user_identity_map', default=None)
+
+
+@contextmanager
+def request_scope():
+    # A dict, so users remembered on a worker thread of an async view (a
+    # copied context) are seen by the rest of the request.
+    token = _map.set({})
+    try:
+        yield
+    finally:
+        _map.reset(token)
+
+
+def remember(user):
+    users = _map.get()
+    if users is not None and user is not None and user.pk is not None:
+        users[user.pk] = user
+    return user
+
+
+def get(pk):
+    users = _map.get()
+    if users is None:
+        return None
+    try:
+        return users.get(int(pk))
+    except (TypeError, ValueError):
+        return None
+
+
+def forget(pk, unless=None):
+    """
+    Drop user `pk`, unless the remembered instance is `unless`.
+    """
+    users = _map.get()
+    if users is not None and users.get(pk) is not unless:
+        users.pop(pk, None)
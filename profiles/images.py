@@ -0,0 +1,172 @@
+import glob
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+VARIANT_SIZES = tuple(getattr(settings, 'PROFILE_IMAGE_VARIANT_SIZES', (64, 128, 256)))
+VARIANT_FORMATS = ('webp', 'original')
+VARIANT_DIR = 'variants'
+CACHE_MAX_BYTES = getattr(settings, 'PROFILE_IMAGE_VARIANT_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+EVICT_INTERVAL = getattr(settings, 'PROFILE_IMAGE_VARIANT_EVICT_INTERVAL', 300)
+
+# <dir>/variants/<size>/<original filename>[.webp]
+VARIANT_PATH_RE = re.compile(
+    r'^(?P<dir>(?:.+/)?){0}/(?P<size>\d+)/(?P<name>[^/]+?)(?P<webp>\.webp)?$'.format(VARIANT_DIR)
+)
+# Where variants directories can be, next to originals stored as <id>/<filename>
+# (before rehome_media), <ab>/<cd>/<id>/<filename> or cas/<ab>/<cd>/<sha><ext>.
+VARIANT_DIR_PATTERNS = (os.path.join('*', VARIANT_DIR), os.path.join('*', '*', '*', VARIANT_DIR))
+
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PROFILE_IMAGE_WORKERS', 2),
+                               thread_name_prefix='image-variants')
+_last_eviction = 0.0
+_eviction_lock = threading.Lock()
+
+
+def variant_name(name, size, fmt):
+    """
+    Storage name of a variant, kept next to the original:
+    `<dir>/variants/<size>/<filename>` plus `.webp` for the WebP copy.
+    """
+    directory, filename = posixpath.split(name)
+    if fmt == 'webp':
+        filename += '.webp'
+    return posixpath.join(directory, VARIANT_DIR, str(size), filename)
+
+
+def parse_variant_name(name):
+    """
+    Inverse of variant_name(): (original name, size, fmt), or None if `name`
+    is not a variant of a size we generate.
+    """
+    match = VARIANT_PATH_RE.match(name)
+    if match is None or int(match.group('size')) not in VARIANT_SIZES:
+        return None
+    original = match.group('dir') + match.group('name')
+    return original, int(match.group('size')), 'webp' if match.group('webp') else 'original'
+
+
+def generate_variant(name, size, fmt, storage=default_storage):
+    target = variant_name(name, size, fmt)
+    if storage.exists(target):
+        return target
+    with storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        original_format = image.format or 'PNG'
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    image_format = 'WEBP' if fmt == 'webp' else original_format
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, quality=85)
+    saved = storage.save(target, ContentFile(buffer.getvalue()))
+    if saved != target:
+        # Another worker won the race; keep its copy.
+        storage.delete(saved)
+    return target
+
+
+def generate_variants(name, storage=default_storage):
+    for size in VARIANT_SIZES:
+        for fmt in VARIANT_FORMATS:
+            generate_variant(name, size, fmt, storage=storage)
+    maybe_evict()
+
+
+def _run(name):
+    try:
+        generate_variants(name)
+    except Exception:
+        logger.exception('Could not generate variants for %s', name)
+
+
+def schedule_variants(name):
+    """
+    Generate every variant of `name` on the background worker pool.
+    """
+    if name:
+        _executor.submit(_run, name)
+
+
+def variant_urls(name, build_url, url=None):
+    if not name:
+        return None
+    url = url or default_storage.url
+    return {
+        str(size): {fmt: build_url(url(variant_name(name, size, fmt))) for fmt in VARIANT_FORMATS}
+        for size in VARIANT_SIZES
+    }
+
+
+def evict_variants(max_bytes=CACHE_MAX_BYTES, root=None):
+    """
+    Delete the least recently used variants until all of them together fit
+    in `max_bytes`. Variants are regenerated on demand, so this is safe.
+    Only the variants directories are walked, never the originals.
+    """
+    root = root or settings.MEDIA_ROOT
+    files = []
+    total = 0
+    for pattern in VARIANT_DIR_PATTERNS:
+        for variant_dir in glob.glob(os.path.join(glob.escape(root), pattern)):
+            for directory, dirnames, filenames in os.walk(variant_dir):
+                for filename in filenames:
+                    path = os.path.join(directory, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+                    total += stat.st_size
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def _evict():
+    try:
+        evict_variants()
+    except Exception:
+        logger.exception('Could not evict profile image variants')
+
+
+def maybe_evict():
+    """
+    Run evict_variants() on the background worker pool, at most once per
+    EVICT_INTERVAL. Returns its future, or None when it is not due.
+    """
+    global _last_eviction
+    with _eviction_lock:
+        if time.monotonic() - _last_eviction < EVICT_INTERVAL:
+            return None
+        _last_eviction = time.monotonic()
+    return _executor.submit(_evict)
+
+
+def touch(path):
+    # Mark a variant as recently used for eviction, even on noatime mounts.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
@@ -0,0 +1,98 @@
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+# LogRecord attributes that are not user supplied `extra` fields.
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'request_id'}
+
+
+class RequestIDFilter(logging.Filter):
+    """
+    Stamps records with the id of the request being handled. Attached to
+    the handler, so it runs on the thread that logged, before the record is
+    queued, where the request's context is still current.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through a `rate` fraction of records below WARNING; warnings and
+    errors always pass.
+    """
+
+    def __init__(self, rate=1.0, name=''):
+        super().__init__(name)
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to a bounded in-memory queue drained by a background
+    thread that does the formatting and the actual write. When the queue is
+    full the record is dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream or sys.stdout)
+        self.target.setFormatter(JSONFormatter())
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        # Flush whatever is queued and join the writer thread; safe to call twice.
+        if self.listener._thread is not None:
+            self.queue.put(self.listener._sentinel)
+            self.listener._thread.join()
+            self.listener._thread = None
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread.
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Resolve the message now, while the arguments still hold the values
+        # they had at the call site; formatting is left to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
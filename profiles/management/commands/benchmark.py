@@ -0,0 +1,104 @@
+import json
+import logging
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+
+from profiles import benchmarks
+from profiles.authentication import token_cache
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+class Command(BaseCommand):
+    help = ('Run the serializer micro-benchmarks and drive every users route in process against a freshly '
+            'created and seeded test database (in-memory SQLite by default). Application logging below '
+            'WARNING is silenced while the benchmarks run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Number of users to seed.')
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per route.')
+        parser.add_argument('--iterations', type=int, default=1000, help='Timed calls per micro-benchmark.')
+        parser.add_argument('--warmup', type=int, default=10,
+                            help='Untimed requests (and 5x as many micro-benchmark calls) run first.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for picking users, for repeatable runs.')
+        parser.add_argument('--page-size', type=int, default=50, help='Users per page for the staff listing.')
+        parser.add_argument('--only', choices=['micro', 'load'], help='Run only one of the two suites.')
+        parser.add_argument('--micro', nargs='+', choices=sorted(benchmarks.MICRO_BENCHMARKS),
+                            help='Micro-benchmarks to run. All of them by default.')
+        parser.add_argument('--routes', nargs='+', choices=sorted(benchmarks.ROUTES),
+                            help='Routes to drive. All of them by default.')
+        parser.add_argument('--fast-hashing', action='store_true',
+                            help='Hash passwords with MD5 so hashing does not dominate the timings.')
+        parser.add_argument('--output', help='Write the results as JSON to this file instead of stdout.')
+        parser.add_argument('--budget', help='JSON budget file; the run fails if any metric is outside it.')
+        parser.add_argument('--write-budget', help='Write a budget derived from this run to this file.')
+        parser.add_argument('--headroom', type=float, default=1.5,
+                            help='Slack allowed by --write-budget over the measured values.')
+
+    def handle(self, *args, **options):
+        media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+        overrides = dict(benchmarks.SETTINGS_OVERRIDES, MEDIA_ROOT=media_root)
+        if options['fast_hashing']:
+            overrides['PASSWORD_HASHERS'] = FAST_HASHERS
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        logging.disable(logging.INFO)
+        try:
+            with override_settings(**overrides):
+                token_cache.clear()
+                results = self.run(options)
+        finally:
+            logging.disable(logging.NOTSET)
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        if options['output']:
+            benchmarks.dump(results, options['output'])
+            self.report(results)
+        else:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if options['write_budget']:
+            benchmarks.dump(benchmarks.make_budget(results, options['headroom']), options['write_budget'])
+
+        if options['budget']:
+            with open(options['budget']) as f:
+                violations = benchmarks.check_budget(results, json.load(f))
+            if violations:
+                raise CommandError('Benchmark budget exceeded:\n  ' + '\n  '.join(violations))
+            self.stderr.write(self.style.SUCCESS('All metrics within budget'))
+
+    def run(self, options):
+        results = {'environment': benchmarks.environment(), 'parameters': {
+            'users': options['users'],
+            'requests': options['requests'],
+            'iterations': options['iterations'],
+            'seed': options['seed'],
+            'page_size': options['page_size'],
+            'fast_hashing': options['fast_hashing'],
+        }}
+        self.stderr.write('Seeding {0} users'.format(options['users']))
+        benchmarks.seed_users(options['users'])
+        ctx = benchmarks.Context(seed=options['seed'], page_size=options['page_size'])
+        if options['only'] != 'load':
+            results['micro'] = benchmarks.run_micro(ctx, options['micro'], options['iterations'],
+                                                    options['warmup'] * 5)
+        if options['only'] != 'micro':
+            results['load'] = benchmarks.run_load(ctx, options['routes'], options['requests'], options['warmup'])
+        return results
+
+    def report(self, results):
+        line = '{0:<32} {1:>8} {2:>12} {3:>10} {4:>10} {5:>8}'
+        self.stdout.write(line.format('benchmark', 'count', 'per second', 'p50 ms', 'p99 ms', 'queries'))
+        for section in ('micro', 'load'):
+            for name, summary in results.get(section, {}).items():
+                self.stdout.write(line.format(
+                    '{0}.{1}'.format(section, name), summary['count'], '{0:.1f}'.format(summary['throughput']),
+                    '{0:.3f}'.format(summary['p50_ms']), '{0:.3f}'.format(summary['p99_ms']),
+                    '{0:.1f}'.format(summary['queries_per_request']) if 'queries_per_request' in summary else '-'))
@@ -0,0 +1,84 @@
+import json
+import os
+import platform
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+
+from profiles.hashing import CalibratedPBKDF2PasswordHasher, load_calibration
+
+PROBE_ITERATIONS = 20000
+
+
+class Command(BaseCommand):
+    help = ('Measure PBKDF2 throughput on this machine and write the iteration count that makes one password '
+            'hash take --target-ms to PASSWORD_HASH_CALIBRATION_FILE, where '
+            'profiles.hashing.CalibratedPBKDF2PasswordHasher picks it up. Existing hashes are upgraded as their '
+            'users log in.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=250.0,
+                            help='Time one hash should take, on one core.')
+        parser.add_argument('--min-iterations', type=int, default=100000,
+                            help='Never go below this many iterations, however slow the machine.')
+        parser.add_argument('--samples', type=int, default=5, help='Timed probe hashes.')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'HASHING_WORKERS', None) or 1,
+                            help='Concurrent hashes for the throughput check.')
+        parser.add_argument('--output', default=getattr(settings, 'PASSWORD_HASH_CALIBRATION_FILE', None))
+        parser.add_argument('--dry-run', action='store_true', help='Print the result without writing it.')
+
+    def handle(self, *args, **options):
+        if options['target_ms'] <= 0 or options['samples'] < 1 or options['workers'] < 1:
+            raise CommandError('--target-ms, --samples and --workers must be positive')
+        hasher = CalibratedPBKDF2PasswordHasher()
+        password, salt = get_random_string(16), hasher.salt()
+
+        def hash_time(iterations):
+            start = time.perf_counter()
+            hasher.encode(password, salt, iterations)
+            return time.perf_counter() - start
+
+        hash_time(PROBE_ITERATIONS)
+        per_iteration = statistics.median(hash_time(PROBE_ITERATIONS) for _ in range(options['samples'])) / \
+            PROBE_ITERATIONS
+        iterations = int(options['target_ms'] / 1000 / per_iteration) // 1000 * 1000
+        if iterations < options['min_iterations']:
+            self.stderr.write('{0} iterations would meet the target, using the minimum of {1}'.format(
+                iterations, options['min_iterations']))
+            iterations = options['min_iterations']
+
+        # hashlib's PBKDF2 releases the GIL, so threads measure what the
+        # hashing executor can do.
+        jobs = options['workers'] * 2
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            start = time.perf_counter()
+            latencies = list(pool.map(hash_time, [iterations] * jobs))
+            elapsed = time.perf_counter() - start
+
+        result = {
+            'algorithm': hasher.algorithm,
+            'iterations': iterations,
+            'target_ms': options['target_ms'],
+            'hash_ms': statistics.median(latencies) * 1000,
+            'throughput': jobs / elapsed,
+            'workers': options['workers'],
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        self.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+        if options['dry_run']:
+            return
+        if not options['output']:
+            raise CommandError('No PASSWORD_HASH_CALIBRATION_FILE, pass --output')
+        with open(options['output'], 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+        load_calibration.cache_clear()
+        self.stdout.write(self.style.SUCCESS('Wrote {0}; restart the workers to use {1} iterations'.format(
+            options['output'], iterations)))
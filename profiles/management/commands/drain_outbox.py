@@ -0,0 +1,46 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection as db_connection
+
+from profiles import outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbox emails using a pool of worker threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'OUTBOX_WORKERS', 4),
+                            help='Number of worker threads, each with its own SMTP connection.')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE,
+                            help='Messages claimed per batch.')
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the outbox has been drained instead of polling forever.')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        if workers == 1:
+            sent = self.worker(options)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox') as pool:
+                sent = sum(pool.map(lambda _: self.worker(options, close_db=True), range(workers)))
+        self.stdout.write(self.style.SUCCESS('Sent {0} message(s)'.format(sent)))
+
+    def worker(self, options, close_db=False):
+        sent = 0
+        try:
+            while True:
+                try:
+                    sent += outbox.drain(batch_size=options['batch_size'])
+                except Exception as e:
+                    self.stderr.write('Outbox worker error: {0!r}'.format(e))
+                if options['once']:
+                    return sent
+                time.sleep(options['poll_interval'])
+        finally:
+            if close_db:
+                db_connection.close()
@@ -0,0 +1,31 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from profiles import schema
+
+
+class Command(BaseCommand):
+    help = ('Write the OpenAPI schema of the users API to a versioned artifact in OPENAPI_SCHEMA_DIR, served by '
+            '/swagger/?format=openapi. Run it at build time so servers never introspect the API themselves.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=schema.SCHEMA_DIR)
+        parser.add_argument('--check', action='store_true',
+                            help='Only exit with an error when the artifact for the current code is missing.')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Keep artifacts generated from older versions of the code.')
+
+    def handle(self, *args, **options):
+        path = schema.artifact_path(directory=options['output_dir'])
+        if options['check']:
+            if not os.path.exists(path):
+                raise CommandError('The schema artifact {0} is missing or stale, run generate_schema'.format(path))
+            self.stdout.write('{0} is up to date'.format(path))
+            return
+        schema.write(schema.generate(), path)
+        self.stdout.write(self.style.SUCCESS('Wrote {0}'.format(path)))
+        if not options['keep_old']:
+            for old in schema.stale_artifacts(options['output_dir']):
+                os.remove(old)
+                self.stdout.write('Removed {0}'.format(old))
@@ -0,0 +1,41 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from profiles.bulk import FORMATS, guess_format, import_users, read_records
+
+
+class Command(BaseCommand):
+    help = 'Stream users from a json, jsonl or csv file into the database in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for stdin.")
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Input format. Guessed from the file extension when omitted.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Records validated, hashed and inserted per chunk.')
+        parser.add_argument('--errors', help='Write rejected records as JSON lines to this file '
+                                             'instead of stderr.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        errors = open(options['errors'], 'w') if options['errors'] else self.stderr
+
+        def on_error(row, email, error):
+            errors.write(json.dumps({'row': row, 'email': email, 'errors': error}) + '\n')
+
+        try:
+            created, failed = import_users(read_records(stream, fmt), chunk_size=options['chunk_size'],
+                                           on_error=on_error)
+        except (ValueError, KeyError, csv.Error) as e:
+            raise CommandError('Could not read {0}: {1}'.format(path, e))
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+            if errors is not self.stderr:
+                errors.close()
+        self.stdout.write(self.style.SUCCESS('Created {0} user(s), rejected {1}'.format(created, failed)))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from profiles import sharding
+from profiles.models import AuthToken
+
+
+class Command(BaseCommand):
+    help = ('Delete expired API tokens. Keys are picked off the expires_at index a batch at a time and each batch '
+            'is deleted in its own short transaction, so the table is never locked for long.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load on the database.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the expired tokens.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        purged = 0
+        for shard in sharding.SHARDS if sharding.enabled() else [None]:
+            tokens = sharding.on_shard(AuthToken.objects, shard).filter(expires_at__lte=now)
+            if options['dry_run']:
+                purged += tokens.count()
+                continue
+            while True:
+                keys = list(tokens.order_by('expires_at').values_list('key', flat=True)[:options['batch_size']])
+                if not keys:
+                    break
+                with transaction.atomic(using=shard):
+                    deleted, _ = tokens.filter(key__in=keys).delete()
+                purged += deleted
+                self.stdout.write('Purged {0} expired token(s)'.format(purged))
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS('Done: {0} expired token(s) {1}'.format(
+            purged, 'found' if options['dry_run'] else 'purged')))
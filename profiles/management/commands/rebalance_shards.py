@@ -0,0 +1,69 @@
+import time
+
+from django.contrib.auth.models import Group, Permission
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from profiles import sharding
+from profiles.authentication import token_cache
+from profiles.models import AuthToken, CustomUser
+
+
+class Command(BaseCommand):
+    help = ('Move users whose email now hashes to another shard (after adding shards to USER_SHARDS) together '
+            'with their tokens, groups and permissions. Each user is copied before it is deleted from its old '
+            'shard, so an interrupted run can simply be started again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load on the shards.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            self.stdout.write('Sharding is not enabled, nothing to do')
+            return
+        moved = 0
+        for source in sharding.SHARDS:
+            last_pk = 0
+            while True:
+                batch = list(CustomUser.objects.using(source).filter(pk__gt=last_pk)
+                             .order_by('pk')[:options['batch_size']])
+                if not batch:
+                    break
+                for user in batch:
+                    target = sharding.shard_for_email(user.email)
+                    if target == source:
+                        continue
+                    if options['dry_run']:
+                        self.stdout.write('User {0}: {1} -> {2}'.format(user.pk, source, target))
+                    else:
+                        self.move(user, source, target)
+                    moved += 1
+                last_pk = batch[-1].pk
+                self.stdout.write('{0}: processed up to user {1}, {2} moved'.format(source, last_pk, moved))
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS('Done: {0} moved'.format(moved)))
+
+    def move(self, user, source, target):
+        tokens = list(AuthToken.objects.using(source).filter(user_id=user.pk))
+        groups = list(user.groups.values_list('name', flat=True))
+        permissions = list(user.user_permissions.values_list('content_type__app_label', 'codename'))
+
+        with transaction.atomic(using=target):
+            # Updates the copy left by an interrupted run, inserts otherwise.
+            user.save(using=target)
+            AuthToken.objects.using(target).filter(user_id=user.pk).exclude(key__in=[t.key for t in tokens]).delete()
+            AuthToken.objects.using(target).bulk_create(tokens, ignore_conflicts=True)
+            user.groups.set(Group.objects.using(target).filter(name__in=groups))
+            matching = Q(pk__in=[])
+            for app_label, codename in permissions:
+                matching |= Q(content_type__app_label=app_label, codename=codename)
+            user.user_permissions.set(Permission.objects.using(target).filter(matching))
+
+        with transaction.atomic(using=source):
+            CustomUser.objects.using(source).filter(pk=user.pk).delete()
+        token_cache.invalidate_user(user.pk)
@@ -0,0 +1,129 @@
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.utils import timezone
+
+from profiles.authentication import token_cache
+from profiles import sharding
+from profiles.db_routers import pin_user
+from profiles.images import VARIANT_FORMATS, VARIANT_SIZES, variant_name
+from profiles.mecache import me_cache
+from profiles.models import CustomUser, content_address, user_directory_path
+from profiles.storage import CONTENT_ADDRESSED_PREFIX
+
+
+def link_or_copy(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class Command(BaseCommand):
+    help = ('Move profile images into the sharded media layout in resumable batches. '
+            'Rows are switched one at a time, so old and new paths both work until each row moves.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit I/O pressure.')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.MEDIA_ROOT, '.rehome_media.checkpoint'),
+                            help='File recording the last processed user id.')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over.')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Leave the old files in place, e.g. while cached URLs still point at them.')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        last_pk = 0 if options['restart'] else self.read_checkpoint(options['checkpoint'])
+        moved = skipped = 0
+        while True:
+            batch = self.next_batch(last_pk, options['batch_size'])
+            if not batch:
+                break
+            for pk, name, shard in batch:
+                if self.rehome(pk, name, shard, options):
+                    moved += 1
+                else:
+                    skipped += 1
+            last_pk = batch[-1][0]
+            if not options['dry_run']:
+                self.write_checkpoint(options['checkpoint'], last_pk)
+            self.stdout.write('Processed up to user {0}: {1} moved, {2} skipped'.format(last_pk, moved, skipped))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS('Done: {0} moved, {1} skipped'.format(moved, skipped)))
+
+    def next_batch(self, last_pk, size):
+        # The next `size` users by id across all shards, as (pk, name, shard).
+        batch = []
+        for shard in sharding.SHARDS if sharding.enabled() else [None]:
+            users = sharding.on_shard(CustomUser.objects, shard).filter(pk__gt=last_pk).exclude(profile_image='') \
+                .exclude(profile_image__isnull=True).order_by('pk').values_list('pk', 'profile_image')[:size]
+            batch.extend((pk, name, shard) for pk, name in users)
+        return sorted(batch)[:size]
+
+    def target_name(self, user, name):
+        if getattr(settings, 'PROFILE_IMAGE_DEDUPE', False):
+            with default_storage.open(name, 'rb') as f:
+                return content_address(f, name)
+        return user_directory_path(user, os.path.basename(name))
+
+    def rehome(self, pk, name, shard, options):
+        if not default_storage.exists(name):
+            self.stderr.write('User {0}: {1} is missing, skipping'.format(pk, name))
+            return False
+        target = self.target_name(CustomUser(pk=pk), name)
+        if target == name:
+            return False
+        if options['dry_run']:
+            self.stdout.write('User {0}: {1} -> {2}'.format(pk, name, target))
+            return True
+
+        source_path = default_storage.path(name)
+        deduped = target.startswith(CONTENT_ADDRESSED_PREFIX)
+        if default_storage.exists(target) and not deduped and \
+                os.path.getsize(default_storage.path(target)) != os.path.getsize(source_path):
+            # Something else lives there; a same-sized file is our own copy
+            # from an interrupted run.
+            target = default_storage.get_available_name(target)
+        if not default_storage.exists(target):
+            link_or_copy(source_path, default_storage.path(target))
+
+        # Only switch rows that still point at the old file, so an upload that
+        # raced us wins.
+        switched = sharding.on_shard(CustomUser.objects, shard).filter(pk=pk, profile_image=name).update(
+            profile_image=target, updated_at=timezone.now(), version=F('version') + 1)
+        if not switched:
+            if not deduped:
+                default_storage.delete(target)
+            return False
+        token_cache.invalidate_user(pk)
+        me_cache.invalidate(pk)
+        pin_user(pk)
+        if not options['keep_old']:
+            default_storage.delete(name)
+            for size in VARIANT_SIZES:
+                for fmt in VARIANT_FORMATS:
+                    default_storage.delete(variant_name(name, size, fmt))
+        return True
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_checkpoint(self, path, pk):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(pk))
+        os.replace(tmp_path, path)
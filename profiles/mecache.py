@@ -0,0 +1,90 @@
+"""
+Cache of the serialized `me` payload of non-staff users, in the Django cache
+named by ME_CACHE_ALIAS. Entries are keyed by user id and a version derived
+from the serializer, so a deploy changing UserSerializer never reads an old
+entry. Saving or deleting a user, rehoming its profile image and deleting
+one of its tokens drop the entry (see profiles.signals).
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+from .serializers import UserSerializer
+
+# Bump when the shape of a cached entry changes.
+ENTRY_VERSION = 1
+
+
+class MeCache:
+    def __init__(self, alias, timeout, fields):
+        self.alias = alias
+        self.timeout = timeout
+        self.version = hashlib.md5('{0}|{1}'.format(ENTRY_VERSION, ','.join(fields)).encode()).hexdigest()[:8]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, user_pk):
+        return 'me:{0}:{1}'.format(self.version, user_pk)
+
+    def get(self, user_pk, base_url):
+        """
+        The entry stored for `user_pk`, or None. Entries hold absolute URLs,
+        so one stored for another host (`base_url`) counts as a miss.
+        """
+        entry = self.cache.get(self.key(user_pk)) if self.timeout > 0 else None
+        hit = entry is not None and entry['base_url'] == base_url
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if hit else None
+
+    def set(self, user_pk, base_url, data, versions, last_modified):
+        entry = {'base_url': base_url, 'data': data, 'versions': versions, 'last_modified': last_modified}
+        if self.timeout > 0:
+            self.cache.set(self.key(user_pk), entry, self.timeout)
+        return entry
+
+    def invalidate(self, user_pk):
+        if self.timeout > 0:
+            self.cache.delete(self.key(user_pk))
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+me_cache = MeCache(
+    alias=getattr(settings, 'ME_CACHE_ALIAS', 'default'),
+    timeout=getattr(settings, 'ME_CACHE_TIMEOUT', 300),
+    fields=UserSerializer.Meta.fields,
+)
+
+
+@metrics.registry.register_collector
+def collect_me_cache_stats():
+    stats = me_cache.stats()
+    return [
+        ('profiles_me_cache_requests_total', 'counter', 'Cached `me` payload lookups by result.',
+         [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]),
+        ('profiles_me_cache_hit_ratio', 'gauge', 'Share of `me` payload lookups served from the cache.',
+         [({}, stats['hit_ratio'])]),
+    ]
@@ -0,0 +1,129 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def file_etag(path, mtime_ns, size):
+    # Keyed on mtime and size as well, so a rewritten file is hashed again.
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return '"{0}"'.format(sha.hexdigest())
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single `bytes=` range, or None when
+    the header should be ignored and the whole file sent.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def iter_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def sendfile_response(path, name, content_type):
+    header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+    response = HttpResponse(content_type=content_type)
+    if header == 'X-Accel-Redirect':
+        response[header] = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/') + name
+    else:
+        response[header] = path
+    return response
+
+
+def serve_file(request, name, document_root):
+    """
+    Serve `name` below `document_root` with ETag and Last-Modified
+    validators, 304 handling, single byte ranges and optional X-Sendfile or
+    X-Accel-Redirect offload to the front end server.
+    """
+    name = posixpath.normpath(name).lstrip('/')
+    path = safe_join(document_root, name)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('"{0}" does not exist'.format(name))
+    if not os.path.isfile(path):
+        raise Http404('Directory indexes are not allowed here.')
+
+    etag = file_etag(path, stat.st_mtime_ns, stat.st_size)
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    if getattr(settings, 'MEDIA_SENDFILE_HEADER', None):
+        # The front end server deals with ranges itself.
+        response = sendfile_response(path, name, content_type)
+    else:
+        response = range_response(request, path, stat.st_size, etag, content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def range_response(request, path, size, etag, content_type):
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_range(path, start, end - start + 1), status=206,
+                                             content_type=content_type)
+            response['Content-Length'] = str(end - start + 1)
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
+            response['Accept-Ranges'] = 'bytes'
+            return response
+    response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['Accept-Ranges'] = 'bytes'
+    return response
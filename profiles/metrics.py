@@ -0,0 +1,209 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Read once; every hook checks this before doing any work.
+enabled = getattr(settings, 'METRICS_ENABLED', False)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def header(self):
+        return ['# HELP {0} {1}'.format(self.name, self.documentation),
+                '# TYPE {0} {1}'.format(self.name, self.type)]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = self.header()
+        for key, value in values:
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(zip(self.labelnames, key)),
+                                             _format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # One slot per bucket, then sum and count.
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        lines = self.header()
+        for key, state in values:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets + (float('inf'),), state[:len(self.buckets)] + [state[-1]]):
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _format_labels(labels + [('le', _format_value(float(bound)))]), count))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(labels), _format_value(state[-2])))
+            lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(labels), state[-1]))
+        return lines
+
+
+class Registry:
+    """
+    Holds metrics plus collectors, callables returning the current values
+    of stats kept elsewhere as [(name, type, help, [(labels, value)])].
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append('# HELP {0} {1}'.format(name, documentation))
+                lines.append('# TYPE {0} {1}'.format(name, metric_type))
+                for labels, value in samples:
+                    lines.append('{0}{1} {2}'.format(name, _format_labels(sorted(labels.items())),
+                                                     _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram(
+    'profiles_request_duration_seconds', 'Time spent handling a UserViewSet action.',
+    ['action', 'method', 'status'])
+REQUEST_DB_QUERIES = registry.histogram(
+    'profiles_request_db_queries', 'Database queries issued per UserViewSet request.',
+    ['action'], buckets=QUERY_BUCKETS)
+REQUEST_DB_TIME = registry.histogram(
+    'profiles_request_db_duration_seconds', 'Time spent in database queries per UserViewSet request.',
+    ['action'])
+PASSWORD_HASH_TIME = registry.histogram(
+    'profiles_password_hash_duration_seconds', 'Time spent hashing or checking a password.',
+    ['operation'])
+PASSWORD_HASH_QUEUE_WAIT = registry.histogram(
+    'profiles_password_hash_queue_wait_seconds', 'Time a password job waited for a hashing worker.',
+    ['operation'])
+TEMPLATE_RENDER_TIME = registry.histogram(
+    'profiles_template_render_duration_seconds', 'Time spent rendering a template.',
+    ['template'])
+
+
+@contextmanager
+def _timer(histogram, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(histogram, **labels):
+    """
+    Context manager observing the block's duration, or a shared no-op
+    when metrics are disabled.
+    """
+    if not enabled:
+        return _null_timer
+    return _timer(histogram, labels)
+
+
+class QueryTimer:
+    """
+    connection.execute_wrapper() hook counting and timing queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
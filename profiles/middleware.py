@@ -0,0 +1,150 @@
+import asyncio
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import db_routers, identity, log, metrics
+
+
+def mark_async(middleware, get_response):
+    # Under ASGI the handler chain is async; flag the instance as a coroutine
+    # function so Django calls it without a sync adapter in between.
+    middleware.is_async = asyncio.iscoroutinefunction(get_response)
+    if middleware.is_async:
+        middleware._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+class MetricsMiddleware:
+    """
+    Records latency, query count and query time for every viewset action.
+    Removed from the stack entirely unless METRICS_ENABLED is set.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics.enabled:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        mark_async(self, get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        queries = metrics.QueryTimer()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            response = self.get_response(request)
+        action = getattr(request, '_metrics_action', None)
+        if action is not None:
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, action=action,
+                                            method=request.method, status=response.status_code)
+            metrics.REQUEST_DB_QUERIES.observe(queries.count, action=action)
+            metrics.REQUEST_DB_TIME.observe(queries.duration, action=action)
+        return response
+
+    async def __acall__(self, request):
+        # Async views run their queries on worker threads, out of reach of a
+        # connection wrapper installed here, so only latency is recorded.
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        action = getattr(request, '_metrics_action', None)
+        if action is not None:
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, action=action,
+                                            method=request.method, status=response.status_code)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Viewset views carry their method -> action mapping.
+        actions = getattr(view_func, 'actions', None)
+        if actions:
+            request._metrics_action = actions.get(request.method.lower())
+
+
+class RequestIDMiddleware:
+    """
+    Makes the request id (the client's X-Request-ID, or a fresh one)
+    available to log records and echoes it on the response.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        mark_async(self, get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request_id = request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        token = log.request_id.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response['X-Request-ID'] = request_id
+        return response
+
+    async def __acall__(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID') or uuid.uuid4().hex
+        token = log.request_id.set(request_id)
+        try:
+            response = await self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response['X-Request-ID'] = request_id
+        return response
+
+
+class ReplicaMiddleware:
+    """
+    Gives each request its own read-your-writes state for
+    profiles.db_routers. Not used unless read replicas are configured.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not db_routers.replicas.aliases:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        mark_async(self, get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with db_routers.request_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with db_routers.request_scope():
+            return await self.get_response(request)
+
+
+class IdentityMapMiddleware:
+    """
+    Gives each request its own profiles.identity map of loaded users.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        mark_async(self, get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with identity.request_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with identity.request_scope():
+            return await self.get_response(request)
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_customuser_has_requested_password_reset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='subject')),
+                ('body', models.TextField(blank=True, verbose_name='body')),
+                ('html_body', models.TextField(blank=True, verbose_name='html body')),
+                ('from_email', models.CharField(blank=True, max_length=254, verbose_name='from email')),
+                ('recipients', models.TextField(help_text='Comma separated list of addresses.', verbose_name='recipients')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('sending', 'sending'), ('sent', 'sent'), ('failed', 'failed')], default='queued', max_length=10, verbose_name='status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='next attempt at')),
+                ('claimed_by', models.CharField(blank=True, max_length=32, verbose_name='claimed by')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='sent at')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='profiles_ou_status_8983c7_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.14 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0003_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='updated at'),
+            preserve_default=False,
+        ),
+    ]
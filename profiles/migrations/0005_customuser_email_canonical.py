@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0004_customuser_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='email_canonical',
+            field=models.EmailField(editable=False, max_length=254, null=True, verbose_name='canonical email address'),
+        ),
+    ]
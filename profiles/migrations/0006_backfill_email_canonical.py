@@ -0,0 +1,58 @@
+"""
+Fill in email_canonical in batches, each in its own transaction, so the
+table is never locked for long. Accounts whose emails differ only in case
+are then deduplicated: the one that logged in most recently (the oldest
+when none did) keeps the address, the others keep their rows but are
+parked with a NULL email_canonical, so they can no longer be found by
+email. Their tokens are deleted too, so they cannot stay signed in
+either. Safe to rerun if interrupted.
+"""
+from django.db import migrations, transaction
+from django.db.models import Count, F
+
+BATCH_SIZE = 1000
+
+
+def canonical_email(email):
+    # Frozen copy of profiles.models.canonical_email.
+    return email.strip().lower()
+
+
+def backfill(apps, schema_editor):
+    CustomUser = apps.get_model('profiles', 'CustomUser')
+    Token = apps.get_model('authtoken', 'Token')
+    db = schema_editor.connection.alias
+    users = CustomUser.objects.using(db)
+    last_pk = 0
+    while True:
+        batch = list(users.filter(pk__gt=last_pk, email_canonical__isnull=True).order_by('pk')
+                     .only('pk', 'email')[:BATCH_SIZE])
+        if not batch:
+            break
+        for user in batch:
+            user.email_canonical = canonical_email(user.email)
+        with transaction.atomic(using=db):
+            users.bulk_update(batch, ['email_canonical'])
+        last_pk = batch[-1].pk
+
+    duplicates = list(users.filter(email_canonical__isnull=False).values('email_canonical')
+                      .annotate(count=Count('pk')).filter(count__gt=1).values_list('email_canonical', flat=True))
+    for email in duplicates:
+        pks = list(users.filter(email_canonical=email)
+                   .order_by(F('last_login').desc(nulls_last=True), 'pk').values_list('pk', flat=True))
+        with transaction.atomic(using=db):
+            users.filter(pk__in=pks[1:]).update(email_canonical=None)
+            Token.objects.using(db).filter(user_id__in=pks[1:]).delete()
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('authtoken', '0003_tokenproxy'),
+        ('profiles', '0005_customuser_email_canonical'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
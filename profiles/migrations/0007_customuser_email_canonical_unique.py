@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0006_backfill_email_canonical'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customuser',
+            name='email_canonical',
+            field=models.EmailField(editable=False, max_length=254, null=True, unique=True,
+                                    verbose_name='canonical email address'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import profiles.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0007_customuser_email_canonical_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthToken',
+            fields=[
+                ('key', models.CharField(max_length=40, primary_key=True, serialize=False, verbose_name='key')),
+                ('name', models.CharField(blank=True, max_length=100, verbose_name='device name')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created')),
+                ('expires_at', models.DateTimeField(db_index=True, default=profiles.models.token_expiry, verbose_name='expires at')),
+                ('last_used_at', models.DateTimeField(blank=True, null=True, verbose_name='last used at')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='auth_tokens', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'token',
+                'verbose_name_plural': 'tokens',
+            },
+        ),
+    ]
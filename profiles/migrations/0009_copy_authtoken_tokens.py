@@ -0,0 +1,41 @@
+"""
+Copy DRF's one-per-user tokens into AuthToken in batches, so clients keep
+working. Copied tokens expire TOKEN_TTL seconds after the migration runs.
+The authtoken table itself is left alone.
+"""
+from django.db import migrations, transaction
+
+from profiles.models import token_expiry
+
+BATCH_SIZE = 1000
+
+
+def copy_tokens(apps, schema_editor):
+    Token = apps.get_model('authtoken', 'Token')
+    AuthToken = apps.get_model('profiles', 'AuthToken')
+    db = schema_editor.connection.alias
+    expires_at = token_expiry()
+    last_key = ''
+    while True:
+        batch = list(Token.objects.using(db).filter(key__gt=last_key).order_by('key')[:BATCH_SIZE])
+        if not batch:
+            break
+        with transaction.atomic(using=db):
+            AuthToken.objects.using(db).bulk_create([
+                AuthToken(key=token.key, user_id=token.user_id, created=token.created, expires_at=expires_at)
+                for token in batch
+            ], ignore_conflicts=True)
+        last_key = batch[-1].key
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('authtoken', '0003_tokenproxy'),
+        ('profiles', '0008_authtoken'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0009_copy_authtoken_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='version'),
+        ),
+    ]
@@ -1,13 +1,65 @@
+import binascii
+import datetime
+import hashlib
+import os
+
+from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
-from django.db import models
+from django.db import connections, models, router
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .storage import CONTENT_ADDRESSED_PREFIX
+
+
+def canonical_email(email):
+    """
+    The form emails are compared in: two addresses differing only in case
+    belong to the same account.
+    """
+    return email.strip().lower()
+
+
+class VersionConflict(Exception):
+    """
+    A save with `expected_version` found the row at another version.
+    """
+
+
+def can_update_returning(connection):
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    # MySQL and MariaDB have no UPDATE ... RETURNING.
+    return connection.vendor == 'postgresql'
+
 
 class UserManager(BaseUserManager):
     use_in_migrations = True
 
+    def get_by_natural_key(self, username):
+        return self.get(email_canonical=canonical_email(username))
+
+    def flag_password_reset(self, email):
+        """
+        Set has_requested_password_reset on the user with `email` and return
+        it, or None when there is no such user. One UPDATE ... RETURNING
+        where the database supports it.
+        """
+        using = self._db or router.db_for_write(self.model)
+        connection = connections[using]
+        meta = self.model._meta
+        lookup = canonical_email(email)
+        if not can_update_returning(connection):
+            if not self.db_manager(using).filter(email_canonical=lookup).update(has_requested_password_reset=True):
+                return None
+            return self.db_manager(using).get(email_canonical=lookup)
+        qn = connection.ops.quote_name
+        sql = 'UPDATE {0} SET {1} = %s WHERE {2} = %s RETURNING {3}'.format(
+            qn(meta.db_table), qn(meta.get_field('has_requested_password_reset').column),
+            qn(meta.get_field('email_canonical').column), ', '.join(qn(f.column) for f in meta.concrete_fields))
+        return next(iter(self.db_manager(using).raw(sql, [True, lookup])), None)
+
     def _create_user(self, email, password, **extra_fields):
         if not email:
             raise ValueError('The given email must be set')
@@ -40,15 +92,38 @@ def validate_file_extension(value):
         raise ValidationError('Unsupported file extension.')
 
 
+def media_shard(key):
+    # Two levels of 256 directories keep any one directory small.
+    digest = hashlib.md5(str(key).encode()).hexdigest()
+    return '{0}/{1}'.format(digest[:2], digest[2:4])
+
+
+def content_address(file, filename):
+    sha = hashlib.sha256()
+    for chunk in file.chunks():
+        sha.update(chunk)
+    file.seek(0)
+    digest = sha.hexdigest()
+    ext = os.path.splitext(filename)[1].lower()
+    return CONTENT_ADDRESSED_PREFIX + '{0}/{1}/{2}{3}'.format(digest[:2], digest[2:4], digest, ext)
+
+
 def user_directory_path(instance, filename):
-    # file will be uploaded to MEDIA_ROOT/user_<id>/<filename>
-    return '{0}/{1}'.format(instance.id, filename)
+    # file will be uploaded to MEDIA_ROOT/<ab>/<cd>/<id>/<filename>, or with
+    # PROFILE_IMAGE_DEDUPE to MEDIA_ROOT/cas/<ab>/<cd>/<sha256><ext> so identical
+    # uploads share one file.
+    if getattr(settings, 'PROFILE_IMAGE_DEDUPE', False) and instance.profile_image:
+        return content_address(instance.profile_image, filename)
+    return '{0}/{1}/{2}'.format(media_shard(instance.id), instance.id, filename)
 
 
 # Create your models here.
 class CustomUser(AbstractBaseUser, PermissionsMixin):
     username = None
     email = models.EmailField(_('email address'), unique=True)
+    # Kept in sync with `email` by save(). Lookups by email go through it;
+    # NULL only for duplicates parked by migration 0006, which stay parked.
+    email_canonical = models.EmailField(_('canonical email address'), unique=True, null=True, editable=False)
     name = models.CharField(_('name'), blank=True, max_length=50)
     has_requested_password_reset = models.BooleanField(default=False)
     is_staff = models.BooleanField(
@@ -59,14 +134,142 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     profile_image = models.FileField(default=None, validators=[validate_file_extension],
                                      upload_to=user_directory_path)
     date_joined = models.DateTimeField(_('date joined'), default=timezone.now)
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True)
+    # Bumped by every save but those only touching UNVERSIONED_FIELDS, see
+    # save(expected_version=...).
+    version = models.PositiveIntegerField(_('version'), default=0, editable=False)
 
     objects = UserManager()
 
+    UNVERSIONED_FIELDS = frozenset(['last_login'])
+
     USERNAME_FIELD = 'email'
 
     def __str__(self):  # __unicode__ on Python 2
         return self.email
 
+    def save(self, *args, expected_version=None, **kwargs):
+        """
+        With `update_fields`, only those columns are written, plus
+        email_canonical, updated_at and version where they follow. With
+        `expected_version` too, the UPDATE only applies while the row is
+        still at that version, and VersionConflict is raised otherwise.
+        """
+        if self._state.adding or self.email_canonical is not None:
+            self.email_canonical = canonical_email(self.email)
+        update_fields = kwargs.get('update_fields')
+        versioned = update_fields is None or not self.UNVERSIONED_FIELDS.issuperset(update_fields)
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'email' in update_fields:
+                update_fields.add('email_canonical')
+            if versioned:
+                # auto_now is only written when listed.
+                update_fields |= {'updated_at', 'version'}
+            kwargs['update_fields'] = update_fields
+        elif expected_version is not None:
+            # Without update_fields, a missed UPDATE would fall back to an INSERT.
+            raise ValueError('expected_version needs update_fields')
+        if versioned and not self._state.adding:
+            self.version = (self.version if expected_version is None else expected_version) + 1
+        self._expected_version, self._version_conflict = expected_version, False
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self._expected_version = None
+        if self._version_conflict:
+            # Raised out here: inside save_base it would break the caller's
+            # transaction.
+            self.version = expected_version
+            raise VersionConflict('User {0} is no longer at version {1}'.format(self.pk, expected_version))
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        expected_version = getattr(self, '_expected_version', None)
+        if expected_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        self._version_conflict = not super()._do_update(base_qs.filter(version=expected_version), using, pk_val,
+                                                        values, update_fields, forced_update)
+        # A miss is not reported, or save_base would raise a DatabaseError.
+        return True
+
+
+class OutboxMessage(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, _('queued')),
+        (STATUS_SENDING, _('sending')),
+        (STATUS_SENT, _('sent')),
+        (STATUS_FAILED, _('failed')),
+    ]
+
+    subject = models.CharField(_('subject'), max_length=255)
+    body = models.TextField(_('body'), blank=True)
+    html_body = models.TextField(_('html body'), blank=True)
+    from_email = models.CharField(_('from email'), max_length=254, blank=True)
+    recipients = models.TextField(_('recipients'), help_text=_('Comma separated list of addresses.'))
+    status = models.CharField(_('status'), max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_attempt_at = models.DateTimeField(_('next attempt at'), default=timezone.now)
+    claimed_by = models.CharField(_('claimed by'), max_length=32, blank=True)
+    last_error = models.TextField(_('last error'), blank=True)
+    created_at = models.DateTimeField(_('created at'), default=timezone.now)
+    sent_at = models.DateTimeField(_('sent at'), null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return '{0} -> {1} ({2})'.format(self.subject, self.recipients, self.status)
+
+    @property
+    def recipient_list(self):
+        return [r for r in self.recipients.split(',') if r]
+
+
+def token_expiry():
+    return timezone.now() + datetime.timedelta(seconds=getattr(settings, 'TOKEN_TTL', 30 * 24 * 3600))
+
+
+class AuthToken(models.Model):
+    """
+    An API token for one device. A user can hold several; each expires
+    TOKEN_TTL seconds after it was issued (see `manage.py purge_tokens`).
+    """
+    key = models.CharField(_('key'), max_length=40, primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='auth_tokens', on_delete=models.CASCADE,
+                             verbose_name=_('user'))
+    name = models.CharField(_('device name'), max_length=100, blank=True)
+    created = models.DateTimeField(_('created'), default=timezone.now)
+    expires_at = models.DateTimeField(_('expires at'), default=token_expiry, db_index=True)
+    # Written at most every TOKEN_LAST_USED_INTERVAL seconds.
+    last_used_at = models.DateTimeField(_('last used at'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('token')
+        verbose_name_plural = _('tokens')
+
+    def __str__(self):
+        return self.key
+
+    def save(self, *args, **kwargs):
+        if not self.key:
+            self.key = self.generate_key()
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def generate_key(cls):
+        return binascii.hexlify(os.urandom(20)).decode()
+
+    @property
+    def is_expired(self):
+        return self.expires_at <= timezone.now()
+
+
 # @receiver(post_save, sender=CustomUser)
 # def create_auth_token(sender, instance=None, created=False, **kwargs):
 #     if created:
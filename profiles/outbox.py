@@ -0,0 +1,134 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .models import OutboxMessage
+
+BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 50)
+MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5)
+RETRY_BACKOFF = getattr(settings, 'OUTBOX_RETRY_BACKOFF', 30)
+MAX_RETRY_BACKOFF = getattr(settings, 'OUTBOX_MAX_RETRY_BACKOFF', 3600)
+LEASE = getattr(settings, 'OUTBOX_LEASE', 300)
+
+
+def enqueue_mail(subject, message, from_email, recipient_list, html_message=''):
+    """
+    Queue a message for the outbox worker instead of talking SMTP on the
+    request thread. Same arguments as django.core.mail.send_mail.
+    """
+    return OutboxMessage.objects.create(
+        subject=subject,
+        body=message,
+        html_body=html_message or '',
+        from_email=from_email or '',
+        recipients=','.join(recipient_list),
+    )
+
+
+def claim_batch(batch_size=BATCH_SIZE):
+    """
+    Lease up to `batch_size` due messages to the caller. A message whose
+    lease ran out (worker died mid-send) becomes claimable again.
+    """
+    now = timezone.now()
+    due = (Q(status=OutboxMessage.STATUS_QUEUED) | Q(status=OutboxMessage.STATUS_SENDING)) & \
+        Q(next_attempt_at__lte=now)
+    ids = list(OutboxMessage.objects.filter(due).order_by('next_attempt_at')
+               .values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return []
+    claim = uuid.uuid4().hex
+    # Only rows still due get the claim, so concurrent workers never share one.
+    OutboxMessage.objects.filter(due, pk__in=ids).update(
+        status=OutboxMessage.STATUS_SENDING,
+        next_attempt_at=now + timedelta(seconds=LEASE),
+        claimed_by=claim,
+    )
+    return list(OutboxMessage.objects.filter(claimed_by=claim, status=OutboxMessage.STATUS_SENDING))
+
+
+def retry_delay(attempts):
+    return min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+
+
+def build_email(message, connection):
+    email = EmailMultiAlternatives(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or None,
+        to=message.recipient_list,
+        connection=connection,
+    )
+    if message.html_body:
+        email.attach_alternative(message.html_body, 'text/html')
+    return email
+
+
+def deliver_batch(messages, connection):
+    """
+    Send claimed messages over an already opened connection. Returns the
+    number of messages sent; failures are rescheduled with backoff. Messages
+    sent before an error escapes (reconnecting failed) are still marked
+    sent; the rest stay leased until LEASE runs out.
+    """
+    sent = []
+    try:
+        for message in messages:
+            try:
+                connection.send_messages([build_email(message, connection)])
+            except Exception as e:
+                attempts = message.attempts + 1
+                if attempts >= MAX_ATTEMPTS:
+                    status, next_attempt_at = OutboxMessage.STATUS_FAILED, timezone.now()
+                else:
+                    status = OutboxMessage.STATUS_QUEUED
+                    next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(attempts))
+                OutboxMessage.objects.filter(pk=message.pk, claimed_by=message.claimed_by).update(
+                    status=status, attempts=attempts, next_attempt_at=next_attempt_at,
+                    claimed_by='', last_error=repr(e),
+                )
+                # The server may have dropped us; start the next send on a fresh connection.
+                connection.close()
+                connection.open()
+            else:
+                sent.append(message.pk)
+    finally:
+        if sent:
+            # A batch shares one claim (claim_batch). Rows whose lease ran out
+            # and went to another worker are that worker's to mark.
+            OutboxMessage.objects.filter(pk__in=sent, claimed_by=messages[0].claimed_by).update(
+                status=OutboxMessage.STATUS_SENT, sent_at=timezone.now(), claimed_by='', last_error='',
+            )
+    return len(sent)
+
+
+def drain(batch_size=BATCH_SIZE, connection=None):
+    """
+    Deliver due messages in batches over a single reused connection until
+    nothing is left to claim. Returns the number of messages sent.
+    """
+    connection = connection or get_connection()
+    connection.open()
+    total = 0
+    try:
+        while True:
+            messages = claim_batch(batch_size)
+            if not messages:
+                return total
+            total += deliver_batch(messages, connection)
+    finally:
+        connection.close()
+
+
+@metrics.registry.register_collector
+def collect_outbox_stats():
+    pending = [OutboxMessage.STATUS_QUEUED, OutboxMessage.STATUS_SENDING]
+    queued = OutboxMessage.objects.filter(status__in=pending).count()
+    return [
+        ('profiles_outbox_pending', 'gauge', 'Outbox messages waiting to be delivered.', [({}, queued)]),
+    ]
@@ -0,0 +1,13 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the primary key, so every page is an indexed
+    range scan no matter how deep the client pages.
+    """
+    ordering = 'id'
+    page_size = getattr(settings, 'USER_LIST_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'USER_LIST_MAX_PAGE_SIZE', 1000)
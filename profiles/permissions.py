@@ -1,16 +1,20 @@
+import logging
+
 from rest_framework import permissions
 
+logger = logging.getLogger(__name__)
+
 
 class UserAccessPermission(permissions.BasePermission):
     message = "User is not allowed to update"
 
     def has_permission(self, request, view):
         if request.user.is_anonymous:
-            print('Unknown')
+            logger.debug('Anonymous request to %s denied', view.action)
             return False
         return True
 
     def has_object_permission(self, request, view, obj):
-        print(request.user)
-        print(obj)
-        return obj == request.user
+        allowed = obj == request.user
+        logger.debug('Object permission for %s on %s: %s', request.user, obj, allowed)
+        return allowed
@@ -0,0 +1,45 @@
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer, TemplateHTMLRenderer
+
+from . import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if not getattr(settings, 'FAST_JSON', True):
+    orjson = None
+
+
+class TimedTemplateHTMLRenderer(TemplateHTMLRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not metrics.enabled:
+            return super().render(data, accepted_media_type, renderer_context)
+        response = (renderer_context or {}).get('response')
+        template = getattr(response, 'template_name', None) or self.template_name or ''
+        with metrics.timer(metrics.TEMPLATE_RENDER_TIME, template=template):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson when it is installed, producing
+    the same bytes as the stdlib path for compact, non-indented output.
+    Anything else (indent requested, data orjson rejects) goes through
+    JSONRenderer.
+    """
+    if orjson is not None:
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # Dates and the other types orjson leaves alone are formatted
+            # by DRF's encoder, exactly as json.dumps would.
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except (orjson.JSONEncodeError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
@@ -0,0 +1,140 @@
+"""
+The OpenAPI schema of the users API, built once and served from a file.
+
+`manage.py generate_schema` writes the schema to
+OPENAPI_SCHEMA_DIR/openapi-<version>-<fingerprint>.json, where the
+fingerprint hashes the drf_yasg and DRF versions and the source of the
+modules the schema is introspected from. The swagger view serves that
+file with long-lived caching. A process that finds no artifact for its own
+fingerprint (missing, or stale after a code change) generates the schema
+once itself and tries to write it.
+"""
+import glob
+import hashlib
+import logging
+import os
+import threading
+
+import drf_yasg
+import rest_framework
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.renderers import OpenAPIRenderer, SwaggerJSONRenderer
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_DIR = getattr(settings, 'OPENAPI_SCHEMA_DIR', os.path.join(settings.BASE_DIR, 'schema'))
+MAX_AGE = getattr(settings, 'OPENAPI_SCHEMA_MAX_AGE', 24 * 3600)
+# Modules whose source the schema is generated from.
+SOURCE_MODULES = ('models', 'pagination', 'parsers', 'permissions', 'renderers', 'schema', 'serializers', 'urls',
+                  'views')
+
+API_VERSION = 'v1'
+
+api_info = openapi.Info(
+    title="Profile API",
+    default_version=API_VERSION,
+    description="Getting image absolute URL",
+    terms_of_service="https://www.google.com/policies/terms/",
+    contact=openapi.Contact(email="contact@test.com"),
+    license=openapi.License(name="BSD License"),
+)
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+def fingerprint():
+    digest = hashlib.sha256()
+    digest.update('{0}|{1}|{2}'.format(drf_yasg.__version__, rest_framework.VERSION, API_VERSION)
+                  .encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCE_MODULES:
+        with open(os.path.join(directory, name + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def artifact_path(version=None, directory=None):
+    return os.path.join(directory or SCHEMA_DIR, 'openapi-{0}-{1}.json'.format(
+        API_VERSION, version or fingerprint()))
+
+
+def generate():
+    """
+    The schema as JSON bytes. Without a request, no host is emitted, so
+    clients resolve the API against wherever they loaded the schema from.
+    """
+    generator = SchemaView.generator_class(api_info, url='')
+    return OpenAPICodecJson(validators=[]).encode(generator.get_schema(request=None, public=True))
+
+
+def write(content, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def stale_artifacts(directory=None):
+    current = artifact_path(directory=directory)
+    return [path for path in glob.glob(os.path.join(directory or SCHEMA_DIR, 'openapi-*.json')) if path != current]
+
+
+def load():
+    """
+    (content, version) of the current schema, from the artifact when there
+    is one, generated in process otherwise. Kept in memory after the first
+    call.
+    """
+    with _lock:
+        if _loaded:
+            return _loaded['content'], _loaded['version']
+        version = fingerprint()
+        path = artifact_path(version)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            logger.warning('No schema artifact at %s, generating it in process; run `manage.py generate_schema` '
+                           'at build time', path)
+            content = generate()
+            try:
+                write(content, path)
+            except OSError as e:
+                logger.warning('Could not write schema artifact %s: %s', path, e)
+        _loaded.update(content=content, version=version)
+        return content, version
+
+
+def reset():
+    with _lock:
+        _loaded.clear()
+
+
+class SchemaView(get_schema_view(api_info, public=True, permission_classes=(permissions.AllowAny,))):
+    """
+    drf_yasg's schema view, with the JSON schema served from the artifact
+    (see `load`) instead of introspecting the API on every request. The UI
+    page and YAML are still rendered by drf_yasg.
+    """
+
+    def get(self, request, version='', format=None):
+        if not isinstance(request.accepted_renderer, (OpenAPIRenderer, SwaggerJSONRenderer)):
+            return super().get(request, version, format)
+        content, schema_version = load()
+        etag = '"{0}"'.format(schema_version)
+        response = get_conditional_response(request._request, etag=etag) or \
+            HttpResponse(content, content_type=request.accepted_renderer.media_type)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+        return response
+
+
+schema_view = SchemaView
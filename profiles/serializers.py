@@ -1,13 +1,53 @@
+import logging
+
 import django.contrib.auth.password_validation as validators
 from django.contrib.auth import authenticate
 from django.core import exceptions
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.utils.encoding import filepath_to_uri
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
+
+from .authentication import token_cache
+from .hashing import hashing_executor
+from .images import schedule_variants, variant_urls
+from .models import CustomUser, VersionConflict, canonical_email
+from .sharding import db_for_email, on_shard
+from .storage import CONTENT_ADDRESSED_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+class EmailUniqueValidator(UniqueValidator):
+    """
+    UniqueValidator ignoring case, run on the shard the email belongs on.
+    """
+
+    def __call__(self, value, serializer_field):
+        instance = getattr(serializer_field.parent, 'instance', None)
+        if instance is not None and instance.email_canonical == canonical_email(value):
+            # Unchanged, so the only row holding it is the instance's own.
+            return
+        super().__call__(value, serializer_field)
 
-from .models import CustomUser
+    def filter_queryset(self, value, queryset, field_name):
+        return on_shard(queryset, db_for_email(value)).filter(email_canonical=canonical_email(value))
 
 
-class RegisterSerializer(serializers.ModelSerializer):
+class ShardedModelSerializer(serializers.ModelSerializer):
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super().build_standard_field(field_name, model_field)
+        if field_name == 'email':
+            field_kwargs['validators'] = [
+                EmailUniqueValidator(v.queryset, v.message, v.lookup) if type(v) is UniqueValidator else v
+                for v in field_kwargs.get('validators', [])
+            ]
+        return field_class, field_kwargs
+
+
+class RegisterSerializer(ShardedModelSerializer):
     password = serializers.CharField(write_only=True)
     re_password = serializers.CharField(write_only=True)
 
@@ -35,12 +75,27 @@ class RegisterSerializer(serializers.ModelSerializer):
             email=validated_data['email'],
             name=validated_data['name'],
         )
-        user.set_password(validated_data['password'])
+        user.password = hashing_executor.make_password(validated_data['password'])
         user.save()
-        print(user)
+        logger.info('Registered user %s', user.pk)
         return user
 
 
+class BulkRegisterSerializer(RegisterSerializer):
+    """
+    Per-record validation for bulk imports. Email uniqueness is checked for
+    a whole chunk at once by profiles.bulk, and re_password is optional.
+    """
+    re_password = serializers.CharField(write_only=True, required=False)
+
+    class Meta(RegisterSerializer.Meta):
+        extra_kwargs = {'email': {'validators': []}}
+
+    def validate(self, attrs):
+        attrs.setdefault('re_password', attrs.get('password'))
+        return super().validate(attrs)
+
+
 class LoginSerializer(serializers.ModelSerializer):
     email = serializers.CharField(
         label=_("Email"),
@@ -68,10 +123,84 @@ class LoginSerializer(serializers.ModelSerializer):
         return attrs
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ShardedModelSerializer):
+    profile_image_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = CustomUser
-        fields = ['id', 'email', 'profile_image', 'date_joined']
+        fields = ['id', 'email', 'profile_image', 'profile_image_variants', 'date_joined']
+
+    def get_profile_image_variants(self, obj):
+        request = self.context.get('request')
+        build_url = request.build_absolute_uri if request is not None else str
+        return variant_urls(obj.profile_image.name, build_url)
+
+    def update(self, instance, validated_data):
+        # From save(expected_version=...), see CustomUser.save.
+        expected_version = validated_data.pop('expected_version', None)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        try:
+            instance.save(update_fields=list(validated_data), expected_version=expected_version)
+        except VersionConflict:
+            # The upload was stored before the UPDATE missed. Content
+            # addressed files may be shared, those stay.
+            name = instance.profile_image.name
+            if 'profile_image' in validated_data and name and not name.startswith(CONTENT_ADDRESSED_PREFIX):
+                instance.profile_image.storage.delete(name)
+            raise
+        if 'profile_image' in validated_data:
+            name = instance.profile_image.name
+            transaction.on_commit(lambda: schedule_variants(name))
+        return instance
+
+
+def media_url_builder(request, storage=default_storage):
+    """
+    name -> URL of a stored file, as a FileField renders it. For a plain
+    FileSystemStorage the absolute MEDIA_URL prefix is built once instead of
+    once per file.
+    """
+    build_url = request.build_absolute_uri if request is not None else str
+    if storage.__class__.url is FileSystemStorage.url and storage.base_url.startswith('/') and \
+            not storage.base_url.startswith('//'):
+        prefix = build_url(storage.base_url)
+        return lambda name: prefix + filepath_to_uri(name).lstrip('/')
+    return lambda name: build_url(storage.url(name))
+
+
+class UserRowSerializer:
+    """
+    UserSerializer's output, built straight from `.values(*VALUES)` rows
+    instead of model instances and per-field serializer objects.
+    """
+    VALUES = ('id', 'email', 'profile_image', 'date_joined', 'updated_at')
+
+    def __init__(self, context=None):
+        self.media_url = media_url_builder((context or {}).get('request'))
+        self.date_joined = serializers.DateTimeField()
+
+    def to_representation(self, row):
+        name = row['profile_image']
+        return {
+            'id': row['id'],
+            'email': row['email'],
+            'profile_image': self.media_url(name) if name else None,
+            'profile_image_variants': variant_urls(name, str, self.media_url),
+            'date_joined': self.date_joined.to_representation(row['date_joined']),
+        }
+
+    def many(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+    @classmethod
+    def row(cls, user):
+        """
+        The `.values(*VALUES)` row of a loaded user.
+        """
+        row = {name: getattr(user, name) for name in cls.VALUES}
+        row['profile_image'] = user.profile_image.name
+        return row
 
 
 class PasswordSerializer(serializers.ModelSerializer):
@@ -112,9 +241,8 @@ class ResetPasswordSerializer(serializers.ModelSerializer):
         return attrs
 
     def update(self, instance, validated_data):
-        print(validated_data)
-        print(instance)
         instance.has_requested_password_reset = False
-        instance.set_password(validated_data['password'])
-        instance.save()
+        instance.password = hashing_executor.make_password(validated_data['password'])
+        instance.save(update_fields=['password', 'has_requested_password_reset'])
+        token_cache.invalidate_user(instance.pk)
         return instance
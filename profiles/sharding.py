@@ -0,0 +1,165 @@
+"""
+Optional horizontal sharding of users by email.
+
+SHARD_DATABASES lists the shard aliases, 'default' first. A user lives on
+the shard picked by a jump consistent hash of the normalized email, so
+adding a shard only moves about 1/N of the users (see `manage.py
+rebalance_shards`). Each shard hands out primary keys from its own range,
+keeping user ids unique across shards.
+
+Token keys and password reset uids carry the shard index, so resolving
+them takes one lookup on one shard. After a rebalance they may point at a
+user's old shard; lookups then fall back to the other shards.
+
+With a single shard every helper returns None (let the routers decide)
+and keys and uids keep their usual format.
+"""
+import binascii
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import connections
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+from .models import canonical_email
+
+SHARDS = list(getattr(settings, 'SHARD_DATABASES', ['default']))
+# Primary keys of shard i start at i * ID_SPAN + 1.
+ID_SPAN = getattr(settings, 'SHARD_ID_SPAN', 2 ** 26)
+
+
+def enabled():
+    return len(SHARDS) > 1
+
+
+def jump_hash(key, buckets):
+    """
+    Lamping and Veach's jump consistent hash of a 64-bit `key`.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) % 2 ** 64
+        j = int((b + 1) * (2 ** 31 / ((key >> 33) + 1)))
+    return b
+
+
+def shard_index(email, shards=None):
+    shards = SHARDS if shards is None else shards
+    digest = hashlib.sha1(canonical_email(email).encode()).digest()
+    return jump_hash(int.from_bytes(digest[:8], 'big'), len(shards))
+
+
+def shard_for_email(email, shards=None):
+    shards = SHARDS if shards is None else shards
+    return shards[shard_index(email, shards)]
+
+
+def shard_of(instance):
+    """
+    Primary alias of the shard `instance` was loaded from or saved to. Rows
+    read from a replica belong to 'default'.
+    """
+    db = instance._state.db
+    return db if db in SHARDS else SHARDS[0]
+
+
+def db_for_email(email):
+    return shard_for_email(email) if enabled() else None
+
+
+def db_for_user(user):
+    state = getattr(user, '_state', None)
+    return shard_of(user) if enabled() and state is not None and state.db else None
+
+
+def other_shards(alias):
+    return [shard for shard in SHARDS if shard != alias]
+
+
+def shard_for_pk(pk):
+    """
+    Shard whose id range `pk` is from: where the user was created, and
+    still is unless a rebalance moved it.
+    """
+    return SHARDS[min(max(int(pk) - 1, 0) // ID_SPAN, len(SHARDS) - 1)]
+
+
+def on_shard(queryset, alias):
+    return queryset.using(alias) if alias else queryset
+
+
+def token_defaults(alias):
+    # create() arguments giving a new AuthToken a key naming its shard.
+    return {'key': make_token_key(alias)} if alias else {}
+
+
+def make_token_key(alias):
+    """
+    A token key (40 hex digits, like DRF's) starting with the shard index.
+    """
+    return '{0:02x}{1}'.format(SHARDS.index(alias), binascii.hexlify(os.urandom(19)).decode())
+
+
+def shard_for_token(key):
+    try:
+        return SHARDS[int(key[:2], 16)]
+    except (ValueError, IndexError):
+        return SHARDS[0]
+
+
+def encode_uid(user):
+    if not enabled():
+        return urlsafe_base64_encode(force_bytes(user.pk))
+    return urlsafe_base64_encode(force_bytes('{0}.{1}'.format(SHARDS.index(shard_of(user)), user.pk)))
+
+
+def decode_uid(uid):
+    """
+    (shard alias or None, pk) from a uid made by `encode_uid`.
+    """
+    value = force_text(urlsafe_base64_decode(uid))
+    if '.' not in value:
+        return None, value
+    index, pk = value.split('.', 1)
+    return SHARDS[int(index)] if int(index) < len(SHARDS) else None, pk
+
+
+def get_from_shards(queryset, alias=None, **lookup):
+    """
+    queryset.get(**lookup) on `alias` first, then on the other shards.
+    """
+    if not enabled():
+        return queryset.get(**lookup)
+    alias = alias or SHARDS[0]
+    for shard in [alias] + other_shards(alias):
+        try:
+            return queryset.using(shard).get(**lookup)
+        except queryset.model.DoesNotExist:
+            continue
+    raise queryset.model.DoesNotExist('{0} matching query does not exist.'.format(queryset.model._meta.object_name))
+
+
+def reserve_id_range(alias, table):
+    """
+    Make `table` on shard `alias` hand out ids from the shard's range.
+    """
+    index = SHARDS.index(alias)
+    if index == 0:
+        return
+    start = index * ID_SPAN
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                           'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)', [table, start, table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                           "GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {0})))".format(
+                               connection.ops.quote_name(table)), [table, start])
+        elif connection.vendor == 'mysql':
+            # AUTO_INCREMENT never goes below the current maximum id.
+            cursor.execute('ALTER TABLE {0} AUTO_INCREMENT = {1}'.format(connection.ops.quote_name(table), start + 1))
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from . import identity, sharding
+from .authentication import token_cache
+from .db_routers import pin_user
+from .mecache import me_cache
+from .models import AuthToken, CustomUser
+
+
+@receiver(post_delete, sender=AuthToken)
+def invalidate_cached_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=AuthToken)
+@receiver(post_delete, sender=AuthToken)
+def pin_token_user(sender, instance, **kwargs):
+    pin_user(instance.user_id)
+
+
+@receiver(post_delete, sender=AuthToken)
+def invalidate_cached_me(sender, instance, **kwargs):
+    me_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user_tokens(sender, instance, update_fields=None, **kwargs):
+    if update_fields and CustomUser.UNVERSIONED_FIELDS.issuperset(update_fields):
+        # update_last_login on each login: nothing cached shows last_login.
+        return
+    token_cache.invalidate_user(instance.pk)
+    me_cache.invalidate(instance.pk)
+    pin_user(instance.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def forget_other_user_copies(sender, instance, **kwargs):
+    # The remembered instance is stale once another copy was saved.
+    identity.forget(instance.pk, unless=instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def forget_deleted_user(sender, instance, **kwargs):
+    identity.forget(instance.pk)
+
+
+@receiver(post_migrate)
+def reserve_shard_id_ranges(sender, using, **kwargs):
+    if sender.name == 'profiles' and sharding.enabled() and using in sharding.SHARDS:
+        sharding.reserve_id_range(using, CustomUser._meta.db_table)
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+CONTENT_ADDRESSED_PREFIX = 'cas/'
+
+
+class MediaStorage(FileSystemStorage):
+    """
+    FileSystemStorage that stores content addressed names (see
+    profiles.models.content_address) once: saving a name that already exists
+    is a no-op instead of a renamed duplicate.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if name.startswith(CONTENT_ADDRESSED_PREFIX):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if not name.startswith(CONTENT_ADDRESSED_PREFIX):
+            return super()._save(name, content)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            return name
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        # Write aside and rename into place; concurrent writers of the same
+        # name carry the same bytes, so whichever rename lands last is fine.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp_path, self.file_permissions_mode)
+        os.replace(tmp_path, full_path)
+        return name
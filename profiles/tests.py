@@ -1,3 +1,1261 @@
-from django.test import TestCase
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from PIL import Image
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+
+from . import backends, benchmarks, db_routers, identity, images, metrics, schema, sharding
+from .authentication import token_cache
+from .bulk import import_users
+from .hashing import HashingExecutor, hashing_executor
+from .images import evict_variants, generate_variants, maybe_evict, variant_name
+from .log import BackgroundQueueHandler, RequestIDFilter, SamplingFilter
+from .mecache import me_cache
+from .models import AuthToken, CustomUser, OutboxMessage, media_shard
+from .outbox import claim_batch, deliver_batch, enqueue_mail
+from .parsers import FastJSONParser
+from .renderers import FastJSONRenderer
+from .serializers import UserRowSerializer, UserSerializer
+from .throttling import CacheWindows, Limiter, LocMemWindows, limiter
+from .tokens import default_token_generator
+from .uploadhandlers import ProfileImageUploadHandler
+from .urls import async_urlpatterns, router
+from .views import serve_media
+
+# URLconf with the async views in front, as asgi.py sets it up.
+urlpatterns = async_urlpatterns(router.urls) + [path('', include('customusers.urls'))]
+
+
+def token_client(user=None, key=None):
+    """
+    APIClient sending token `key`, or a new token of `user`.
+    """
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + (key or AuthToken.objects.create(user=user).key))
+    return client
+
+
+class TempMediaRootMixin:
+    """
+    Runs each test against an empty MEDIA_ROOT, `self.media_root`.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        cache.clear()
+        self.user = CustomUser.objects.create_user('cache@test.com', 'Str0ng-pass!')
+        self.token = AuthToken.objects.create(user=self.user)
+        self.client = token_client(key=self.token.key)
+
+    def test_repeat_requests_skip_token_lookup(self):
+        self.client.get('/users/me/')
+        # The `me` payload is cached too.
+        with self.assertNumQueries(0):
+            response = self.client.get('/users/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['content']['user'], 'cache@test.com')
+        self.assertEqual(token_cache.stats()['hits'], 1)
+
+    def test_logout_invalidates_cached_token(self):
+        self.client.get('/users/me/')
+        self.assertEqual(self.client.get('/users/logout/').status_code, 200)
+        self.assertEqual(token_cache.stats()['size'], 0)
+        self.assertEqual(self.client.get('/users/me/').status_code, 401)
+
+    def test_user_change_invalidates_cached_token(self):
+        self.client.get('/users/me/')
+        self.user.name = 'changed'
+        self.user.save()
+        self.assertEqual(token_cache.stats()['size'], 0)
+
+    def test_login_elsewhere_keeps_cached_token(self):
+        self.client.get('/users/me/')
+        response = APIClient().post('/users/login/', {'email': 'cache@test.com', 'password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(token_cache.stats()['size'], 1)
+        self.assertEqual(self.client.get('/users/me/').status_code, 200)
+        self.assertEqual(token_cache.stats()['hits'], 1)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        CustomUser.objects.create_user('reset@test.com', 'Str0ng-pass!')
+
+    def drain(self):
+        call_command('drain_outbox', workers=1, once=True, stdout=StringIO(), stderr=StringIO())
+
+    def test_forget_password_queues_instead_of_sending(self):
+        response = APIClient().post('/users/forget-password/', {'email': 'reset@test.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.STATUS_QUEUED)
+
+        self.drain()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['reset@test.com'])
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.STATUS_SENT)
+
+    def test_failed_delivery_is_rescheduled(self):
+        APIClient().post('/users/forget-password/', {'email': 'reset@test.com'})
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=OSError('connection refused')):
+            self.drain()
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.status, OutboxMessage.STATUS_QUEUED)
+        self.assertEqual(message.attempts, 1)
+        self.assertIn('connection refused', message.last_error)
+
+        # Not due yet, so a second pass leaves it alone.
+        self.drain()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_sent_messages_are_marked_when_reconnecting_fails(self):
+        for i in range(3):
+            enqueue_mail('Subject {0}'.format(i), 'Body', None, ['to{0}@test.com'.format(i)])
+        connection = mock.Mock()
+        connection.send_messages.side_effect = [1, OSError('connection reset'), 1]
+        connection.open.side_effect = OSError('connection refused')
+        with self.assertRaises(OSError):
+            deliver_batch(claim_batch(), connection)
+        statuses = list(OutboxMessage.objects.order_by('pk').values_list('status', 'attempts'))
+        self.assertEqual(statuses, [(OutboxMessage.STATUS_SENT, 0), (OutboxMessage.STATUS_QUEUED, 1),
+                                    (OutboxMessage.STATUS_SENDING, 0)])
+
+    def test_sent_messages_claimed_by_another_worker_are_left_alone(self):
+        enqueue_mail('Subject', 'Body', None, ['to@test.com'])
+        [message] = claim_batch()
+        connection = mock.Mock()
+
+        def send_messages(emails):
+            # The lease ran out mid-send and another worker claimed the row.
+            OutboxMessage.objects.filter(pk=message.pk).update(claimed_by='other')
+            return 1
+
+        connection.send_messages.side_effect = send_messages
+        self.assertEqual(deliver_batch([message], connection), 1)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.claimed_by), (OutboxMessage.STATUS_SENDING, 'other'))
+
+
+class HashingExecutorTests(TestCase):
+    register_data = {'email': 'new@test.com', 'name': 'New', 'password': 'Str0ng-pass!',
+                     're_password': 'Str0ng-pass!'}
+
+    def test_register_and_login_hash_on_executor(self):
+        completed = hashing_executor.stats()['completed']
+        self.assertEqual(APIClient().post('/users/register/', self.register_data).status_code, 201)
+        response = APIClient().post('/users/login/', {'email': 'new@test.com', 'password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(hashing_executor.stats()['completed'], completed + 2)
+        self.assertTrue(CustomUser.objects.get().check_password('Str0ng-pass!'))
+
+    def test_background_jobs_report_their_queue_wait(self):
+        executor = HashingExecutor(mode='thread', workers=1)
+        self.addCleanup(executor.shutdown)
+        release, results = threading.Event(), []
+        executor.run_later(release.wait, 5)
+        executor.run_later(str, 'queued', callback=results.append)
+        time.sleep(.1)
+        release.set()
+        for _ in range(100):
+            if results:
+                break
+            time.sleep(.01)
+        self.assertEqual(results, ['queued'])
+        stats = executor.stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertGreaterEqual(stats['queue_wait_max'], .1)
+
+    def test_saturated_executor_returns_503(self):
+        with mock.patch.object(hashing_executor._slots, 'acquire', return_value=False):
+            response = APIClient().post('/users/register/', self.register_data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(CustomUser.objects.exists())
+
+
+class BulkRegistrationTests(TestCase):
+    def setUp(self):
+        CustomUser.objects.create_user('taken@test.com', 'Str0ng-pass!')
+        staff = CustomUser.objects.create_user('staff@test.com', 'Str0ng-pass!', is_staff=True)
+        self.client = token_client(staff)
+
+    def test_bulk_endpoint_reports_bad_records_without_aborting(self):
+        records = [
+            {'email': 'one@test.com', 'name': 'One', 'password': 'Str0ng-pass!'},
+            {'email': 'taken@test.com', 'password': 'Str0ng-pass!'},
+            {'email': 'not-an-email', 'password': 'Str0ng-pass!'},
+            {'email': 'two@test.com', 'password': '123'},
+            {'email': 'one@test.com', 'password': 'Str0ng-pass!'},
+            {'email': 'three@test.com', 'password': 'Str0ng-pass!'},
+        ]
+        response = self.client.post('/users/register-bulk/', records, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 4))
+        self.assertEqual([e['row'] for e in response.data['errors']], [2, 3, 4, 1])
+        self.assertTrue(CustomUser.objects.get(email='three@test.com').check_password('Str0ng-pass!'))
+
+    def test_bulk_upload_rejects_unknown_format(self):
+        upload = SimpleUploadedFile('users.txt', b'email\n')
+        response = self.client.post('/users/register-bulk/', {'file': upload, 'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_upload_reports_rows_committed_before_a_read_error(self):
+        lines = [json.dumps({'email': 'user{0}@test.com'.format(i), 'password': 'Str0ng-pass!'}) for i in range(3)]
+        upload = SimpleUploadedFile('users.jsonl', '\n'.join(lines + ['{broken']).encode())
+        with mock.patch('profiles.views.import_users', side_effect=functools.partial(import_users, chunk_size=2)):
+            response = self.client.post('/users/register-bulk/', {'file': upload})
+        self.assertEqual(response.status_code, 400)
+        # The first chunk, and the row read into the second before the error.
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual(CustomUser.objects.filter(email__startswith='user').count(), 3)
+
+    def test_bulk_endpoint_is_staff_only(self):
+        response = APIClient().post('/users/register-bulk/', [], format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_import_command_streams_csv(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('email,name,password\n')
+            for i in range(25):
+                f.write('user{0}@test.com,User {0},Str0ng-pass!\n'.format(i))
+            f.write('taken@test.com,,Str0ng-pass!\n')
+        self.addCleanup(os.unlink, f.name)
+        errors = StringIO()
+        call_command('import_users', f.name, chunk_size=10, stdout=StringIO(), stderr=errors)
+        self.assertEqual(CustomUser.objects.filter(email__startswith='user').count(), 25)
+        self.assertEqual(json.loads(errors.getvalue())['row'], 25)
+
+
+class StaffListingTests(TestCase):
+    def setUp(self):
+        staff = CustomUser.objects.create_user('staff@test.com', 'Str0ng-pass!', is_staff=True)
+        CustomUser.objects.bulk_create([CustomUser(email='user{0}@test.com'.format(i)) for i in range(4)])
+        self.client = token_client(staff)
+
+    def test_me_pages_with_cursor(self):
+        emails = []
+        url = '/users/me/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            emails += [u['email'] for u in response.data['user']]
+            url = response.data['next']
+        self.assertEqual(emails, list(CustomUser.objects.order_by('id').values_list('email', flat=True)))
+
+    def test_export_streams_ndjson_and_csv(self):
+        response = self.client.get('/users/export/?type=ndjson')
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['email'], 'staff@test.com')
+
+        response = self.client.get('/users/export/?type=csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,email,profile_image,date_joined')
+        self.assertEqual(len(lines), 6)
+
+
+def png_upload(name='avatar.png', size=(300, 200)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageVariantTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('image@test.com', 'Str0ng-pass!')
+        self.client = token_client(self.user)
+
+    def upload(self):
+        data = {'email': self.user.email, 'profile_image': png_upload()}
+        response = self.client.patch('/users/{0}'.format(self.user.pk), data)
+        self.assertEqual(response.status_code, 202, response.data)
+        self.user.refresh_from_db()
+        return self.user.profile_image.name
+
+    def test_serializer_exposes_variant_urls(self):
+        name = self.upload()
+        variants = self.client.get('/users/me/').data['user'][0]['profile_image_variants']
+        self.assertEqual(sorted(variants, key=int), ['64', '128', '256'])
+        self.assertTrue(variants['64']['webp'].endswith('/media/' + variant_name(name, 64, 'webp')))
+
+    def test_missing_variant_is_generated_on_first_request(self):
+        name = self.upload()
+        path = variant_name(name, 128, 'webp')
+        response = serve_media(RequestFactory().get('/media/' + path), path)
+        self.assertEqual(response.status_code, 200)
+        with Image.open(os.path.join(self.media_root, path)) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (128, 128)))
+
+    def test_eviction_keeps_cache_under_budget(self):
+        generate_variants(self.upload())
+        self.assertGreater(evict_variants(max_bytes=0, root=self.media_root), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.user.profile_image.name)))
+
+    def test_eviction_only_walks_variant_directories(self):
+        generate_variants(self.upload())
+        walked = []
+
+        def walk(top, *args, **kwargs):
+            walked.append(os.path.relpath(top, self.media_root))
+            return real_walk(top, *args, **kwargs)
+
+        real_walk = os.walk
+        with mock.patch('profiles.images.os.walk', side_effect=walk):
+            evict_variants(max_bytes=0, root=self.media_root)
+        self.assertEqual(walked, [os.path.join(os.path.dirname(self.user.profile_image.name), 'variants')])
+
+    def test_eviction_runs_off_the_request_thread(self):
+        threads = []
+        with mock.patch.object(images, '_last_eviction', 0.0), mock.patch.object(images, 'EVICT_INTERVAL', 0), \
+                mock.patch.object(images, 'evict_variants', side_effect=lambda: threads.append(threading.get_ident())):
+            maybe_evict().result()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+
+class ProfileImageUploadTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user('upload@test.com', 'Str0ng-pass!')
+        self.client = token_client(self.user)
+
+    def patch(self, upload):
+        return self.client.patch('/users/{0}'.format(self.user.pk), {'email': self.user.email, 'profile_image': upload})
+
+    def test_fake_png_is_rejected(self):
+        response = self.patch(SimpleUploadedFile('avatar.png', b'GIF89a not really a png'))
+        self.assertEqual(response.status_code, 415)
+
+    def test_oversized_upload_is_rejected(self):
+        with override_settings(PROFILE_IMAGE_MAX_UPLOAD_SIZE=1024):
+            response = self.patch(SimpleUploadedFile('avatar.png', b'\x89PNG\r\n\x1a\n' + os.urandom(4096)))
+        self.assertEqual(response.status_code, 413)
+
+    def test_upload_losing_a_version_conflict_is_deleted(self):
+        def racing_write(request, user):
+            CustomUser.objects.get(pk=user.pk).save(update_fields=['name'])
+            return user.version
+
+        with mock.patch('profiles.views.if_match_version', side_effect=racing_write):
+            response = self.patch(png_upload())
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual([files for _, _, files in os.walk(self.media_root) if files], [])
+
+    def test_large_upload_spills_to_disk(self):
+        handler = ProfileImageUploadHandler(max_size=2 ** 20, memory_threshold=16)
+        handler.new_file('profile_image', 'avatar.png', 'image/png', None)
+        data = png_upload(size=(64, 64)).read()
+        handler.receive_data_chunk(data[:10], 0)
+        handler.receive_data_chunk(data[10:], 10)
+        upload = handler.file_complete(len(data))
+        self.assertTrue(hasattr(upload, 'temporary_file_path'))
+        self.assertEqual(upload.read(), data)
+
+
+class RehomeMediaTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+    def legacy_user(self, email):
+        user = CustomUser.objects.create_user(email, 'Str0ng-pass!')
+        name = '{0}/avatar.png'.format(user.pk)
+        os.makedirs(os.path.join(self.media_root, str(user.pk)))
+        with open(os.path.join(self.media_root, name), 'wb') as f:
+            f.write(png_upload().read())
+        CustomUser.objects.filter(pk=user.pk).update(profile_image=name)
+        return user
+
+    def test_new_uploads_use_sharded_layout(self):
+        user = CustomUser.objects.create_user('sharded@test.com', 'Str0ng-pass!')
+        user.profile_image = png_upload()
+        user.save()
+        self.assertEqual(user.profile_image.name, '{0}/{1}/avatar.png'.format(media_shard(user.pk), user.pk))
+
+    def test_dedupe_stores_identical_uploads_once(self):
+        with override_settings(PROFILE_IMAGE_DEDUPE=True):
+            names = []
+            for email in ('a@test.com', 'b@test.com'):
+                user = CustomUser.objects.create_user(email, 'Str0ng-pass!')
+                user.profile_image = png_upload()
+                user.save()
+                names.append(user.profile_image.name)
+        self.assertEqual(names[0], names[1])
+        self.assertTrue(names[0].startswith('cas/'))
+
+    def test_rehome_moves_files_and_resumes_from_checkpoint(self):
+        users = [self.legacy_user('legacy{0}@test.com'.format(i)) for i in range(3)]
+        call_command('rehome_media', batch_size=2, stdout=StringIO())
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(user.profile_image.name,
+                             '{0}/{1}/avatar.png'.format(media_shard(user.pk), user.pk))
+            self.assertTrue(os.path.exists(user.profile_image.path))
+            self.assertFalse(os.path.exists(os.path.join(self.media_root, str(user.pk), 'avatar.png')))
+            self.assertEqual(user.version, 1)
+
+        late = self.legacy_user('late@test.com')
+        out = StringIO()
+        call_command('rehome_media', stdout=out)
+        self.assertIn('1 moved', out.getvalue())
+        late.refresh_from_db()
+        self.assertTrue(late.profile_image.name.startswith(media_shard(late.pk)))
+
+
+class ConditionalGetTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.media_root, 'file.bin'), 'wb') as f:
+            f.write(bytes(range(256)) * 4)
+        cache.clear()
+        self.user = CustomUser.objects.create_user('etag@test.com', 'Str0ng-pass!')
+        self.client = token_client(self.user)
+
+    def serve(self, **headers):
+        return serve_media(RequestFactory().get('/media/file.bin', **headers), 'file.bin')
+
+    def test_media_revalidation_and_ranges(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        response = self.serve(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+        self.assertEqual(self.serve(HTTP_RANGE='bytes=-4')['Content-Range'], 'bytes 1020-1023/1024')
+        self.assertEqual(self.serve(HTTP_RANGE='bytes=2000-').status_code, 416)
+
+    def test_media_sendfile_offload(self):
+        with override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect'):
+            response = self.serve()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/file.bin')
+        self.assertEqual(response.content, b'')
+
+    def test_me_answers_304_until_user_changes(self):
+        etag = self.client.get('/users/me/')['ETag']
+        self.assertEqual(self.client.get('/users/me/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.user.name = 'changed'
+        self.user.save()
+        self.assertEqual(self.client.get('/users/me/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(metrics, 'enabled', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for metric in metrics.registry.metrics:
+            metric.clear()
+        user = CustomUser.objects.create_user('metrics@test.com', 'Str0ng-pass!')
+        self.client = token_client(user)
+
+    def test_actions_are_exported_in_prometheus_format(self):
+        self.client.get('/users/me/')
+        APIClient().post('/users/login/', {'email': 'metrics@test.com', 'password': 'Str0ng-pass!'})
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('profiles_request_duration_seconds_count{action="me",method="GET",status="200"} 1', body)
+        self.assertIn('profiles_request_db_queries_count{action="login"} 1', body)
+        self.assertIn('profiles_password_hash_duration_seconds_count{operation="check_password"} 1', body)
+        self.assertIn('profiles_token_cache_requests_total{result="miss"}', body)
+        self.assertIn('profiles_me_cache_hit_ratio', body)
+
+    def test_metrics_endpoint_is_hidden_when_disabled(self):
+        with mock.patch.object(metrics, 'enabled', False):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class StructuredLoggingTests(TestCase):
+    def test_records_are_written_as_json_with_request_id(self):
+        stream = StringIO()
+        handler = BackgroundQueueHandler(stream=stream)
+        handler.addFilter(RequestIDFilter())
+        logger = logging.getLogger('profiles')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        response = APIClient().post('/users/register/', HashingExecutorTests.register_data,
+                                    HTTP_X_REQUEST_ID='req-123')
+        handler.stop()
+        self.assertEqual(response['X-Request-ID'], 'req-123')
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        registered = [e for e in entries if e['message'].startswith('Registered user')]
+        self.assertEqual(len(registered), 1)
+        self.assertEqual(registered[0]['request_id'], 'req-123')
+        self.assertEqual(registered[0]['logger'], 'profiles.serializers')
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = BackgroundQueueHandler(stream=StringIO(), maxsize=1)
+        handler.stop()
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'message %d', 'args': (i,)}))
+        self.assertEqual(handler.dropped, 2)
+
+    def test_sampling_keeps_warnings(self):
+        sampler = SamplingFilter(rate=0)
+        self.assertFalse(sampler.filter(logging.makeLogRecord({'levelno': logging.DEBUG})))
+        self.assertTrue(sampler.filter(logging.makeLogRecord({'levelno': logging.WARNING})))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BenchmarkTests(TempMediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        benchmarks.seed_users(30)
+        self.ctx = benchmarks.Context(seed=1)
+
+    def test_every_route_is_driven_without_errors(self):
+        results = benchmarks.run_load(self.ctx, requests=2, warmup=0)
+        self.assertEqual(set(results), set(benchmarks.ROUTES))
+        for name, summary in results.items():
+            self.assertEqual((summary['count'], summary['errors']), (2, 0), name)
+            self.assertGreater(summary['queries_per_request'], 0, name)
+
+    def test_throttled_routes_run_past_their_rate(self):
+        routes = ['register', 'login', 'forget_password']
+        requests = max(limiter.rates[route]['ip'][0] for route in routes) + 5
+        limiter.clear()
+        self.addCleanup(limiter.clear)
+        with override_settings(**benchmarks.SETTINGS_OVERRIDES):
+            results = benchmarks.run_load(self.ctx, routes, requests=requests, warmup=0)
+        for name, summary in results.items():
+            self.assertEqual((summary['count'], summary['errors']), (requests, 0), name)
+
+    def test_budget_flags_regressions(self):
+        results = {'micro': benchmarks.run_micro(self.ctx, ['token_make', 'permission'], iterations=5, warmup=0)}
+        budget = benchmarks.make_budget(results)
+        self.assertEqual(benchmarks.check_budget(results, budget), [])
+        budget['micro.token_make.p99_ms'] = 0
+        budget['load.me.p99_ms'] = 10
+        self.assertEqual([v.split(':')[0] for v in benchmarks.check_budget(results, budget)],
+                         ['load.me.p99_ms', 'micro.token_make.p99_ms'])
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncViewTests(TransactionTestCase):
+    # The async views query from worker threads, which cannot see the
+    # uncommitted data of a TestCase transaction.
+    def setUp(self):
+        token_cache.clear()
+        cache.clear()
+        self.user = CustomUser.objects.create_user('async@test.com', 'Str0ng-pass!')
+        self.token = AuthToken.objects.create(user=self.user)
+        self.client = AsyncClient()
+
+    def get(self, path, **headers):
+        return async_to_sync(self.client.get)(path, **headers)
+
+    def test_me_matches_sync_view(self):
+        auth = {'authorization': 'Token ' + self.token.key}
+        response = self.get('/users/me/', **auth)
+        self.assertEqual(response.status_code, 200)
+        expected = APIClient().get('/users/me/', HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(response['ETag'], expected['ETag'])
+        self.assertTrue(response['X-Request-ID'])
+        self.assertEqual(self.get('/users/me/', if_none_match=response['ETag'], **auth).status_code, 304)
+
+        response = self.get('/users/me/')
+        self.assertEqual((response.status_code, response['WWW-Authenticate']), (401, 'Token'))
+
+    def test_logout_deletes_token(self):
+        auth = {'authorization': 'Token ' + self.token.key}
+        response = self.get('/users/logout/', **auth)
+        self.assertEqual(response.json(), {'result': 'successfully logged out'})
+        self.assertFalse(AuthToken.objects.exists())
+        self.assertEqual(self.get('/users/me/', **auth).status_code, 401)
+
+    def test_reset_page_and_form_fallback(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(has_requested_password_reset=True)
+        self.user.refresh_from_db()
+        url = '/users/reset-password/{0}/{1}/'.format(urlsafe_base64_encode(force_bytes(self.user.pk)),
+                                                     default_token_generator.make_token(self.user))
+        response = self.get(url)
+        self.assertContains(response, 'Reset Password')
+
+        response = async_to_sync(self.client.post)(url, 'password=Fresh-pass-1!&confirm_password=Fresh-pass-1!',
+                                                   content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'Password Updated')
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('Fresh-pass-1!'))
+
+    def test_export_streams_from_worker_threads(self):
+        # The test client reads streamed bodies itself; the ASGI handler
+        # iterates them on the event loop.
+        async def export(query, token):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/users/export/', 'query_string': query,
+                     'headers': [(b'authorization', 'Token {0}'.format(token).encode())]}
+            await ASGIHandler()(scope, receive, send)
+            return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+        staff = CustomUser.objects.create_user('staff@test.com', 'Str0ng-pass!', is_staff=True)
+        key = AuthToken.objects.create(user=staff).key
+        status_code, body = async_to_sync(export)(b'type=csv', key)
+        self.assertEqual(status_code, 200)
+        lines = body.decode().splitlines()
+        self.assertEqual(lines[0], 'id,email,profile_image,date_joined')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], ['async@test.com', 'staff@test.com'])
+        self.assertEqual(async_to_sync(export)(b'type=xml', key)[0], 400)
+        self.assertEqual(async_to_sync(export)(b'', self.token.key)[0], 403)
+
+
+class ExtraDatabaseMixin:
+    def add_database(self, alias, name):
+        connections.databases[alias] = dict(connections.databases['default'], NAME=name, TEST={})
+        connections.ensure_defaults(alias)
+        self.addCleanup(self.remove_database, alias)
+
+    def remove_database(self, alias):
+        connections[alias].close()
+        delattr(connections._connections, alias)
+        del connections.databases[alias]
+
+
+class ReplicaRoutingTests(ExtraDatabaseMixin, TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A migrated SQLite file, and one the health check cannot open.
+        self.add_database('replica_ok', os.path.join(directory.name, 'replica.sqlite3'))
+        self.add_database('replica_down', os.path.join(directory.name, 'missing', 'replica.sqlite3'))
+        call_command('migrate', database='replica_ok', verbosity=0)
+        replicas = mock.patch.object(db_routers.replicas, 'aliases', ['replica_ok', 'replica_down'])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+        db_routers.replicas.reset()
+        self.addCleanup(db_routers.replicas.reset)
+        cache.clear()
+        token_cache.clear()
+        CustomUser.objects.using('replica_ok').create(email='stale@test.com', name='Replica')
+
+    def test_reads_go_to_healthy_replica_until_request_writes(self):
+        with db_routers.request_scope():
+            self.assertTrue(CustomUser.objects.filter(email='stale@test.com').exists())
+            self.assertEqual(db_routers.replicas.stats(), {'replica_ok': True, 'replica_down': False})
+            CustomUser.objects.create_user('fresh@test.com', 'Str0ng-pass!')
+            self.assertFalse(CustomUser.objects.filter(email='stale@test.com').exists())
+            self.assertTrue(CustomUser.objects.filter(email='fresh@test.com').exists())
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        client = APIClient()
+        self.assertEqual(client.post('/users/register/', HashingExecutorTests.register_data).status_code, 201)
+        # Only on the primary: login and the first `me` fall back to it.
+        response = client.post('/users/login/', {'email': 'new@test.com', 'password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 202)
+        client.credentials(HTTP_AUTHORIZATION='Token ' + response.data['token'])
+        user = CustomUser.objects.using('default').get(email='new@test.com')
+        self.assertTrue(db_routers.is_pinned(user.pk))
+        self.assertEqual([u['email'] for u in client.get('/users/me/').data['user']], ['new@test.com'])
+
+        # Once the pin expires, reads are served by the replica again.
+        cache.clear()
+        self.assertEqual(client.get('/users/me/').data['user'], [])
+
+    def test_reset_link_reads_the_flag_just_set_on_the_primary(self):
+        user = CustomUser.objects.create_user('reset@test.com', 'Str0ng-pass!')
+        CustomUser.objects.using('replica_ok').create(pk=user.pk, email=user.email, password=user.password)
+        cache.clear()
+        self.assertEqual(APIClient().post('/users/forget-password/', {'email': 'reset@test.com'}).status_code, 200)
+        url = '/users/reset-password/{0}/{1}/'.format(sharding.encode_uid(user),
+                                                     default_token_generator.make_token(user))
+        self.assertTemplateUsed(APIClient().get(url), 'reset_password.html')
+
+
+class ShardingTests(ExtraDatabaseMixin, TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.add_database('shard1', os.path.join(directory.name, 'shard1.sqlite3'))
+        shards = mock.patch.object(sharding, 'SHARDS', ['default', 'shard1'])
+        shards.start()
+        self.addCleanup(shards.stop)
+        call_command('migrate', database='shard1', verbosity=0)
+        token_cache.clear()
+        cache.clear()
+
+    def email_on(self, alias):
+        return next(email for email in ('user{0}@test.com'.format(i) for i in range(100))
+                    if sharding.shard_for_email(email) == alias)
+
+    def test_users_live_on_the_shard_of_their_email(self):
+        email = self.email_on('shard1')
+        client = APIClient()
+        response = client.post('/users/register/', {'email': email, 'name': 'Sharded', 'password': 'Str0ng-pass!',
+                                                    're_password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 201)
+        user = CustomUser.objects.using('shard1').get(email=email)
+        self.assertGreater(user.pk, sharding.ID_SPAN)
+        self.assertFalse(CustomUser.objects.using('default').filter(email=email).exists())
+
+        response = client.post('/users/login/', {'email': email, 'password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data['token'].startswith('01'))
+        client.credentials(HTTP_AUTHORIZATION='Token ' + response.data['token'])
+        self.assertEqual([u['email'] for u in client.get('/users/me/').data['user']], [email])
+
+        self.assertEqual(client.post('/users/forget-password/', {'email': email}).status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.has_requested_password_reset)
+        self.assertEqual(sharding.decode_uid(sharding.encode_uid(user)), ('shard1', str(user.pk)))
+        url = '/users/reset-password/{0}/{1}/'.format(sharding.encode_uid(user),
+                                                      default_token_generator.make_token(user))
+        self.assertTemplateUsed(APIClient().get(url), 'reset_password.html')
+
+    def test_staff_listing_pages_through_the_shards(self):
+        staff = CustomUser.objects.create_user(self.email_on('default'), 'Str0ng-pass!', is_staff=True)
+        CustomUser.objects.create_user(self.email_on('shard1'), 'Str0ng-pass!')
+        client = APIClient()
+        client.force_authenticate(staff)
+        response = client.get('/users/me/')
+        self.assertEqual([u['email'] for u in response.data['user']], [staff.email])
+        response = client.get(response.data['next'])
+        self.assertEqual([u['email'] for u in response.data['user']], [self.email_on('shard1')])
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(client.get('/users/me/?shard=2').status_code, 400)
+
+    def test_rebalance_moves_users_and_tokens(self):
+        email = self.email_on('shard1')
+        # Registered before shard1 was added.
+        user = CustomUser.objects.using('default').create(email=email, name='Moved')
+        user.set_password('Str0ng-pass!')
+        user.save(using='default')
+        token = AuthToken.objects.using('default').create(user=user, key='ff' + '0' * 38)
+
+        call_command('rebalance_shards', stdout=StringIO())
+        call_command('rebalance_shards', stdout=StringIO())
+        self.assertFalse(CustomUser.objects.using('default').filter(email=email).exists())
+        self.assertEqual(CustomUser.objects.using('shard1').get(email=email).pk, user.pk)
+        self.assertEqual(AuthToken.objects.using('shard1').get(user_id=user.pk).key, token.key)
+
+        client = token_client(key=token.key)
+        self.assertEqual([u['email'] for u in client.get('/users/me/').data['user']], [email])
+        response = APIClient().post('/users/login/', {'email': email, 'password': 'Str0ng-pass!'})
+        self.assertTrue(response.data['token'].startswith('01'))
+
+
+class CanonicalEmailTests(TestCase):
+    def test_lookups_ignore_case(self):
+        CustomUser.objects.create_user('Mixed.Case@Test.com', 'Str0ng-pass!')
+        response = APIClient().post('/users/login/', {'email': 'mixed.case@test.COM', 'password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 202)
+        response = APIClient().post('/users/forget-password/', {'email': 'MIXED.CASE@TEST.COM'})
+        self.assertEqual(response.status_code, 200)
+        response = APIClient().post('/users/register/', {'email': 'mixed.case@test.com', 'password': 'Str0ng-pass!',
+                                                         're_password': 'Str0ng-pass!'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CanonicalEmailMigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate(target)
+        return executor.loader.project_state(target).apps
+
+    def test_backfill_parks_duplicates(self):
+        old_apps = self.migrate([('profiles', '0005_customuser_email_canonical'), ('authtoken', '0003_tokenproxy')])
+        User = old_apps.get_model('profiles', 'CustomUser')
+        older = User.objects.create(email='dup@test.com', password='x')
+        newer = User.objects.create(email='DUP@test.com', password='x', last_login=timezone.now())
+        Token = old_apps.get_model('authtoken', 'Token')
+        Token.objects.create(key='parked', user_id=older.pk)
+        Token.objects.create(key='kept', user_id=newer.pk)
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+        self.assertEqual(CustomUser.objects.get(pk=newer.pk).email_canonical, 'dup@test.com')
+        self.assertIsNone(CustomUser.objects.get(pk=older.pk).email_canonical)
+        self.assertEqual(list(AuthToken.objects.values_list('key', flat=True)), ['kept'])
+        self.assertEqual(CustomUser.objects.get_by_natural_key('Dup@Test.com').pk, newer.pk)
+
+
+class AuthTokenTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('devices@test.com', 'Str0ng-pass!')
+        token_cache.clear()
+        cache.clear()
+
+    def login(self):
+        response = APIClient().post('/users/login/', {'email': 'devices@test.com', 'password': 'Str0ng-pass!'},
+                                    HTTP_USER_AGENT='phone')
+        client = token_client(key=response.data['token'])
+        return client
+
+    def test_each_device_logs_out_on_its_own(self):
+        phone, laptop, tablet = self.login(), self.login(), self.login()
+        self.assertEqual(AuthToken.objects.filter(user=self.user, name='phone').count(), 3)
+        self.assertEqual(phone.get('/users/logout/').status_code, 200)
+        self.assertEqual(phone.get('/users/me/').status_code, 401)
+        self.assertEqual(laptop.get('/users/me/').status_code, 200)
+        self.assertEqual(laptop.get('/users/logout/?all=true').status_code, 200)
+        self.assertEqual(tablet.get('/users/me/').status_code, 401)
+        self.assertFalse(AuthToken.objects.exists())
+
+    def test_last_use_is_written_at_most_once_per_interval(self):
+        client = self.login()
+        client.get('/users/me/')
+        token = AuthToken.objects.get()
+        self.assertIsNotNone(token.last_used_at)
+        with self.assertNumQueries(0):
+            client.get('/users/me/')
+        self.assertEqual(AuthToken.objects.get().last_used_at, token.last_used_at)
+
+    @override_settings(TOKEN_LAST_USED_INTERVAL=0)
+    def test_touching_a_cached_token_keeps_its_expiry(self):
+        client = self.login()
+        with mock.patch('profiles.authentication.time') as clock:
+            clock.monotonic.return_value = 1000.0
+            self.assertEqual(client.get('/users/me/').status_code, 200)
+            # Another worker expires the token; this one only learns of it
+            # once its cached copy runs out.
+            AuthToken.objects.update(expires_at=timezone.now())
+            clock.monotonic.return_value += token_cache.ttl - 1
+            self.assertEqual(client.get('/users/me/').status_code, 200)
+            clock.monotonic.return_value += 2
+            self.assertEqual(client.get('/users/me/').status_code, 401)
+
+    def test_expired_tokens_are_rejected_and_purged(self):
+        client = self.login()
+        AuthToken.objects.update(expires_at=timezone.now())
+        token_cache.clear()
+        cache.clear()
+        self.assertEqual(client.get('/users/me/').status_code, 401)
+        self.login()
+
+        call_command('purge_tokens', batch_size=1, stdout=StringIO())
+        self.assertEqual(AuthToken.objects.count(), 1)
+        self.assertFalse(AuthToken.objects.get().is_expired)
+
+
+class MeCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        me_cache.reset_stats()
+        self.user = CustomUser.objects.create_user('cached@test.com', 'Str0ng-pass!')
+        self.token = AuthToken.objects.create(user=self.user)
+        self.client = token_client(key=self.token.key)
+
+    def emails(self):
+        return [u['email'] for u in self.client.get('/users/me/').data['user']]
+
+    def test_saves_invalidate_the_cached_payload(self):
+        first = self.client.get('/users/me/')
+        second = self.client.get('/users/me/')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(me_cache.stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+        CustomUser.objects.filter(pk=self.user.pk).update(email='stale@test.com')
+        self.assertEqual(self.emails(), ['cached@test.com'])
+        self.user.email = 'renamed@test.com'
+        self.user.save()
+        self.assertEqual(self.emails(), ['renamed@test.com'])
+
+    def test_token_deletion_invalidates_the_cached_payload(self):
+        self.emails()
+        other = AuthToken.objects.create(user=self.user)
+        other.delete()
+        self.assertIsNone(cache.get(me_cache.key(self.user.pk)))
+
+
+class FastJSONTests(TestCase):
+    def test_row_serializer_output_is_byte_compatible(self):
+        CustomUser.objects.create_user('plain@test.com', 'Str0ng-pass!')
+        user = CustomUser.objects.create_user('image@test.com', 'Str0ng-pass!')
+        CustomUser.objects.filter(pk=user.pk).update(email='ünï\u2028code@test.com',
+                                                      profile_image='ab/cd/{0}/my pic é.png'.format(user.pk))
+        request = Request(RequestFactory().get('/users/me/', HTTP_HOST='api.test'))
+        users = CustomUser.objects.order_by('id')
+
+        expected = JSONRenderer().render(UserSerializer(users, many=True, context={'request': request}).data)
+        rows = UserRowSerializer({'request': request}).many(users.values(*UserRowSerializer.VALUES))
+        self.assertEqual(FastJSONRenderer().render(rows), expected)
+        self.assertEqual(JSONRenderer().render(rows), expected)
+
+    def test_renderer_matches_drf_and_falls_back(self):
+        data = {'when': timezone.now(), 'text': 'line\u2029break', 'big': 2 ** 70, 1: [None, True, 1.5]}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+
+    def test_parser(self):
+        self.assertEqual(FastJSONParser().parse(BytesIO('{"a": [1, "é"]}'.encode())), {'a': [1, 'é']})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"a": NaN}'))
+
+
+class SchemaTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(schema, 'SCHEMA_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        schema.reset()
+        self.addCleanup(schema.reset)
+
+    def test_command_writes_artifact(self):
+        old = os.path.join(self.directory, 'openapi-v1-0000000000000000.json')
+        open(old, 'w').close()
+        with self.assertRaises(CommandError):
+            call_command('generate_schema', '--check', stdout=StringIO())
+
+        call_command('generate_schema', stdout=StringIO())
+        call_command('generate_schema', '--check', stdout=StringIO())
+        self.assertFalse(os.path.exists(old))
+        with open(schema.artifact_path(), 'rb') as f:
+            spec = json.loads(f.read())
+        self.assertIn('/users/login/', spec['paths'])
+
+    def test_swagger_serves_artifact(self):
+        schema.write(b'{"swagger": "2.0"}', schema.artifact_path())
+        with mock.patch.object(schema, 'generate') as generate:
+            response = self.client.get('/swagger/?format=openapi')
+            self.assertEqual(response.content, b'{"swagger": "2.0"}')
+            self.assertIn('max-age={0}'.format(schema.MAX_AGE), response['Cache-Control'])
+            response = self.client.get('/swagger/?format=openapi', HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+        generate.assert_not_called()
+
+    def test_missing_artifact_is_generated_once(self):
+        with mock.patch.object(schema, 'generate', wraps=schema.generate) as generate:
+            self.assertEqual(self.client.get('/swagger/?format=openapi').status_code, 200)
+            self.assertEqual(self.client.get('/swagger/?format=openapi').status_code, 200)
+        self.assertEqual(generate.call_count, 1)
+        self.assertTrue(os.path.exists(schema.artifact_path()))
+
+
+class PasswordResetTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('reset@test.com', 'Str0ng-pass!')
+        self.client = APIClient()
+
+    def reset_path(self, user, token=None):
+        return '/users/reset-password/{0}/{1}/'.format(sharding.encode_uid(user),
+                                                       token or default_token_generator.make_token(user))
+
+    def test_forget_password_flags_user_in_one_query(self):
+        self.client.post('/users/forget-password/', {'email': 'nobody@test.com'})
+        with self.assertNumQueries(1), mock.patch('profiles.views.enqueue_mail'):
+            response = self.client.post('/users/forget-password/', {'email': 'RESET@test.com'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.has_requested_password_reset)
+        with self.assertNumQueries(1):
+            self.assertIsNone(CustomUser.objects.flag_password_reset('nobody@test.com'))
+
+    def test_forged_and_expired_links_need_no_query(self):
+        token = default_token_generator.make_token(self.user)
+        ts_b36, signature, state = token.split('-')
+        forged = '{0}-{1}-{2}'.format(ts_b36, signature[::-1], state)
+        other_user = '/users/reset-password/{0}/{1}/'.format(urlsafe_base64_encode(force_bytes(self.user.pk + 1)),
+                                                            token)
+        with self.assertNumQueries(0):
+            for path in (self.reset_path(self.user, forged), self.reset_path(self.user, 'garbage'), other_user,
+                         '/users/reset-password/-x-/{0}/'.format(token)):
+                self.assertTemplateUsed(self.client.get(path), 'error_password.html')
+        with override_settings(PASSWORD_RESET_TIMEOUT=-1), self.assertNumQueries(0):
+            self.assertIsNone(default_token_generator.prevalidate(self.user.pk, token))
+
+    def test_token_is_bound_to_password_and_last_login(self):
+        token = default_token_generator.make_token(self.user)
+        self.assertTrue(default_token_generator.check_token(self.user, token))
+        self.user.last_login = timezone.now()
+        self.assertFalse(default_token_generator.check_token(self.user, token))
+
+        token = default_token_generator.make_token(self.user)
+        self.user.save()
+        path = self.reset_path(self.user, token)
+        response = self.client.post(path, 'password=Fresh-pass-1!&confirm_password=Fresh-pass-1!',
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'Password Updated')
+        response = self.client.post(path, 'password=Other-pass-2!&confirm_password=Other-pass-2!',
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'invalid token')
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('Fresh-pass-1!'))
+
+
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        limiter.clear()
+        self.addCleanup(limiter.clear)
+        CustomUser.objects.create_user('throttled@test.com', 'Str0ng-pass!')
+
+    def test_login_burst_rejected_before_hashing_or_queries(self):
+        rates = {'login': {'ip': '100/min', 'email': '3/min'}}
+        with mock.patch.object(limiter, 'rates', Limiter(limiter.windows, rates).rates):
+            for _ in range(3):
+                self.assertNotEqual(APIClient().post('/users/login/', {'email': 'THROTTLED@test.com',
+                                                                      'password': 'wrong'}).status_code, 429)
+            with self.assertNumQueries(0), mock.patch.object(hashing_executor, 'check_password') as check:
+                response = APIClient().post('/users/login/', {'email': 'throttled@test.com', 'password': 'wrong'})
+            check.assert_not_called()
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response)
+            self.assertNotEqual(APIClient().post('/users/login/', {'email': 'other@test.com',
+                                                                  'password': 'wrong'}).status_code, 429)
+        self.assertEqual(limiter.stats()['rejected'], {'login': 1})
+        self.assertIn('profiles_throttle_requests_total{result="rejected",scope="login"} 1', metrics.registry.render())
+
+    def test_windows_slide(self):
+        for windows in (LocMemWindows(max_keys=2), CacheWindows('default')):
+            limiter = Limiter(windows, {'login': {'ip': '4/min'}})
+            keys = [('ip', '10.0.0.1'), ('email', 'ignored@test.com')]
+            self.assertEqual([limiter.check('login', keys, now=60 * 100 + t) for t in range(5)][:4], [0] * 4)
+            self.assertTrue(limiter.check('login', keys, now=60 * 100 + 59))
+            # Half of the previous window still counts: 2 of 4.
+            self.assertEqual([bool(limiter.check('login', keys, now=60 * 101 + 30)) for _ in range(3)],
+                             [False, False, True])
+            self.assertEqual(limiter.check('login', keys, now=60 * 103), 0)
+        windows = LocMemWindows(max_keys=2)
+        limiter = Limiter(windows, {'login': {'ip': '4/min'}})
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            limiter.check('login', [('ip', ip)])
+        self.assertEqual(limiter.stats()['size'], 2)
+
+
+class HasherCalibrationTests(TransactionTestCase):
+    def test_calibrate_hasher_configures_hasher(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'hasher.json')
+            call_command('calibrate_hasher', target_ms=1, min_iterations=3000, samples=1, workers=1, output=path,
+                         stdout=StringIO(), stderr=StringIO())
+            with open(path) as f:
+                iterations = json.load(f)['iterations']
+            self.assertGreaterEqual(iterations, 3000)
+            with override_settings(PASSWORD_HASH_ITERATIONS=0, PASSWORD_HASH_CALIBRATION_FILE=path):
+                self.assertTrue(make_password('secret').startswith('pbkdf2_sha256${0}$'.format(iterations)))
+
+    def watch_rehash(self):
+        """
+        An Event set once the background rehash of a login is through.
+        Waiting on it rather than polling keeps the test off the table while
+        the worker writes, which SQLite's shared cache test database would
+        fail with 'table is locked'.
+        """
+        done, rehash_password = threading.Event(), backends.rehash_password
+
+        def rehash_and_signal(*args, **kwargs):
+            try:
+                rehash_password(*args, **kwargs)
+            finally:
+                done.set()
+
+        patcher = mock.patch('profiles.backends.rehash_password', rehash_and_signal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return done
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_login_rehashes_outdated_hash_in_background(self):
+        user = CustomUser.objects.create_user('rehash@test.com', 'Str0ng-pass!')
+        old = user.password
+        release, rehashed = threading.Event(), self.watch_rehash()
+
+        def slow_make_password(password):
+            release.wait(5)
+            return make_password(password)
+
+        # The slow hash is a local function, which only a thread pool can run.
+        executor = HashingExecutor(mode='thread', workers=1)
+        self.addCleanup(executor.shutdown)
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000), \
+                mock.patch('profiles.backends.hashing_executor', executor), \
+                mock.patch('profiles.backends.make_password', slow_make_password):
+            response = APIClient().post('/users/login/', {'email': 'rehash@test.com', 'password': 'Str0ng-pass!'})
+            self.assertEqual(response.status_code, 202)
+            user.refresh_from_db()
+            self.assertEqual(user.password, old)
+            release.set()
+            self.assertTrue(rehashed.wait(5))
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+        self.assertEqual(user.version, 1)
+        self.assertTrue(user.check_password('Str0ng-pass!'))
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_login_rehashes_in_process_mode(self):
+        user = CustomUser.objects.create_user('process@test.com', 'Str0ng-pass!')
+        rehashed = self.watch_rehash()
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000):
+            executor = HashingExecutor(mode='process', workers=1)
+            self.addCleanup(executor.shutdown)
+            with mock.patch('profiles.backends.hashing_executor', executor):
+                response = APIClient().post('/users/login/', {'email': 'process@test.com', 'password': 'Str0ng-pass!'})
+            self.assertEqual(response.status_code, 202)
+            self.assertTrue(rehashed.wait(5))
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+        self.assertTrue(user.check_password('Str0ng-pass!'))
+        # check_password, then the rehash.
+        self.assertEqual(executor.stats()['completed'], 2)
+
+
+class TargetedWriteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create_user('writer@test.com', 'Str0ng-pass!', name='Writer')
+        self.client = token_client(self.user)
+        self.path = '/users/{0}'.format(self.user.pk)
+
+    def user_updates(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE "profiles_customuser"')]
+
+    def test_patch_writes_only_submitted_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.path, {'email': 'Renamed@test.com'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['ETag'], '"1"')
+        [update] = self.user_updates(queries)
+        self.assertEqual(update.split(' WHERE ')[0].count(' = '), 4)
+        for column in ('"email"', '"email_canonical"', '"updated_at"', '"version"'):
+            self.assertIn(column, update)
+
+        # Against a full-row save of the same change.
+        self.user.refresh_from_db()
+        with CaptureQueriesContext(connection) as queries:
+            self.user.save()
+        [full] = self.user_updates(queries)
+        self.assertGreater(full.split(' WHERE ')[0].count(' = '), 10)
+        self.assertLess(len(update.split(' WHERE ')[0]), len(full.split(' WHERE ')[0]) / 2)
+        self.assertEqual(self.user.version, 2)
+
+    def test_if_match(self):
+        response = self.client.patch(self.path, {'email': 'a@test.com'}, HTTP_IF_MATCH='"7"')
+        self.assertEqual(response.status_code, 412)
+        response = self.client.patch(self.path, {'email': 'b@test.com'}, HTTP_IF_MATCH='W/"0"')
+        self.assertEqual(response.status_code, 412)
+        response = self.client.patch(self.path, {'email': 'c@test.com'}, HTTP_IF_MATCH='"0"')
+        self.assertEqual(response.status_code, 202)
+        etag = response['ETag']
+        response = self.client.patch(self.path, {'email': 'd@test.com'}, HTTP_IF_MATCH='"0"')
+        self.assertEqual(response.status_code, 412)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.email, self.user.version), ('c@test.com', 1))
+        response = self.client.patch(self.path, {'email': 'e@test.com'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 202)
+
+    def test_version_is_not_in_the_user_payload(self):
+        self.client.patch(self.path, {'email': 'versioned@test.com'})
+        [data] = self.client.get('/users/me/').data['user']
+        self.assertNotIn('version', data)
+
+    def test_concurrent_write_is_not_clobbered(self):
+        def racing_write(request, user):
+            # Lands between reading the row and writing it back.
+            CustomUser.objects.get(pk=user.pk).save(update_fields=['name'])
+            return user.version
+
+        with mock.patch('profiles.views.if_match_version', side_effect=racing_write):
+            response = self.client.patch(self.path, {'email': 'lost@test.com'})
+        self.assertEqual(response.status_code, 412)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.email, self.user.version), ('writer@test.com', 1))
+
+    def test_login_and_reset_write_their_columns_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            APIClient().post('/users/login/', {'email': 'writer@test.com', 'password': 'Str0ng-pass!'})
+        [login] = self.user_updates(queries)
+        self.assertEqual(login.split(' WHERE ')[0].count(' = '), 1)
+
+        user = CustomUser.objects.get(pk=self.user.pk)
+        path = '/users/reset-password/{0}/{1}/'.format(sharding.encode_uid(user),
+                                                       default_token_generator.make_token(user))
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().post(path, 'password=Fresh-pass-1!&confirm_password=Fresh-pass-1!',
+                                        content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'Password Updated')
+        [reset] = self.user_updates(queries)
+        self.assertNotIn('"email"', reset)
+        self.assertIn('"has_requested_password_reset"', reset)
+        self.assertEqual(CustomUser.objects.get(pk=user.pk).version, 1)
+
+
+class IdentityMapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.user = CustomUser.objects.create_user('identity@test.com', 'Str0ng-pass!')
+        self.client = token_client(self.user)
+
+    def user_reads(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('SELECT') and '"profiles_customuser"' in q['sql']]
+
+    def clear_caches(self, token_cached):
+        if not token_cached:
+            token_cache.clear()
+        cache.clear()
+
+    def test_one_user_query_per_request(self):
+        for token_cached in (False, True):
+            self.clear_caches(token_cached)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.patch('/users/{0}'.format(self.user.pk), {'email': 'identity@test.com'})
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(len(self.user_reads(queries)), 1, ('patch', token_cached))
+
+            self.clear_caches(token_cached)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/users/me/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(self.user_reads(queries)), 1, ('me', token_cached))
+
+    def test_other_users_are_still_looked_up(self):
+        other = CustomUser.objects.create_user('other@test.com', 'Str0ng-pass!')
+        response = self.client.patch('/users/{0}'.format(other.pk), {'email': 'other@test.com'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_nothing_is_remembered_outside_a_request(self):
+        self.assertIs(identity.remember(self.user), self.user)
+        self.assertIsNone(identity.get(self.user.pk))
+        with identity.request_scope():
+            identity.remember(self.user)
+            self.assertIs(identity.get(str(self.user.pk)), self.user)
+            CustomUser.objects.get(pk=self.user.pk).save(update_fields=['name'])
+            self.assertIsNone(identity.get(self.user.pk))
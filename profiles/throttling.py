@@ -0,0 +1,234 @@
+"""
+Sliding window rate limits on the actions anyone can call without a token
+(login, register, forget_password), per client IP and per canonical email.
+UserViewSet checks them before the view runs, so a rejected request costs
+no password hashing, query or mail.
+
+Windows are sliding window counters: each key keeps the number of hits in
+the current and the previous fixed window, and the previous one counts for
+the part of it the sliding window still covers. THROTTLE_BACKEND picks
+where they live: 'locmem' keeps them in process memory, 'cache' in the
+Django cache named by THROTTLE_CACHE_ALIAS, shared by every worker using it.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .models import canonical_email
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    (hits, seconds) from a DRF style rate such as '10/min'.
+    """
+    hits, period = rate.split('/')
+    return int(hits), DURATIONS[period[0]]
+
+
+def estimate(previous, current, now, period):
+    return previous * (1 - (now % period) / period) + current
+
+
+def retry_after(previous, current, now, period, limit):
+    """
+    Seconds until the previous window's weight drops enough to let one more
+    hit in, or until the current window ends.
+    """
+    remaining = period - now % period
+    if current >= limit or not previous:
+        return remaining
+    # previous * (1 - t / period) + current <= limit - 1
+    return max(0.0, min(remaining, period * (1 - (limit - 1 - current) / previous) - now % period))
+
+
+class LocMemWindows:
+    """
+    Per-key [window index, previous count, current count] in an LRU map of
+    at most `max_keys` keys.
+    """
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, period, now):
+        """
+        Count a hit on `key` unless that takes it over `limit` hits per
+        `period`. Returns 0 when counted, the seconds to wait otherwise.
+        """
+        index = int(now // period)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window[0] < index - 1:
+                window = [index, 0, 0]
+            elif window[0] == index - 1:
+                window = [index, window[2], 0]
+            if estimate(window[1], window[2], now, period) + 1 > limit:
+                wait = retry_after(window[1], window[2], now, period, limit)
+            else:
+                window[2] += 1
+                wait = 0
+            self._windows[key] = window
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+    def size(self):
+        return len(self._windows)
+
+
+class CacheWindows:
+    """
+    Per-key counters in a Django cache, one entry per fixed window. Two
+    workers racing on the same key may both get the last hit in.
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.max_keys = None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def cache_key(self, key, index):
+        # Emails are not safe memcached keys.
+        return 'throttle:{0}:{1}'.format(hashlib.md5(key.encode()).hexdigest(), index)
+
+    def hit(self, key, limit, period, now):
+        index = int(now // period)
+        current_key, previous_key = self.cache_key(key, index), self.cache_key(key, index - 1)
+        counts = self.cache.get_many([current_key, previous_key])
+        previous, current = counts.get(previous_key, 0), counts.get(current_key, 0)
+        if estimate(previous, current, now, period) + 1 > limit:
+            return retry_after(previous, current, now, period, limit)
+        # Kept through the next window, where it is the previous one.
+        if not self.cache.add(current_key, 1, 2 * period):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr().
+                self.cache.add(current_key, 1, 2 * period)
+        return 0
+
+    def clear(self):
+        # Entries expire on their own; the cache may be shared.
+        pass
+
+    def size(self):
+        return None
+
+
+class Limiter:
+    def __init__(self, windows, rates):
+        self.windows = windows
+        self.rates = {scope: {kind: parse_rate(rate) for kind, rate in limits.items()}
+                      for scope, limits in rates.items()}
+        self._lock = threading.Lock()
+        self.allowed = {}
+        self.rejected = {}
+
+    def check(self, scope, keys, now=None):
+        """
+        Count a hit of `scope` for each (kind, value) of `keys`, e.g.
+        ('ip', '10.0.0.1'). Returns 0 when every limit let it in, the
+        longest wait otherwise. Kinds without a rate are ignored.
+        """
+        now = time.time() if now is None else now
+        wait = 0
+        for kind, value in keys:
+            if value is None or kind not in self.rates.get(scope, {}):
+                continue
+            limit, period = self.rates[scope][kind]
+            wait = max(wait, self.windows.hit('{0}:{1}:{2}'.format(scope, kind, value), limit, period, now))
+            if wait:
+                # Later keys are not charged for a rejected request.
+                break
+        with self._lock:
+            counts = self.rejected if wait else self.allowed
+            counts[scope] = counts.get(scope, 0) + 1
+        return wait
+
+    def clear(self):
+        self.windows.clear()
+        with self._lock:
+            self.allowed.clear()
+            self.rejected.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'allowed': dict(self.allowed),
+                'rejected': dict(self.rejected),
+                'size': self.windows.size(),
+                'max_size': self.windows.max_keys,
+            }
+
+
+def make_windows(backend):
+    if backend == 'cache':
+        return CacheWindows(getattr(settings, 'THROTTLE_CACHE_ALIAS', 'default'))
+    if backend == 'locmem':
+        return LocMemWindows(getattr(settings, 'THROTTLE_LOCMEM_MAX_KEYS', 100000))
+    raise ValueError('Unknown THROTTLE_BACKEND {0!r}, use locmem or cache'.format(backend))
+
+
+limiter = Limiter(
+    windows=make_windows(getattr(settings, 'THROTTLE_BACKEND', 'locmem')),
+    rates=getattr(settings, 'THROTTLE_RATES', {}),
+)
+
+
+@metrics.registry.register_collector
+def collect_throttle_stats():
+    stats = limiter.stats()
+    scopes = sorted(set(stats['allowed']) | set(stats['rejected']))
+    collected = [
+        ('profiles_throttle_requests_total', 'counter', 'Throttled action requests by result.',
+         [({'scope': scope, 'result': result}, stats[result].get(scope, 0))
+          for scope in scopes for result in ('allowed', 'rejected')]),
+    ]
+    if stats['size'] is not None:
+        collected += [
+            ('profiles_throttle_keys', 'gauge', 'Keys tracked by the in-memory limiter.', [({}, stats['size'])]),
+            ('profiles_throttle_occupancy', 'gauge', 'Share of the in-memory limiter capacity in use.',
+             [({}, stats['size'] / stats['max_size'] if stats['max_size'] else 0.0)]),
+        ]
+    return collected
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Applies `limiter` to the view's action, keyed by client IP and by the
+    canonical form of the posted email. Actions without THROTTLE_RATES pass.
+    """
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'action', None)
+        if not getattr(settings, 'THROTTLE_ENABLED', True) or scope not in limiter.rates:
+            return True
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        keys = [('ip', self.get_ident(request)),
+                ('email', canonical_email(email) if isinstance(email, str) and email else None)]
+        self.wait_seconds = limiter.check(scope, keys)
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
@@ -1,10 +1,58 @@
+import logging
+
+from django.conf import settings
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int
+
+logger = logging.getLogger(__name__)
 
 
 class CustomPasswordResetTokenGenerator(PasswordResetTokenGenerator):
+    """
+    Tokens read <timestamp>-<link signature>-<state hash>. The link signature
+    only covers the user id and the timestamp, so `prevalidate` rejects
+    forged and expired links without a query. The state hash covers the
+    password hash and last login, so a token stops working once it was used
+    or the user logged in again.
+    """
+    link_key_salt = PasswordResetTokenGenerator.key_salt + '.link'
+
+    def check_token(self, user, token):
+        if not (user and token):
+            return False
+        timestamp = self.prevalidate(user.pk, token)
+        return timestamp is not None and constant_time_compare(self._make_token_with_timestamp(user, timestamp), token)
+
+    def prevalidate(self, pk, token):
+        """
+        The timestamp of `token` if it was made for the user `pk` and has not
+        expired, None otherwise. Needs no database access.
+        """
+        try:
+            ts_b36, signature, _ = token.split('-')
+            timestamp = base36_to_int(ts_b36)
+        except ValueError:
+            return None
+        if not constant_time_compare(self._link_signature(pk, timestamp), signature):
+            return None
+        if self._num_seconds(self._now()) - timestamp > settings.PASSWORD_RESET_TIMEOUT:
+            return None
+        return timestamp
+
+    def _link_signature(self, pk, timestamp):
+        return salted_hmac(self.link_key_salt, '{0}|{1}'.format(pk, timestamp), secret=self.secret,
+                           algorithm=self.algorithm).hexdigest()[::4]
+
+    def _make_token_with_timestamp(self, user, timestamp, legacy=False):
+        ts_b36, state_hash = super()._make_token_with_timestamp(user, timestamp, legacy).split('-')
+        return '{0}-{1}-{2}'.format(ts_b36, self._link_signature(user.pk, timestamp), state_hash)
+
     def _make_hash_value(self, user, timestamp):
-        print('called')
-        return str(timestamp)
+        logger.debug('Hashing reset token for user %s', user.pk)
+        # Microseconds are dropped, not every database keeps them.
+        login_timestamp = '' if user.last_login is None else user.last_login.replace(microsecond=0, tzinfo=None)
+        return '{0}{1}{2}{3}'.format(user.pk, user.password, login_timestamp, timestamp)
 
 
 default_token_generator = CustomPasswordResetTokenGenerator()
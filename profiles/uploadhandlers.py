@@ -0,0 +1,89 @@
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .exceptions import UnsupportedImageType, UploadTooLarge
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+SNIFF_BYTES = max(len(signature) for signature, _ in IMAGE_SIGNATURES)
+# Room for the multipart boundaries and the other form fields.
+FORM_OVERHEAD = 64 * 1024
+
+
+def sniff_image_type(header):
+    for signature, content_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    return None
+
+
+class ProfileImageUploadHandler(FileUploadHandler):
+    """
+    Validates profile image uploads while they stream in: the request is
+    refused as soon as it runs past the size cap or its first bytes are not
+    a JPEG or PNG signature. Small files stay in memory, larger ones spill
+    to a temporary file.
+    """
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, request=None, max_size=None, memory_threshold=None):
+        super().__init__(request)
+        self.max_size = max_size or getattr(settings, 'PROFILE_IMAGE_MAX_UPLOAD_SIZE', 5 * 2 ** 20)
+        self.memory_threshold = memory_threshold or getattr(settings, 'PROFILE_IMAGE_MEMORY_THRESHOLD',
+                                                            256 * 2 ** 10)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > self.max_size + FORM_OVERHEAD:
+            raise UploadTooLarge()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.size = 0
+        self.header = b''
+        self.file = BytesIO()
+        self.spilled = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if len(self.header) < SNIFF_BYTES:
+            self.header += raw_data[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= SNIFF_BYTES:
+                self.check_header()
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            raise UploadTooLarge()
+        if not self.spilled and self.size > self.memory_threshold:
+            spilled = TemporaryUploadedFile(self.file_name, self.content_type, 0, self.charset,
+                                            self.content_type_extra)
+            spilled.write(self.file.getvalue())
+            self.file, self.spilled = spilled, True
+        self.file.write(raw_data)
+        # Consumed here, later handlers never see the data.
+        return None
+
+    def check_header(self):
+        content_type = sniff_image_type(self.header)
+        if content_type is None:
+            raise UnsupportedImageType()
+        self.content_type = content_type
+
+    def file_complete(self, file_size):
+        if len(self.header) < SNIFF_BYTES:
+            self.check_header()
+        self.file.seek(0)
+        if self.spilled:
+            self.file.size = file_size
+            return self.file
+        return InMemoryUploadedFile(
+            file=self.file,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
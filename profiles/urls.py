@@ -1,26 +1,13 @@
+import re
+
 from django.conf import settings
 from django.conf.urls import url
-from django.conf.urls.static import static
-from django.urls import path, re_path, include
-from drf_yasg import openapi
-from drf_yasg.views import get_schema_view
-from rest_framework import permissions
+from django.urls import path, re_path
 from rest_framework.routers import SimpleRouter, Route, DynamicRoute
 
-from .views import UserViewSet
-
-schema_view = get_schema_view(
-    openapi.Info(
-        title="Profile API",
-        default_version="v1",
-        description="Getting image absolute URL",
-        terms_of_service="https://www.google.com/policies/terms/",
-        contact=openapi.Contact(email="contact@test.com"),
-        license=openapi.License(name="BSD License"),
-    ),
-    public=True,
-    permission_classes=(permissions.AllowAny,),
-)
+from .asyncviews import export_view, logout_view, me_view, reset_password_view
+from .schema import schema_view
+from .views import UserViewSet, metrics_view, serve_media
 
 
 class CustomUserRouter(SimpleRouter):
@@ -46,11 +33,34 @@ router.register('users', UserViewSet, basename='users')
 
 
 urlpatterns = [
-    url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    url(r'^swagger/$', schema_view.with_ui('swagger'), name='schema-swagger-ui'),
+    path('metrics', metrics_view, name='metrics'),
     # path('', include((router.urls, 'customusers'), namespace='users')),
 ]
 
 urlpatterns += router.urls
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+def async_urlpatterns(patterns):
+    """
+    Async views for `me`, `logout`, `export` and the reset password page,
+    each falling back to the viewset view found in `patterns` for what it
+    does not handle.
+    """
+    sync_views = {p.name: p.callback for p in patterns if getattr(p, 'name', None)}
+    return [
+        re_path(r'^users/me/$', me_view(sync_views['users-me']), name='users-me-async'),
+        re_path(r'^users/logout/$', logout_view(sync_views['users-logout']), name='users-logout-async'),
+        re_path(r'^users/export/$', export_view(sync_views['users-export']), name='users-export-async'),
+        re_path(r'^users/reset-password/(?P<uid>[\w-]+)/(?P<token>[\w-]+)/$',
+                reset_password_view(sync_views['users-reset-password']), name='users-reset-password-async'),
+    ]
+
+
+if getattr(settings, 'ASYNC_USER_VIEWS', False):
+    urlpatterns = async_urlpatterns(router.urls) + urlpatterns
+
+if getattr(settings, 'SERVE_MEDIA', settings.DEBUG):
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media),
+    ]
@@ -1,44 +1,270 @@
-import smtplib
+import hashlib
+import logging
+import posixpath
 
 from django.conf import settings
 from django.contrib.auth.models import update_last_login
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import send_mail
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse
 from django.template.loader import render_to_string
-from django.utils.encoding import force_bytes, force_text
-from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_etags, quote_etag
 from rest_framework import status
 from rest_framework import viewsets
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import FormParser, MultiPartParser
-from rest_framework.renderers import TemplateHTMLRenderer
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
-from .models import CustomUser
+from . import identity, metrics, sharding
+from .authentication import CachedTokenAuthentication, token_cache
+from .bulk import FORMATS, ImportInterrupted, guess_format, import_users, read_records
+from .db_routers import pin_user, primary_fallback, read_after_write, use_primary
+from .exceptions import PreconditionFailed
+from .export import EXPORTERS, export_response
+from .images import generate_variant, parse_variant_name, touch
+from .media import serve_file
+from .mecache import me_cache
+from .models import AuthToken, CustomUser, VersionConflict, canonical_email
+from .outbox import enqueue_mail
+from .pagination import UserCursorPagination
+from .parsers import FastJSONParser
+from .renderers import FastJSONRenderer, TimedTemplateHTMLRenderer
 from .permissions import UserAccessPermission
-from .serializers import RegisterSerializer, LoginSerializer, UserSerializer, PasswordSerializer, \
-    ResetPasswordSerializer
+from .serializers import RegisterSerializer, BulkRegisterSerializer, LoginSerializer, UserSerializer, \
+    PasswordSerializer, ResetPasswordSerializer, UserRowSerializer
+from .throttling import SlidingWindowThrottle
 from .tokens import default_token_generator
+from .uploadhandlers import ProfileImageUploadHandler
+
+logger = logging.getLogger(__name__)
+
+
+def user_versions(rows):
+    return ['{0}:{1}'.format(row['id'], row['updated_at'].isoformat()) for row in rows]
+
+
+def users_etag(request, versions):
+    """
+    Weak ETag for a `me` payload: it changes whenever one of the listed users
+    is saved (see `user_versions`), and with anything else that shows up in
+    the response.
+    """
+    parts = [request.get_host(), str(request.auth), request.get_full_path(), ','.join(UserSerializer.Meta.fields)]
+    parts += versions
+    return 'W/"{0}"'.format(hashlib.md5('|'.join(parts).encode()).hexdigest())
+
+
+def version_etag(user):
+    """
+    Strong ETag of a user's version, sent with each PATCH response. It is the
+    only place the version is exposed; clients send it back in If-Match.
+    """
+    return quote_etag(str(user.version))
+
+
+def if_match_version(request, user):
+    """
+    The version an update of `user` must find the row at: the loaded one,
+    once If-Match (when sent) was checked against it.
+    """
+    header = request.META.get('HTTP_IF_MATCH')
+    if header is not None and header.strip() != '*':
+        # If-Match compares strongly, weak tags never match.
+        if version_etag(user) not in [tag for tag in parse_etags(header) if not tag.startswith('W/')]:
+            raise PreconditionFailed()
+    return user.version
+
+
+def requested_shard(request):
+    """
+    Shard a staff listing reads, from the `shard` query parameter (an index
+    into SHARD_DATABASES, 0 by default). None when sharding is off.
+    """
+    if not sharding.enabled():
+        return None
+    try:
+        index = int(request.query_params.get('shard', 0))
+        if index < 0:
+            raise IndexError
+        return sharding.SHARDS[index]
+    except (ValueError, IndexError):
+        raise ValidationError({'shard': ['Expected a shard index below {0}.'.format(len(sharding.SHARDS))]})
+
+
+def user_queryset(request, queryset):
+    """
+    Users `request.user` may see: everyone on the requested shard for staff,
+    their own row otherwise.
+    """
+    if request.user.is_staff:
+        return sharding.on_shard(queryset, requested_shard(request))
+    return sharding.on_shard(queryset, sharding.db_for_user(request.user)).filter(
+        email_canonical=canonical_email(str(request.user)))
+
+
+def flag_password_reset(email):
+    """
+    The user registered with `email`, flagged as having asked for a password
+    reset, or None. Looks on the email's shard first.
+    """
+    alias = sharding.db_for_email(email)
+    for shard in [alias] + sharding.other_shards(alias) if alias else [None]:
+        user = CustomUser.objects.db_manager(shard).flag_password_reset(email)
+        if user is not None:
+            # The raw UPDATE sends no post_save, which is what pins on save.
+            pin_user(user.pk)
+            return user
+    return None
+
+
+def reset_link_user(uid, token):
+    """
+    The user a password reset link is for, or None when the link is forged,
+    expired or already used. Forged and expired links cost no query.
+    """
+    try:
+        shard, pk = sharding.decode_uid(uid)
+    except (ValueError, IndexError):
+        return None
+    if default_token_generator.prevalidate(pk, token) is None:
+        return None
+    try:
+        user = primary_fallback(CustomUser.DoesNotExist, sharding.get_from_shards, CustomUser.objects.all(), shard,
+                                pk=pk)
+        if read_after_write(user):
+            # The reset flag was set moments ago, maybe not on the replica yet.
+            with use_primary():
+                user = sharding.get_from_shards(CustomUser.objects.all(), shard, pk=pk)
+    except (CustomUser.DoesNotExist, ValueError):
+        return None
+    return user if default_token_generator.check_token(user, token) else None
+
+
+def visible_to(request, user):
+    """
+    Whether `user_queryset(request, ...)` would list the loaded `user`.
+    """
+    if request.user.is_staff:
+        return requested_shard(request) in (None, sharding.shard_of(user))
+    return user.email_canonical == canonical_email(str(request.user))
+
+
+def next_shard_link(request):
+    shard = requested_shard(request)
+    index = sharding.SHARDS.index(shard) + 1 if shard else None
+    if index is None or index >= len(sharding.SHARDS):
+        return None
+    return remove_query_param(replace_query_param(request.build_absolute_uri(), 'shard', index), 'cursor')
+
+
+def me_users(request, queryset, paginator):
+    """
+    Users listed by `me` as (users, pagination links, last modified): a
+    keyset page of everyone for staff, the caller's own row otherwise.
+    Staff page through the shards one after the other.
+    """
+    if request.user.is_staff:
+        users = paginator.paginate_queryset(queryset, request)
+        links = {"next": paginator.get_next_link(), "previous": paginator.get_previous_link()}
+        if links["next"] is None:
+            links["next"] = next_shard_link(request)
+        return users, links, None
+    # The caller's row, unless authentication came from the token cache.
+    user = identity.get(request.user.pk)
+    users = [UserRowSerializer.row(user)] if user is not None else list(queryset)
+    last_modified = int(max(u['updated_at'] for u in users).timestamp()) if users else None
+    return users, {}, last_modified
+
+
+def me_listing(request, queryset, paginator, context):
+    """
+    `me` as (serialize, pagination links, last modified, ETag); serialize()
+    returns the users' data, so a 304 never serializes. A non-staff user's
+    own row comes from me_cache when it is there.
+    """
+    queryset = queryset.values(*UserRowSerializer.VALUES)
+    if request.user.is_staff:
+        users, extra, last_modified = me_users(request, queryset, paginator)
+        return (lambda: UserRowSerializer(context).many(users)), extra, last_modified, \
+            users_etag(request, user_versions(users))
+    base_url = request.build_absolute_uri('/')
+    entry = me_cache.get(request.user.pk, base_url)
+    if entry is None:
+        users, _, last_modified = me_users(request, queryset, paginator)
+        entry = me_cache.set(request.user.pk, base_url, UserRowSerializer(context).many(users),
+                             user_versions(users), last_modified)
+    return (lambda: entry['data']), {}, entry['last_modified'], users_etag(request, entry['versions'])
+
+
+def me_data(request, data, extra):
+    content = {
+        "user": str(request.user),
+        "token": str(request.auth)
+    }
+    return dict({"Message": "Hello Good Morning", "content": content, "user": data}, **extra)
+
+
+def set_me_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+def log_out(token, everywhere=False):
+    """
+    Delete the request's token, or with `everywhere` every token of its
+    user. Returns False when there was none to delete.
+    """
+    if token is None:
+        return False
+    tokens = sharding.on_shard(AuthToken.objects, sharding.db_for_user(token))
+    if everywhere:
+        deleted, _ = tokens.filter(user_id=token.user_id).delete()
+        token_cache.invalidate_user(token.user_id)
+    else:
+        deleted, _ = tokens.filter(key=token.key).delete()
+        token_cache.invalidate(token.key)
+    return bool(deleted)
+
+
+def log_out_everywhere(request):
+    return request.GET.get('all', '').lower() in ('1', 'true')
 
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
     permission_classes = [UserAccessPermission]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
+    throttle_classes = [SlidingWindowThrottle]
     parser_classes = [MultiPartParser]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    pagination_class = UserCursorPagination
     http_method_names = ['get', 'patch', 'post']
 
     lookup_field = 'pk'
     lookup_value_regex = '[0-9]+'
 
+    def initial(self, request, *args, **kwargs):
+        if self.action == 'update':
+            # Must be in place before request.data is parsed.
+            request._request.upload_handlers = [ProfileImageUploadHandler(request._request)]
+        super().initial(request, *args, **kwargs)
+
     def get_serializer_class(self):
         # print(self.action)
         if self.action == 'register':
             return RegisterSerializer
+        if self.action == 'register_bulk':
+            return BulkRegisterSerializer
         if self.action == 'login':
             return LoginSerializer
         if self.action == 'forget_password':
@@ -49,7 +275,8 @@ class UserViewSet(viewsets.ModelViewSet):
 
     def get_authenticators(self):
         # print(self.action)
-        if self.request.method == "POST":
+        # self.action is not set yet when the request's authenticators are built.
+        if self.request.method == "POST" and self.action_map.get('post') != 'register_bulk':
             return []
         return super().get_authenticators()
 
@@ -66,12 +293,22 @@ class UserViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return super().get_queryset()
-        elif self.action == 'forget_password':
-            return super().get_queryset()
-        else:
-            return super().get_queryset().filter(email=self.request.user)
+        if getattr(self, 'swagger_fake_view', False):
+            # Schema generation (profiles.schema) runs without a request.
+            return super().get_queryset().none()
+        return user_queryset(self.request, super().get_queryset())
+
+    def get_object(self):
+        """
+        The user named in the URL. When that is the authenticated user and
+        it was read from the database in this request, the loaded instance
+        is reused instead of querying the row again.
+        """
+        user = identity.get(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        if user is None or user.pk != self.request.user.pk or not visible_to(self.request, user):
+            return identity.remember(super().get_object())
+        self.check_object_permissions(self.request, user)
+        return user
 
     @action(detail=False, methods=['post'], url_path='register', url_name='register', permission_classes=[])
     def register(self, request):
@@ -82,6 +319,36 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response({'result': 'User created', 'user_data': serializer.data},
                         status=status.HTTP_201_CREATED, )
 
+    @action(detail=False, methods=['post'], url_path='register-bulk', url_name='register-bulk',
+            permission_classes=[IsAdminUser], parser_classes=[FastJSONParser, MultiPartParser])
+    def register_bulk(self, request):
+        upload = request.FILES.get('file')
+        if upload is not None:
+            fmt = request.data.get('format') or guess_format(upload.name)
+            if fmt not in FORMATS:
+                return Response({'result': 'Unsupported format, use one of: ' + ', '.join(FORMATS)},
+                                status=status.HTTP_400_BAD_REQUEST)
+            records = read_records(upload, fmt)
+        elif isinstance(request.data, list):
+            records = request.data
+        else:
+            return Response({'result': 'Send a JSON list of users or upload a json, jsonl or csv file'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        errors = []
+
+        def on_error(row, email, error):
+            errors.append({'row': row, 'email': email, 'errors': error})
+
+        try:
+            created, failed = import_users(records, on_error=on_error)
+        except ImportInterrupted as e:
+            # Earlier chunks are committed; say how many.
+            return Response({'result': 'Could not read upload: {0}'.format(e.error), 'created': e.created,
+                             'failed': e.failed, 'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'result': 'Users imported', 'created': created, 'failed': failed, 'errors': errors},
+                        status=status.HTTP_201_CREATED)
+
     @action(detail=False, methods=['post'], url_path='login', url_name='login', permission_classes=[])
     def login(self, request):
         serializer = self.get_serializer(data=request.data)
@@ -89,116 +356,109 @@ class UserViewSet(viewsets.ModelViewSet):
         user = serializer.validated_data['user']
         if user:
             update_last_login(None, user)
-            t, _ = Token.objects.get_or_create(user=user)
-            return Response({'result': str(user), "token": t.key}, status=status.HTTP_202_ACCEPTED, )
+            # A token per login, so each device can log out on its own.
+            shard = sharding.db_for_user(user)
+            t = sharding.on_shard(AuthToken.objects, shard).create(
+                user=user, name=request.META.get('HTTP_USER_AGENT', '')[:100], **sharding.token_defaults(shard))
+            return Response({'result': str(user), "token": t.key, "expires_at": t.expires_at},
+                            status=status.HTTP_202_ACCEPTED, )
         return Response({'result': 'Wrong credentials'})
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
-        self.check_object_permissions(request, instance)
-        response = super(UserViewSet, self).update(request, *args, **kwargs)
-        print(response.data['profile_image'])
-        return Response({'Update': instance.email, 'Profile Image': response.data['profile_image']},
-                        status=status.HTTP_202_ACCEPTED)
+        expected_version = if_match_version(request, instance)
+        serializer = self.get_serializer(instance, data=request.data, partial=kwargs.pop('partial', False))
+        serializer.is_valid(raise_exception=True)
+        try:
+            # Only the submitted columns are written, and only if no other
+            # write got in since the row was read.
+            serializer.save(expected_version=expected_version)
+        except VersionConflict:
+            raise PreconditionFailed()
+        logger.info('Updated user %s, profile image %s', instance.pk, serializer.data['profile_image'])
+        return Response({'Update': instance.email, 'Profile Image': serializer.data['profile_image']},
+                        status=status.HTTP_202_ACCEPTED, headers={'ETag': version_etag(instance)})
 
     @action(detail=False, methods=['get'], url_path='me', url_name='me')
     def me(self, request):
-        content = {
-            "user": str(request.user),
-            "token": str(request.auth)
-        }
-        user = self.get_serializer(self.get_queryset(), many=True)
-        return Response({"Message": "Hello Good Morning", "content": content, "user": user.data},
-                        status=status.HTTP_200_OK)
+        serialize, extra, last_modified, etag = me_listing(request, self.get_queryset(), self.paginator,
+                                                           self.get_serializer_context())
+        not_modified = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = Response(me_data(request, serialize(), extra), status=status.HTTP_200_OK)
+        return set_me_validators(response, etag, last_modified)
+
+    @action(detail=False, methods=['get'], url_path='export', url_name='export', permission_classes=[IsAdminUser])
+    def export(self, request):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in EXPORTERS:
+            return Response({'result': 'Unsupported export type, use one of: ' + ', '.join(EXPORTERS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return export_response(self.get_queryset(), request, export_type)
 
     @action(detail=False, methods=['get'], url_path='logout', url_name='logout')
     def logout(self, request):
-        user = self.request.user
-        # print(user)
-        try:
-            user.auth_token.delete()
-        except (AttributeError, ObjectDoesNotExist):
+        # ?all=true logs out every device.
+        if not log_out(request.auth, everywhere=log_out_everywhere(request)):
             return Response({'result': 'error in logout, try again'}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'result': 'successfully logged out'}, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['post'], url_path='forget-password', url_name='forget-password')
     def forget_password(self, request):
-        print(request.data['email'])
         email = request.data['email']
-        try:
-            qs = self.get_queryset().filter(email=email)
-            match = self.get_queryset().get(email=email)
-        except CustomUser.DoesNotExist:
+        user = flag_password_reset(email)
+        if user is None:
             return Response({'result': 'Email not registered'}, status=status.HTTP_404_NOT_FOUND)
-        if len(qs) > 0:
-            user = qs[0]
-        print(user.has_requested_password_reset)
-        user.has_requested_password_reset = True
-        user.save()
-        print(user.has_requested_password_reset)
         token = default_token_generator.make_token(user)
-        print(token)
         site = get_current_site(request)
-        uid = urlsafe_base64_encode(force_bytes(user.pk))
-        print(uid)
+        uid = sharding.encode_uid(user)
         url = UserViewSet.reverse_action(self, UserViewSet.reset_password.url_name, args=[uid, token])
-        print(url)
+        logger.info('Password reset requested for user %s', user.pk)
         # link = "{}".format(reverse('users:users-reset-password', args=[uid, token]))
-        message = render_to_string('password_reset_request.html', {
-            'user': user,
-            'domain': site.domain,
-            'link': url,
-        })
+        with metrics.timer(metrics.TEMPLATE_RENDER_TIME, template='password_reset_request.html'):
+            message = render_to_string('password_reset_request.html', {
+                'user': user,
+                'domain': site.domain,
+                'link': url,
+            })
         subject = "Reset Password"
         # message = "Click on the below link to reset your password"
         email_from = settings.EMAIL_HOST_USER
         recipient_list = [email]
-        print(recipient_list)
-        try:
-            send_mail(subject=subject, message='', from_email=email_from, recipient_list=recipient_list,
-                      html_message=message)
-        except smtplib.SMTPException:
-            return Response({'result': 'Error sending mail'})
+        enqueue_mail(subject=subject, message='', from_email=email_from, recipient_list=recipient_list,
+                     html_message=message)
         return Response({'result': 'Mail sent successfully'})
 
     @action(detail=False, methods=['get', 'post'], url_path='reset-password/(?P<uid>[\w-]+)/(?P<token>[\w-]+)',
-            url_name='reset-password', renderer_classes=[TemplateHTMLRenderer], authentication_classes=[],
+            url_name='reset-password', renderer_classes=[TimedTemplateHTMLRenderer], authentication_classes=[],
             permission_classes=[], parser_classes=[FormParser])
     def reset_password(self, request, uid, token, *args, **kwargs):
-        print(self.request.method)
+        user = reset_link_user(uid, token)
         if self.request.method == 'POST':
-            print(self.request.data)
             # print(self.kwargs)
             data = self.request.data
-            u_id = force_text(urlsafe_base64_decode(uid))
-            user = CustomUser.objects.get(pk=u_id)
-            token_result = default_token_generator.check_token(user, token)
-            print(token_result)
-            if user is not None and token_result:
-                print('here')
+            logger.debug('Reset token check for uid %s: %s', uid, user is not None)
+            if user is not None:
                 return self.change_password(user, data)
             return Response({'errors': ['invalid token'], 'reset_password': self.get_serializer()},
                             template_name='reset_password.html')
         else:
             # print(self.kwargs)
-            u_id = force_text(urlsafe_base64_decode(self.kwargs['uid']))
-            user = CustomUser.objects.get(pk=u_id)
-            token_result = default_token_generator.check_token(user, self.kwargs['token'])
-            print(token_result)
-            print(user.has_requested_password_reset)
-            if token_result and user.has_requested_password_reset:
+            logger.debug('Reset link check for uid %s: token %s, requested %s', uid, user is not None,
+                         user is not None and user.has_requested_password_reset)
+            if user is not None and user.has_requested_password_reset:
                 return Response({'view': UserViewSet, 'reset_password': self.get_serializer()},
                                 template_name='reset_password.html')
             return Response(template_name='error_password.html')
 
     def change_password(self, user, data):
         s = self.get_serializer(user, data=data)
-        print('here2')
         # print(s)
         if s.is_valid(raise_exception=False):
-            print('here3')
             s.save()
-            print(s.data)
+            logger.info('Password reset completed for user %s', user.pk)
             return Response(
                 {'message': 'Password Updated', 'reset_password': self.get_serializer()},
                 template_name='reset_password.html')
@@ -206,20 +466,38 @@ class UserViewSet(viewsets.ModelViewSet):
             errors = s.errors
             error_msg_list = []
             if len(errors) > 0:
-                print(errors)
+                logger.debug('Password reset for user %s rejected: %s', user.pk, errors)
             if 'password' in errors:
                 error_msg = "Password: "
                 error_msg += errors.get('password')[0]
                 error_msg_list.append(error_msg)
-                print(error_msg)
             if 'confirm_password' in errors:
                 error_msg = "\nConfirm Password: "
                 error_msg += errors.get('confirm_password')[0]
                 error_msg_list.append(error_msg)
-                print(error_msg)
             if 'errors' in errors:
                 for e in errors.get('errors'):
-                    print(e)
                     error_msg_list.append(e)
             return Response({'errors': error_msg_list, 'reset_password': self.get_serializer()},
                             template_name='reset_password.html')
+
+
+def serve_media(request, path):
+    """
+    Serve MEDIA_ROOT, generating profile image variants on first request.
+    """
+    variant = parse_variant_name(posixpath.normpath(path).lstrip('/'))
+    if variant is not None:
+        if not default_storage.exists(variant[0]):
+            raise Http404('Original image does not exist')
+        touch(default_storage.path(generate_variant(*variant)))
+    return serve_file(request, path, document_root=settings.MEDIA_ROOT)
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of profiles.metrics.
+    """
+    if not metrics.enabled:
+        raise Http404('Metrics are disabled')
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')